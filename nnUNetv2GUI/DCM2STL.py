@@ -11,6 +11,7 @@ import styles
 import pydicom
 import shutil
 from stl import mesh
+from skimage import measure
 from PIL import Image, ImageTk
 import numpy as np
 import nibabel as nib
@@ -212,28 +213,52 @@ class AirwaySegmenterGUI(tk.Frame):
 
         threading.Thread(target=script_execution).start()
 
-    def nifti_to_stl(self, nifti_file, stl_file):
-        # Load the NIfTI file
+    def nifti_to_stl(self, nifti_file, stl_file, step_size=1, roi=None):
+        """
+        Meshes a NIfTI label map with marching cubes and saves it as an STL file.
+
+        Parameters:
+        - step_size (int): marching cubes step in voxels, 2 or more trades detail for speed
+        - roi (tuple of slice): part of the volume to mesh; by default the bounding box of
+          the label (plus one voxel), so empty parts of the scan are never visited
+        """
+        # Load the NIfTI file in its stored dtype instead of a float64 copy
         img = nib.load(nifti_file)
-        img_data = img.get_fdata()
+        img_data = np.asanyarray(img.dataobj)
 
         # Ensure the data is binary
-        img_data = img_data.astype(np.uint8)
-        img_data[img_data > 0] = 1
+        img_data = (img_data > 0).view(np.uint8)
+
+        if roi is None:
+            roi = self.label_bounding_box(img_data)
+            if roi is None:
+                raise ValueError(f"{nifti_file} contains no labelled voxels")
+        img_data = img_data[roi]
 
         # Perform marching cubes to extract the surface mesh
-        verts, faces, _, _ = measure.marching_cubes(img_data, level=0)
+        verts, faces, _, _ = measure.marching_cubes(img_data, level=0, step_size=step_size)
+        # Back to the voxel coordinates of the whole volume
+        verts += np.array([s.start or 0 for s in roi], dtype=verts.dtype)
 
-        # Create a new mesh object
+        # Create a new mesh object, one row of three vertices per face
         surface_mesh = mesh.Mesh(np.zeros(faces.shape[0], dtype=mesh.Mesh.dtype))
-
-        for i, f in enumerate(faces):
-            for j in range(3):
-                surface_mesh.vectors[i][j] = verts[f[j], :]
+        surface_mesh.vectors[:] = verts[faces]
 
         # Save the mesh as an STL file
         surface_mesh.save(stl_file)
 
+    @staticmethod
+    def label_bounding_box(mask, margin=1):
+        """Slices of the smallest box holding every nonzero voxel, grown by margin; None if empty."""
+        roi = []
+        for axis in range(mask.ndim):
+            other_axes = tuple(a for a in range(mask.ndim) if a != axis)
+            present = np.flatnonzero(mask.any(axis=other_axes))
+            if present.size == 0:
+                return None
+            roi.append(slice(max(0, present[0] - margin), min(mask.shape[axis], present[-1] + 1 + margin)))
+        return tuple(roi)
+
     def convert_files(self):
         input_path_str = self.input_path.get()
         output_path_str = self.output_path.get()
@@ -5,6 +5,7 @@ from pathlib import Path
 import sys
 import styles
 import vtk
+from meshing import DEFAULT_DECIMATION, DEFAULT_ENGINE, decimate_mesh, extract_surface
 
 class AirwaySegmenterGUI(ctk.CTkFrame):
     def __init__(self, parent, home_callback):
@@ -41,29 +42,20 @@ class AirwaySegmenterGUI(ctk.CTkFrame):
             else:
                 os.system(f"xdg-open {output_path_str}")
 
-    def nifti_to_stl(self,nifti_file_path, stl_file_path, threshold_value=1, decimate=True, decimate_target_reduction=0.5):
+    def nifti_to_stl(self,nifti_file_path, stl_file_path, threshold_value=1, decimate=True, decimate_target_reduction=0.5, engine=DEFAULT_ENGINE,
+                     decimate_algorithm=DEFAULT_DECIMATION):
         try:
             # Load NIfTI file
             reader = vtk.vtkNIFTIImageReader()
             reader.SetFileName(nifti_file_path)
             reader.Update()
             
-            # Apply vtkDiscreteFlyingEdges3D
-            discrete_flying_edges = vtk.vtkDiscreteFlyingEdges3D()
-            discrete_flying_edges.SetInputConnection(reader.GetOutputPort())
-            discrete_flying_edges.SetValue(0, threshold_value)
-            discrete_flying_edges.Update()
-            
-            output_polydata = discrete_flying_edges.GetOutput()
+            # Extract the label surface with the selected engine (see meshing.py)
+            output_polydata = extract_surface(reader.GetOutput(), threshold_value, engine)
 
             # Apply decimation if requested
             if decimate:
-                decimator = vtk.vtkDecimatePro()
-                decimator.SetInputData(output_polydata)
-                decimator.SetTargetReduction(decimate_target_reduction)
-                decimator.PreserveTopologyOn()
-                decimator.Update()
-                output_polydata = decimator.GetOutput()
+                output_polydata = decimate_mesh(output_polydata, decimate_algorithm, decimate_target_reduction)
 
             # Apply smoothing
             smoothing_filter = vtk.vtkSmoothPolyDataFilter()
@@ -3,8 +3,53 @@ from tkinter import filedialog, messagebox
 import os
 from pathlib import Path
 import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
 import styles
 import vtk
+from meshing import DEFAULT_DECIMATION, DEFAULT_ENGINE, decimate_mesh, extract_surface, ras_transform, write_mesh
+from stl_export import export_stl_files, summary_message, write_summary
+
+POLL_INTERVAL_MS = 100
+
+
+def convert_nifti_to_stl(nifti_file_path, stl_file_path, threshold_value=1, decimate=True, decimate_target_reduction=0.5,
+                         engine=DEFAULT_ENGINE, decimate_algorithm=DEFAULT_DECIMATION, target_triangles=None):
+    """
+    Meshes a NIfTI segmentation and writes it as a binary STL, or the mesh format of the
+    file extension (see meshing.write_mesh). Raises on failure.
+    Returns the triangle counts before and after decimation, the decimation time and the file size.
+    """
+    # Load NIfTI file
+    reader = vtk.vtkNIFTIImageReader()
+    reader.SetFileName(nifti_file_path)
+    reader.Update()
+    
+    # Extract the label surface with the selected engine (see meshing.py)
+    output_polydata = extract_surface(reader.GetOutput(), threshold_value, engine)
+    stats = {"triangles_extracted": output_polydata.GetNumberOfPolys()}
+
+    # Apply decimation if requested
+    if decimate:
+        start = time.perf_counter()
+        output_polydata = decimate_mesh(output_polydata, decimate_algorithm, decimate_target_reduction, target_triangles)
+        stats["decimate_seconds"] = time.perf_counter() - start
+
+    # Apply smoothing
+    smoothing_filter = vtk.vtkSmoothPolyDataFilter()
+    smoothing_filter.SetInputData(output_polydata)
+    smoothing_filter.SetNumberOfIterations(5)
+    smoothing_filter.SetRelaxationFactor(0.05)
+    smoothing_filter.FeatureEdgeSmoothingOff()
+    smoothing_filter.BoundarySmoothingOn()
+    smoothing_filter.Update()
+    output_polydata = smoothing_filter.GetOutput()
+
+    # Transform to RAS, compute normals and write in the format of the file extension
+    stats["file_bytes"] = write_mesh(output_polydata, ras_transform(reader.GetQFormMatrix()), stl_file_path)
+    stats["triangles"] = output_polydata.GetNumberOfPolys()
+    return stats
+
 
 class STLConverterGUI(ctk.CTkFrame):
     def __init__(self, parent, home_callback):
@@ -17,6 +62,9 @@ class STLConverterGUI(ctk.CTkFrame):
 
         self.input_path = ctk.StringVar()
         self.output_path = ctk.StringVar()
+        # Batches run off the Tk thread so the window keeps responding, one at a time
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="stl-export")
+        self.conversion = None
 
         self.create_widgets()
 
@@ -43,84 +91,16 @@ class STLConverterGUI(ctk.CTkFrame):
             else:
                 os.system(f"xdg-open {output_path_str}")
 
-    def nifti_to_stl(self,nifti_file_path, stl_file_path, threshold_value=1, decimate=True, decimate_target_reduction=0.5):
+    def nifti_to_stl(self,nifti_file_path, stl_file_path, threshold_value=1, decimate=True, decimate_target_reduction=0.5, engine=DEFAULT_ENGINE):
         try:
-            # Load NIfTI file
-            reader = vtk.vtkNIFTIImageReader()
-            reader.SetFileName(nifti_file_path)
-            reader.Update()
-            
-            # Apply vtkDiscreteFlyingEdges3D
-            discrete_flying_edges = vtk.vtkDiscreteFlyingEdges3D()
-            discrete_flying_edges.SetInputConnection(reader.GetOutputPort())
-            discrete_flying_edges.SetValue(0, threshold_value)
-            discrete_flying_edges.Update()
-            
-            output_polydata = discrete_flying_edges.GetOutput()
-
-            # Apply decimation if requested
-            if decimate:
-                decimator = vtk.vtkDecimatePro()
-                decimator.SetInputData(output_polydata)
-                decimator.SetTargetReduction(decimate_target_reduction)
-                decimator.PreserveTopologyOn()
-                decimator.Update()
-                output_polydata = decimator.GetOutput()
-
-            # Apply smoothing
-            smoothing_filter = vtk.vtkSmoothPolyDataFilter()
-            smoothing_filter.SetInputData(output_polydata)
-            smoothing_filter.SetNumberOfIterations(5)
-            smoothing_filter.SetRelaxationFactor(0.05)
-            smoothing_filter.FeatureEdgeSmoothingOff()
-            smoothing_filter.BoundarySmoothingOn()
-            smoothing_filter.Update()
-            output_polydata = smoothing_filter.GetOutput()
-
-            # Get QForm matrix
-            qform_matrix = reader.GetQFormMatrix()
-
-            # Create IJK to RAS transformation
-            ijk_to_ras = vtk.vtkMatrix4x4()
-            ijk_to_ras.DeepCopy(qform_matrix)
-
-            # Adjust for VTK's coordinate system
-            flip_xy = vtk.vtkMatrix4x4()
-            flip_xy.SetElement(0, 0, -1)
-            flip_xy.SetElement(1, 1, -1)
-
-            vtk.vtkMatrix4x4.Multiply4x4(flip_xy, ijk_to_ras, ijk_to_ras)
-
-            # Create transformation matrix
-            transform = vtk.vtkTransform()
-            transform.SetMatrix(ijk_to_ras)
-
-            # Apply transformation
-            transform_filter = vtk.vtkTransformPolyDataFilter()
-            transform_filter.SetInputData(output_polydata)
-            transform_filter.SetTransform(transform)
-            transform_filter.Update()
-            transformed_polydata = transform_filter.GetOutput()
-
-            # Compute normals
-            normals = vtk.vtkPolyDataNormals()
-            normals.SetInputData(transformed_polydata)
-            normals.SetFeatureAngle(60.0)
-            normals.ConsistencyOn()
-            normals.SplittingOff()
-            normals.Update()
-
-            # Write STL file
-            stl_writer = vtk.vtkSTLWriter()
-            stl_writer.SetFileTypeToBinary()
-            stl_writer.SetFileName(stl_file_path)
-            stl_writer.SetInputData(normals.GetOutput())
-            stl_writer.Write()
-
+            convert_nifti_to_stl(nifti_file_path, stl_file_path, threshold_value, decimate, decimate_target_reduction, engine)
         except Exception as e:
             messagebox.showerror("Conversion Error", f"Failed to convert {nifti_file_path} to STL. Error: {e}")
 
     def convert_files(self):
+        if self.conversion is not None:
+            messagebox.showwarning("Conversion Running", "Please wait for the current conversion to finish.")
+            return
         input_path_str = self.input_path.get()
         output_path_str = self.output_path.get()
         
@@ -133,15 +113,36 @@ class STLConverterGUI(ctk.CTkFrame):
             messagebox.showwarning("Input Error", "No NIfTI files found in the selected input directory.")
             return
 
-        for nifti_file in nifti_files:
+        jobs = []
+        for nifti_file in sorted(nifti_files):
             nifti_file_path = os.path.join(input_path_str, nifti_file)
             base_name = os.path.splitext(os.path.splitext(nifti_file)[0])[0]
             stl_file_path = os.path.join(output_path_str, f"{base_name}.stl")
-            print(f"The base name is {base_name}")
-            print(f"The stl_file_path is {stl_file_path}")
-            self.nifti_to_stl(nifti_file_path, stl_file_path, threshold_value=1, decimate=True, decimate_target_reduction=0.5)
-
-        messagebox.showinfo("Conversion Complete", "All NIfTI files have been converted to STL files.")
+            jobs.append((nifti_file_path, stl_file_path))
+
+        # Files are meshed in parallel worker processes, failures are reported once at the end
+        self.conversion = self.executor.submit(self.export_batch, jobs, output_path_str)
+        self.after(POLL_INTERVAL_MS, self.poll_conversion)
+
+    @staticmethod
+    def export_batch(jobs, output_path_str):
+        """Runs on the executor thread: meshes every job and returns the summary dialog (kind, title, message)."""
+        results = export_stl_files(jobs, convert_nifti_to_stl, threshold_value=1, decimate=True, decimate_target_reduction=0.5)
+        summary_path = write_summary(results, output_path_str)
+        return summary_message(results, summary_path)
+
+    def poll_conversion(self):
+        # Runs on the Tk thread: only here are dialogs shown
+        if not self.conversion.done():
+            self.after(POLL_INTERVAL_MS, self.poll_conversion)
+            return
+        try:
+            kind, title, message = self.conversion.result()
+        except Exception as e:
+            kind, title, message = "error", "Conversion Error", f"STL export failed: {e}"
+        self.conversion = None
+        show = messagebox.showinfo if kind == "info" else messagebox.showerror
+        show(title, message)
 
     # def create_widgets(self):
     #     # Configure the main frame to center the container
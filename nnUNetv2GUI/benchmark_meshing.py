@@ -0,0 +1,140 @@
+"""
+Compares the surface extraction engines of meshing.py on real segmentations.
+
+For every segmentation and engine it reports the extraction time, peak memory,
+triangle count and how far the volume enclosed by the mesh is from the voxel
+volume of the label, then names the fastest engine within the tolerance:
+
+    python benchmark_meshing.py /data/Segmentations --tolerance 2 --csv meshing.csv
+
+Each measurement runs in its own fresh process, one after the other, so peak
+memory (max RSS) belongs to that engine alone and runs do not compete for cores.
+"""
+import argparse
+import csv
+import logging
+import multiprocessing
+import os
+import statistics
+import sys
+import time
+
+from instrumentation import peak_rss_mb
+from meshing import ENGINES
+
+COLUMNS = ["file", "engine", "seconds", "peak_mb", "extra_mb", "triangles", "mesh_volume", "voxel_volume", "error_pct"]
+
+
+def measure(nifti_path, engine, label):
+    """Extracts the surface of `label` in nifti_path with `engine` and returns one result row."""
+    import numpy as np
+    import vtk
+    from vtk.util import numpy_support
+
+    from meshing import crop_to_label, extract_surface
+
+    reader = vtk.vtkNIFTIImageReader()
+    reader.SetFileName(nifti_path)
+    reader.Update()
+    # Cropping is shared by every engine and not part of the comparison
+    image = crop_to_label(reader.GetOutput(), label)
+    values = numpy_support.vtk_to_numpy(image.GetPointData().GetScalars())
+    voxel_volume = int(np.count_nonzero(values == label)) * float(np.prod(image.GetSpacing()))
+    baseline = peak_rss_mb()
+
+    start = time.perf_counter()
+    polydata = extract_surface(image, label, engine)
+    seconds = time.perf_counter() - start
+    peak = peak_rss_mb()
+
+    triangles = vtk.vtkTriangleFilter()
+    triangles.SetInputData(polydata)
+    mass = vtk.vtkMassProperties()
+    mass.SetInputConnection(triangles.GetOutputPort())
+    mass.Update()
+    mesh_volume = mass.GetVolume()
+    return {
+        "file": os.path.basename(nifti_path),
+        "engine": engine,
+        "seconds": round(seconds, 3),
+        "peak_mb": round(peak, 1) if peak is not None else None,
+        "extra_mb": round(peak - baseline, 1) if peak is not None else None,
+        "triangles": polydata.GetNumberOfPolys(),
+        "mesh_volume": round(mesh_volume, 2),
+        "voxel_volume": round(voxel_volume, 2),
+        "error_pct": round(100.0 * (mesh_volume - voxel_volume) / voxel_volume, 3) if voxel_volume else None,
+    }
+
+
+def run_benchmark(nifti_files, engines, label=1):
+    rows = []
+    context = multiprocessing.get_context("spawn")
+    for nifti_path in nifti_files:
+        for engine in engines:
+            with context.Pool(1) as pool:
+                try:
+                    row = pool.apply(measure, (nifti_path, engine, label))
+                except Exception as e:
+                    logging.error(f"{engine} failed on {nifti_path}: {e}")
+                    continue
+            logging.info(f"{row['file']} {engine}: {row['seconds']} s, {row['triangles']} triangles, "
+                         f"{row['error_pct']} % volume error")
+            rows.append(row)
+    return rows
+
+
+def summarize(rows, tolerance):
+    """Per-engine median time and worst volume error, and the fastest engine within tolerance."""
+    print(f"{'engine':<16}{'median s':>10}{'median tris':>14}{'max |err| %':>13}{'peak MB':>10}")
+    candidates = []
+    for engine in ENGINES:
+        engine_rows = [row for row in rows if row["engine"] == engine]
+        if not engine_rows:
+            continue
+        median_seconds = statistics.median(row["seconds"] for row in engine_rows)
+        median_triangles = statistics.median(row["triangles"] for row in engine_rows)
+        worst_error = max(abs(row["error_pct"]) for row in engine_rows if row["error_pct"] is not None)
+        peaks = [row["peak_mb"] for row in engine_rows if row["peak_mb"] is not None]
+        peak = f"{max(peaks):.0f}" if peaks else "n/a"
+        print(f"{engine:<16}{median_seconds:>10.3f}{median_triangles:>14.0f}{worst_error:>13.3f}{peak:>10}")
+        if worst_error <= tolerance:
+            candidates.append((median_seconds, engine))
+    if candidates:
+        print(f"Fastest engine within {tolerance} % volume error: {min(candidates)[1]}")
+    else:
+        print(f"No engine stays within {tolerance} % volume error")
+
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Benchmark the mesh extraction engines on NIfTI segmentations.")
+    parser.add_argument("inputs", nargs="+", help="Segmentation files or folders holding them")
+    parser.add_argument("--engines", nargs="+", choices=ENGINES, default=list(ENGINES))
+    parser.add_argument("--label", type=int, default=1, help="Label to mesh (default: 1, the airway)")
+    parser.add_argument("--tolerance", type=float, default=1.0,
+                        help="Largest acceptable enclosed-volume error in percent (default: 1)")
+    parser.add_argument("--csv", help="Also write every measurement to this CSV file")
+    args = parser.parse_args(argv)
+
+    nifti_files = []
+    for path in args.inputs:
+        if os.path.isdir(path):
+            nifti_files += sorted(os.path.join(path, f) for f in os.listdir(path) if f.endswith(('.nii', '.nii.gz')))
+        else:
+            nifti_files.append(path)
+    if not nifti_files:
+        parser.error("no NIfTI files found")
+
+    rows = run_benchmark(nifti_files, args.engines, args.label)
+    if args.csv:
+        with open(args.csv, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=COLUMNS)
+            writer.writeheader()
+            writer.writerows(rows)
+    if rows:
+        summarize(rows, args.tolerance)
+    return 0 if rows else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,168 @@
+"""
+Benchmark suite for the pipeline stages on synthetic phantoms (see phantom.py).
+
+For every data size it generates a phantom dataset, then times discovery (cold
+and with a saved index), anonymization, DICOM to NIfTI conversion, prediction,
+volume calculation and STL export one stage at a time, and finally the whole
+pipeline end to end. Prediction uses phantom.ThresholdPredictor instead of
+nnUNet, so the suite runs on CPU-only machines without the model:
+
+    python benchmark_pipeline.py --sizes small medium --patients 4 --json benchmark.json
+
+Times are the median of --repeats runs; per case is that time divided by the
+number of cases.
+"""
+import argparse
+import json
+import logging
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+from anonymize import AnonymizationEngine
+from discovery import DicomIndex
+from phantom import TRANSFER_SYNTAXES, ThresholdPredictor, generate_dataset
+from pipeline import PipelineOptions, PipelineRun, nifti_to_stl, process_dicom_series
+from volume import label_statistics
+
+# (slices, rows and columns, voxel spacing in mm)
+SIZES = {
+    "small": (64, 128, 0.8),
+    "medium": (160, 256, 0.4),
+    "large": (320, 400, 0.3),
+}
+
+
+class StandInRun(PipelineRun):
+    """PipelineRun that predicts with ThresholdPredictor instead of nnUNet."""
+
+    def load_predictor(self):
+        return ThresholdPredictor()
+
+    def model_identity(self):
+        return "threshold-stand-in"
+
+
+def timed(fn, repeats):
+    """Median wall time in seconds of `repeats` calls of fn."""
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def benchmark_size(size_name, work_folder, patients, time_points, transfer_syntax, repeats, workers):
+    slices, size, spacing = SIZES[size_name]
+    data_folder = os.path.join(work_folder, size_name)
+    start = time.perf_counter()
+    cases = generate_dataset(data_folder, patients, time_points, slices, size, (spacing,) * 3, transfer_syntax)
+    logging.info(f"Generated {len(cases)} {size_name} phantom(s) in {time.perf_counter() - start:.1f} s")
+    dicom_root = os.path.join(data_folder, "DICOM")
+    scratch = os.path.join(data_folder, "scratch")
+    results = {}
+
+    def discover(index_path):
+        run = PipelineRun(PipelineOptions(input_folder=dicom_root, use_cache=False))
+        run.dicom_index = DicomIndex(index_path)
+        found = run.discover_cases()
+        assert len(found) == len(cases), f"discovered {len(found)} of {len(cases)} cases"
+
+    index_path = os.path.join(scratch, "dicom_index.json")
+    os.makedirs(scratch, exist_ok=True)
+    results["discovery (cold)"] = timed(lambda: discover(None), repeats)
+    discover(index_path)
+    results["discovery (saved index)"] = timed(lambda: discover(index_path), repeats)
+
+    def anonymize():
+        engine = AnonymizationEngine(workers)
+        try:
+            for case in cases:
+                engine.anonymize_folder(case["dicom_folder"], os.path.join(scratch, "anonymized", case["name"]),
+                                        case["name"])
+        finally:
+            engine.close()
+        if engine.failures:
+            raise RuntimeError(f"{len(engine.failures)} file(s) failed to anonymize")
+    results["anonymization"] = timed(anonymize, repeats)
+
+    nifti_folder = os.path.join(scratch, "nifti")
+    os.makedirs(nifti_folder, exist_ok=True)
+
+    def convert():
+        for case in cases:
+            case["nifti_path"] = process_dicom_series(case["dicom_folder"], nifti_folder, case["name"])
+    results["conversion"] = timed(convert, repeats)
+
+    predictor = ThresholdPredictor()
+
+    def predict():
+        for case in cases:
+            predictor.predict(case["nifti_path"], os.path.join(scratch, f"{case['name']}_pred.nii.gz"))
+    results["prediction (stand-in)"] = timed(predict, repeats)
+
+    def volume():
+        for case in cases:
+            stats = label_statistics(case["label_path"])
+            assert stats["airway_voxels"] == case["airway_voxels"]
+    results["volume"] = timed(volume, repeats)
+
+    def export_stl():
+        for case in cases:
+            nifti_to_stl(case["label_path"], os.path.join(scratch, f"{case['name']}.stl"))
+    results["stl export"] = timed(export_stl, repeats)
+
+    def end_to_end():
+        shutil.rmtree(f"{dicom_root}_Processed", ignore_errors=True)
+        options = PipelineOptions(input_folder=dicom_root, rename_files=True, convert_to_nifti=True,
+                                  run_prediction=True, calculate_volume=True, export_stl=True, use_cache=False,
+                                  conversion_workers=workers, anonymize_workers=workers)
+        StandInRun(options).run()
+    results["end to end"] = timed(end_to_end, repeats)
+
+    return [
+        {"size": size_name, "shape": [slices, size, size], "spacing_mm": spacing, "cases": len(cases),
+         "stage": stage, "seconds": round(seconds, 3), "seconds_per_case": round(seconds / len(cases), 3)}
+        for stage, seconds in results.items()
+    ]
+
+
+def main(argv=None):
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Time the pipeline stages on synthetic phantoms.")
+    parser.add_argument("--sizes", nargs="+", choices=SIZES, default=["small", "medium"])
+    parser.add_argument("--patients", type=int, default=2)
+    parser.add_argument("--time-points", nargs="*", default=[], help="e.g. T1 T2 for patient/time-point folders")
+    parser.add_argument("--transfer-syntax", choices=TRANSFER_SYNTAXES, default="explicit")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--workers", type=int, default=max(1, (os.cpu_count() or 2) - 1))
+    parser.add_argument("--work-folder", help="Where to write the phantoms (default: a temporary folder, removed after)")
+    parser.add_argument("--json", help="Also write the results to this JSON file")
+    args = parser.parse_args(argv)
+
+    work_folder = args.work_folder or tempfile.mkdtemp(prefix="airway_benchmark_")
+    rows = []
+    try:
+        for size_name in args.sizes:
+            rows += benchmark_size(size_name, work_folder, args.patients, args.time_points, args.transfer_syntax,
+                                   args.repeats, args.workers)
+    finally:
+        if not args.work_folder:
+            shutil.rmtree(work_folder, ignore_errors=True)
+
+    print(f"{'size':<8}{'stage':<26}{'seconds':>10}{'per case':>10}")
+    for row in rows:
+        print(f"{row['size']:<8}{row['stage']:<26}{row['seconds']:>10.3f}{row['seconds_per_case']:>10.3f}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"repeats": args.repeats, "workers": args.workers,
+                       "transfer_syntax": args.transfer_syntax, "results": rows}, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
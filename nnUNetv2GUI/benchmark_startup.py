@@ -0,0 +1,62 @@
+"""
+Measures how long the GUI takes to show its window.
+
+Each run starts a fresh Python process that builds the main window and draws it,
+once the way main.py starts now (heavy libraries deferred, see lazy_imports.py)
+and once importing every heavy library first, the way it used to:
+
+    python benchmark_startup.py --repeats 5
+
+Prints the median time to the drawn window for both, and how long each heavy
+library takes to import. Needs a display (or e.g. xvfb-run on Linux).
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+CHILD = """
+import json, time
+start = time.perf_counter()
+from lazy_imports import preload
+libraries = preload() if {eager} else {{}}
+import main
+app = main.UnifiedAirwaySegmentationGUI(warm_imports=False)
+app.update()
+window = time.perf_counter() - start
+libraries = libraries or preload()
+app.destroy()
+print(json.dumps({{"window": window, "libraries": libraries}}))
+"""
+
+
+def measure(eager):
+    """Seconds to the drawn window, and per-library import seconds, in a fresh process."""
+    result = subprocess.run([sys.executable, "-c", CHILD.format(eager=eager)], capture_output=True, text=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__)))
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1] if result.stderr.strip() else "startup failed")
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Time the GUI from process start to its first drawn window.")
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args(argv)
+
+    results = {}
+    for label, eager in (("deferred imports", False), ("eager imports", True)):
+        runs = [measure(eager) for _ in range(args.repeats)]
+        results[label] = runs
+        print(f"{label:<18} window after {statistics.median(run['window'] for run in runs):.2f} s")
+    print("Import time per library (median, first import in a fresh process):")
+    for name in results["deferred imports"][0]["libraries"]:
+        seconds = statistics.median(run["libraries"][name] for run in results["deferred imports"])
+        print(f"  {name:<26}{seconds:>6.2f} s")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,256 @@
+"""
+Content-addressed cache for pipeline results, shared across output folders.
+
+Keys are derived from what a result actually depends on:
+- DICOM series: hash of every slice's pixel data bytes plus its geometry tags
+- NIfTI images: hash of the voxel bytes plus shape, dtype, scaling and affine
+- stage results: hash of the input key, the stage name, its parameters and, for
+  prediction, the identity of the nnUNet checkpoint
+
+so a scan that was already converted, segmented, measured or meshed under the
+same settings is reused regardless of where it sits on disk or what it is called.
+
+Entries live under `<root>/objects/<key[:2]>/<key>/`. Every hit refreshes the
+entry's timestamp and the least recently used entries are evicted once the cache
+grows past its size limit.
+"""
+import glob
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+
+from lazy_imports import lazy_import
+
+nib = lazy_import("nibabel")
+pydicom = lazy_import("pydicom")
+openers = lazy_import("nibabel.openers")
+
+# Bump when a stage changes what it writes so old entries are no longer matched
+CACHE_VERSION = 1
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".airway_segmentator_cache")
+DEFAULT_MAX_GB = 20
+
+# DICOM tags that, together with the pixel data, determine the converted image
+GEOMETRY_TAGS = (
+    "Rows", "Columns", "BitsAllocated", "BitsStored", "PixelRepresentation",
+    "SamplesPerPixel", "PhotometricInterpretation", "PixelSpacing", "SliceThickness",
+    "ImagePositionPatient", "ImageOrientationPatient", "RescaleSlope", "RescaleIntercept",
+)
+
+# Tag (7FE0,0010) as it starts the Pixel Data element, little and big endian
+PIXEL_DATA_TAG = (b"\xe0\x7f\x10\x00", b"\x7f\xe0\x00\x10")
+
+
+def _tag_value(dataset, keyword):
+    value = dataset.get(keyword)
+    if value is None:
+        return None
+    if isinstance(value, (list, tuple, pydicom.multival.MultiValue)):
+        return [str(v) for v in value]
+    return str(value)
+
+
+def dicom_series_key(dicom_folder, file_names=None, chunk_size=1 << 20):
+    """
+    Key of the DICOM slices in a folder (or only `file_names`): pixel data bytes (as
+    stored, not decoded) and geometry of every slice, independent of file names and
+    patient tags. Only the geometry tags are parsed; the pixel data is hashed as raw
+    bytes straight from the file.
+    """
+    slices = []
+    for file_name in file_names if file_names is not None else os.listdir(dicom_folder):
+        path = os.path.join(dicom_folder, file_name)
+        if not os.path.isfile(path):
+            continue
+        try:
+            with open(path, "rb") as f:
+                # Leaves the file at the start of the Pixel Data element
+                dataset = pydicom.dcmread(f, stop_before_pixels=True, specific_tags=list(GEOMETRY_TAGS))
+                if f.read(len(PIXEL_DATA_TAG[0])) not in PIXEL_DATA_TAG:
+                    continue
+                geometry = {keyword: _tag_value(dataset, keyword) for keyword in GEOMETRY_TAGS}
+                geometry["TransferSyntaxUID"] = str(dataset.file_meta.get("TransferSyntaxUID", ""))
+                slice_digest = hashlib.sha256(json.dumps(geometry, sort_keys=True).encode())
+                # The element's VR and length, its value and anything after it, in chunks
+                while chunk := f.read(chunk_size):
+                    slice_digest.update(chunk)
+        except (pydicom.errors.InvalidDicomError, OSError):
+            continue
+        slices.append(slice_digest.hexdigest())
+
+    # Sorting the per-slice digests makes the key independent of file order
+    digest = hashlib.sha256(b"dicom-series")
+    for slice_hash in sorted(slices):
+        digest.update(slice_hash.encode())
+    return digest.hexdigest()
+
+
+def nifti_key(nifti_path, chunk_size=1 << 20):
+    """
+    Key of a NIfTI image: geometry from the header plus the voxel bytes, streamed
+    through the (de)compressor so memory use stays at one chunk.
+    """
+    img = nib.load(nifti_path)
+    header = img.header
+    # A loaded image keeps its data offset and scaling on the array proxy, the header reads 0 and none
+    proxy = img.dataobj
+    geometry = {
+        "shape": [int(n) for n in header.get_data_shape()],
+        "dtype": str(header.get_data_dtype()),
+        "zooms": [float(z) for z in header.get_zooms()],
+        "affine": [[round(float(v), 6) for v in row] for row in img.affine],
+        "scaling": [str(v) for v in (proxy.slope, proxy.inter)],
+    }
+    digest = hashlib.sha256(json.dumps(geometry, sort_keys=True).encode())
+    with openers.ImageOpener(nifti_path) as f:
+        f.seek(int(proxy.offset))
+        while chunk := f.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def stage_key(input_key, stage, params=None):
+    """Key of a stage result from its input key, stage name and parameters."""
+    payload = {"version": CACHE_VERSION, "input": input_key, "stage": stage, "params": params or {}}
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def checkpoint_identity(results_folder, dataset_id=14, configuration="3d_fullres", fold="all"):
+    """
+    Identity of the nnUNet model used for prediction: dataset, configuration, fold and
+    the size/mtime of the checkpoint file, so retrained weights never hit old entries.
+    """
+    identity = {"dataset": dataset_id, "configuration": configuration, "fold": fold}
+    pattern = os.path.join(str(results_folder), f"Dataset{dataset_id:03d}_*", f"*__{configuration}",
+                           f"fold_{fold}", "checkpoint_final.pth")
+    checkpoints = sorted(glob.glob(pattern))
+    if checkpoints:
+        stat = os.stat(checkpoints[0])
+        identity.update(checkpoint=os.path.relpath(checkpoints[0], str(results_folder)),
+                        size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+    else:
+        identity["checkpoint"] = None
+    return identity
+
+
+class ResultCache:
+    """
+    File and value store keyed by content hashes, with LRU eviction past `max_bytes`.
+    Safe to use from the pipeline's stage threads.
+    """
+
+    def __init__(self, root=None, max_bytes=None):
+        self.root = root or os.environ.get("AIRWAY_CACHE_DIR", DEFAULT_CACHE_DIR)
+        if max_bytes is None:
+            max_bytes = int(float(os.environ.get("AIRWAY_CACHE_MAX_GB", DEFAULT_MAX_GB)) * 1024 ** 3)
+        self.max_bytes = max_bytes
+        self.objects = os.path.join(self.root, "objects")
+        os.makedirs(self.objects, exist_ok=True)
+        self._lock = threading.Lock()
+        # Bytes held by the cache, scanned on the first store and kept up to date after
+        self._size = None
+
+    def _entry_dir(self, key):
+        return os.path.join(self.objects, key[:2], key)
+
+    def _load_meta(self, key):
+        meta_path = os.path.join(self._entry_dir(key), "meta.json")
+        try:
+            with open(meta_path, "r") as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        # Mark as recently used
+        os.utime(meta_path)
+        return meta
+
+    def get_file(self, key, dest_path):
+        """Places the cached file for `key` at dest_path. Returns False on a miss."""
+        meta = self._load_meta(key)
+        if meta is None or "file" not in meta:
+            return False
+        cached_path = os.path.join(self._entry_dir(key), meta["file"])
+        if not os.path.isfile(cached_path):
+            return False
+        # Copy rather than link so later edits to an output never reach the cache
+        shutil.copyfile(cached_path, dest_path)
+        logging.info(f"Cache hit for {os.path.basename(dest_path)}")
+        return True
+
+    def get_value(self, key):
+        """Cached JSON value for `key`, or None on a miss."""
+        meta = self._load_meta(key)
+        if meta is None:
+            return None
+        return meta.get("value")
+
+    def put_file(self, key, src_path, **info):
+        """Stores a copy of src_path under `key`."""
+        self._put(key, {"file": os.path.basename(src_path), **info}, src_path)
+
+    def put_value(self, key, value, **info):
+        self._put(key, {"value": value, **info})
+
+    def _put(self, key, meta, src_path=None):
+        entry_dir = self._entry_dir(key)
+        if os.path.isdir(entry_dir):
+            return
+        # Build the entry next to its final place and move it in with one rename
+        tmp_dir = os.path.join(self.objects, f".tmp-{uuid.uuid4().hex}")
+        os.makedirs(tmp_dir)
+        try:
+            if src_path is not None:
+                shutil.copyfile(src_path, os.path.join(tmp_dir, meta["file"]))
+            meta["created"] = time.strftime("%Y-%m-%d %H:%M:%S")
+            with open(os.path.join(tmp_dir, "meta.json"), "w") as f:
+                json.dump(meta, f)
+            size = sum(entry.stat().st_size for entry in os.scandir(tmp_dir))
+            os.makedirs(os.path.dirname(entry_dir), exist_ok=True)
+            os.rename(tmp_dir, entry_dir)
+        except OSError as e:
+            # Another worker stored the same key first, or the disk is full: the cache is best effort
+            logging.warning(f"Could not store cache entry {key}: {e}")
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            return
+        with self._lock:
+            if self._size is None:
+                self._size = sum(size for _, size, _ in self._scan())
+            else:
+                self._size += size
+            full = self._size > self.max_bytes
+        if full:
+            self.evict()
+
+    def _scan(self):
+        """(last used, size, folder) of every entry."""
+        entries = []
+        for meta_path in glob.glob(os.path.join(self.objects, "??", "*", "meta.json")):
+            entry_dir = os.path.dirname(meta_path)
+            try:
+                size = sum(entry.stat().st_size for entry in os.scandir(entry_dir))
+                entries.append((os.stat(meta_path).st_mtime, size, entry_dir))
+            except OSError:
+                continue
+        return entries
+
+    def evict(self):
+        """
+        Removes least recently used entries until the cache fits in max_bytes. Rescans the
+        cache, which also picks up entries other processes stored since the last scan.
+        """
+        with self._lock:
+            entries = self._scan()
+            total = sum(size for _, size, _ in entries)
+            for _, size, entry_dir in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                shutil.rmtree(entry_dir, ignore_errors=True)
+                total -= size
+                logging.info(f"Evicted cache entry {os.path.basename(entry_dir)}")
+            self._size = total
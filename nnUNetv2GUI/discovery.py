@@ -0,0 +1,168 @@
+"""
+Fast DICOM discovery and a persistent folder -> series index.
+
+A file counts as DICOM when it carries the "DICM" magic after the 128-byte
+preamble, which is what pydicom.dcmread requires without force=True, so only
+132 bytes are read to decide. For DICOM files only the tags needed to group
+and order slices are parsed.
+
+DicomIndex builds one index per run that every stage shares. It is saved next
+to the results and keyed on each folder's modification time: on the next run a
+folder whose mtime is unchanged is taken from the saved index without opening
+any of its files. Adding, removing or renaming files changes a folder's mtime;
+editing a file in place does not, so replace rather than overwrite files in an
+indexed archive.
+"""
+import json
+import logging
+import os
+import threading
+
+from lazy_imports import lazy_import
+
+pydicom = lazy_import("pydicom")
+
+INDEX_NAME = "dicom_index.json"
+INDEX_VERSION = 1
+
+DICOM_MAGIC = b"DICM"
+PREAMBLE_LENGTH = 128
+
+# Tags read from each DICOM file to group and order its slices
+INDEX_TAGS = ["SeriesInstanceUID", "ImagePositionPatient", "ImageOrientationPatient", "InstanceNumber"]
+
+
+def is_dicom_file(path):
+    """True if the file has the DICOM magic after its 128-byte preamble."""
+    try:
+        with open(path, "rb") as f:
+            f.seek(PREAMBLE_LENGTH)
+            return f.read(len(DICOM_MAGIC)) == DICOM_MAGIC
+    except OSError:
+        return False
+
+
+def read_slice_info(path):
+    """Series UID and slice ordering information of one DICOM file, from its header only."""
+    dataset = pydicom.dcmread(path, stop_before_pixels=True, specific_tags=INDEX_TAGS)
+    position = None
+    ipp = dataset.get("ImagePositionPatient")
+    iop = dataset.get("ImageOrientationPatient")
+    if ipp is not None and iop is not None and len(ipp) == 3 and len(iop) == 6:
+        # Distance along the slice normal, the order GDCM sorts slices in
+        row, col = [float(v) for v in iop[:3]], [float(v) for v in iop[3:]]
+        normal = (row[1] * col[2] - row[2] * col[1],
+                  row[2] * col[0] - row[0] * col[2],
+                  row[0] * col[1] - row[1] * col[0])
+        position = sum(float(p) * n for p, n in zip(ipp, normal))
+    instance = dataset.get("InstanceNumber")
+    return {
+        "series": str(dataset.get("SeriesInstanceUID", "")),
+        "position": position,
+        "instance": int(instance) if instance not in (None, "") else None,
+    }
+
+
+class DicomIndex:
+    """
+    Index of which folders hold DICOM files and how those files form series.
+    Folders are scanned on first use and rescanned only when their mtime changes.
+    Thread-safe, so the pipeline's stage threads can share one instance.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self._lock = threading.Lock()
+        self.folders = {}
+        self._dirty = False
+        if path and os.path.exists(path):
+            try:
+                with open(path, "r") as f:
+                    data = json.load(f)
+                if data.get("version") == INDEX_VERSION:
+                    self.folders = data["folders"]
+            except (OSError, ValueError, KeyError) as e:
+                logging.warning(f"Ignoring unreadable DICOM index {path}: {e}")
+
+    def _entry(self, folder):
+        folder = os.path.abspath(folder)
+        mtime_ns = os.stat(folder).st_mtime_ns
+        with self._lock:
+            entry = self.folders.get(folder)
+            if entry is not None and entry["mtime_ns"] == mtime_ns:
+                return entry
+
+        entry = {"mtime_ns": mtime_ns, "subdirs": [], "files": {}}
+        with os.scandir(folder) as entries:
+            for item in entries:
+                if item.is_dir():
+                    entry["subdirs"].append(item.name)
+                elif item.is_file() and not item.name.startswith("._") and is_dicom_file(item.path):
+                    try:
+                        entry["files"][item.name] = read_slice_info(item.path)
+                    except Exception as e:
+                        logging.warning(f"Could not read DICOM header of {item.path}: {e}")
+        entry["subdirs"].sort()
+        with self._lock:
+            self.folders[folder] = entry
+            self._dirty = True
+        return entry
+
+    def contains_dicom(self, folder):
+        return bool(self._entry(folder)["files"])
+
+    def subfolders(self, folder):
+        return list(self._entry(folder)["subdirs"])
+
+    def dicom_files(self, folder):
+        """Names of the DICOM files directly in folder."""
+        return sorted(self._entry(folder)["files"])
+
+    def series(self, folder):
+        """
+        Series of a folder as {series UID: [file paths in slice order]}. Slices are
+        ordered by position along the slice normal, then instance number, then name.
+        """
+        groups = {}
+        for name, info in self._entry(folder)["files"].items():
+            groups.setdefault(info["series"], []).append((name, info))
+
+        def slice_order(item):
+            name, info = item
+            position = info["position"]
+            instance = info["instance"]
+            return (position is None, position or 0.0, instance is None, instance or 0, name)
+
+        folder = os.path.abspath(folder)
+        return {
+            uid: [os.path.join(folder, name) for name, _ in sorted(files, key=slice_order)]
+            for uid, files in groups.items()
+        }
+
+    def dicom_folders(self, root):
+        """
+        Relative paths of every folder under root holding DICOM files. Subdirectories
+        of such a folder are not searched.
+        """
+        folders = []
+        pending = [root]
+        while pending:
+            folder = pending.pop()
+            if self.contains_dicom(folder):
+                folders.append(os.path.relpath(folder, root))
+            else:
+                pending.extend(os.path.join(folder, d) for d in reversed(self.subfolders(folder)))
+        return folders
+
+    def save(self):
+        """Writes the index to its path if anything was (re)scanned."""
+        with self._lock:
+            if not self.path or not self._dirty:
+                return
+            # Drop folders that no longer exist so the file does not grow forever
+            self.folders = {folder: entry for folder, entry in self.folders.items() if os.path.isdir(folder)}
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump({"version": INDEX_VERSION, "folders": self.folders}, f)
+            os.replace(tmp_path, self.path)
+            self._dirty = False
@@ -0,0 +1,199 @@
+"""
+Per-stage, per-case resource measurements and the JSON run report.
+
+Every stage of a case is measured on the thread that runs it: wall time, CPU
+time and the bytes that thread read and wrote (Linux /proc/<pid>/task/<tid>/io,
+which counts file and pipe I/O including page cache hits; None elsewhere). Work a
+stage hands to a process pool or to the anonymization pool is measured where it
+runs (measure_call) and added to the stage that submitted it, so concurrent
+stages in other threads do not leak into each other's numbers.
+
+Prediction spreads over torch's own threads (or a nnUNetv2_predict child
+process), so it is measured with cpu_scope="process": the CPU time of the whole
+process and of finished child processes while it runs.
+
+Peak RSS is the high-water mark of the process (and of the pool worker) at the
+end of the stage: it only grows, so it shows which stage first needed the memory.
+
+The run report ("Run Report.json" next to the volume report) lists every
+measurement and, per stage, the count, total and p50/p90/p95/max of each metric.
+"""
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+RUN_REPORT_NAME = "Run Report.json"
+METRICS = ("wall_seconds", "cpu_seconds", "bytes_read", "bytes_written", "peak_rss_mb")
+PERCENTILES = (50, 90, 95)
+
+_current = threading.local()
+
+
+def peak_rss_mb(children=False):
+    """High-water resident memory of this process (or of its finished children) in MB, None if unknown."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, kilobytes elsewhere
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def children_cpu_seconds():
+    """CPU time of the finished child processes of this process."""
+    try:
+        import resource
+    except ImportError:
+        return 0.0
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def thread_io():
+    """(bytes read, bytes written) by the calling thread so far, or (None, None) without /proc."""
+    try:
+        with open(f"/proc/self/task/{threading.get_native_id()}/io", "r") as f:
+            counters = dict(line.split(":", 1) for line in f if ":" in line)
+        return int(counters["rchar"]), int(counters["wchar"])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+class Measurement:
+    """Resources used by the calling thread (or process, see cpu_scope) between start() and stop()."""
+
+    def __init__(self, cpu_scope="thread"):
+        self.cpu_scope = cpu_scope
+        self.metrics = {}
+        # Measured in pool workers on behalf of this measurement
+        self.extra = {"cpu_seconds": 0.0, "bytes_read": 0, "bytes_written": 0, "peak_rss_mb": None}
+
+    def _cpu(self):
+        if self.cpu_scope == "process":
+            return time.process_time() + children_cpu_seconds()
+        return time.thread_time()
+
+    def start(self):
+        self._wall = time.perf_counter()
+        self._cpu_start = self._cpu()
+        self._io = thread_io()
+        return self
+
+    def add(self, metrics):
+        """Adds the metrics of work done elsewhere (see measure_call) to this measurement."""
+        for key in ("cpu_seconds", "bytes_read", "bytes_written"):
+            if metrics.get(key) is not None:
+                self.extra[key] += metrics[key]
+        self.extra["peak_rss_mb"] = _max(self.extra["peak_rss_mb"], metrics.get("peak_rss_mb"))
+
+    def stop(self):
+        read, written = thread_io()
+        start_read, start_written = self._io
+        self.metrics = {
+            "wall_seconds": time.perf_counter() - self._wall,
+            "cpu_seconds": self._cpu() - self._cpu_start + self.extra["cpu_seconds"],
+            "bytes_read": read - start_read + self.extra["bytes_read"] if read is not None else None,
+            "bytes_written": written - start_written + self.extra["bytes_written"] if written is not None else None,
+            "peak_rss_mb": _max(peak_rss_mb(), peak_rss_mb(children=True) if self.cpu_scope == "process" else None,
+                                self.extra["peak_rss_mb"]),
+        }
+        return self.metrics
+
+
+def _max(*values):
+    values = [value for value in values if value is not None]
+    return max(values) if values else None
+
+
+def measure_call(fn, *args):
+    """Runs fn(*args) and returns (result, metrics of this thread). Picklable for process pools."""
+    measurement = Measurement().start()
+    result = fn(*args)
+    return result, measurement.stop()
+
+
+def add_worker_metrics(metrics):
+    """Adds metrics from measure_call to the stage measured on the calling thread, if any."""
+    measurement = getattr(_current, "measurement", None)
+    if measurement is not None and metrics:
+        measurement.add(metrics)
+
+
+def percentile(values, p):
+    """Linearly interpolated p-th percentile of a non-empty list."""
+    values = sorted(values)
+    position = (len(values) - 1) * p / 100
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+class StageRecorder:
+    """Collects one sample per stage and case. Thread-safe; stages may nest (e.g. volume inside postprocess)."""
+
+    def __init__(self):
+        self.samples = []
+        self._lock = threading.Lock()
+        self.started = time.strftime("%Y-%m-%d %H:%M:%S")
+
+    @contextmanager
+    def stage(self, stage_name, case_name=None, cpu_scope="thread"):
+        measurement = Measurement(cpu_scope).start()
+        outer = getattr(_current, "measurement", None)
+        _current.measurement = measurement
+        error = None
+        try:
+            yield measurement
+        except BaseException as e:
+            error = str(e)
+            raise
+        finally:
+            _current.measurement = outer
+            metrics = measurement.stop()
+            if outer is not None:
+                # The outer stage measured this thread too, only the pool work is missing
+                outer.add({key: value for key, value in measurement.extra.items()})
+            sample = {"stage": stage_name, "case": case_name, **metrics}
+            if error is not None:
+                sample["error"] = error
+            with self._lock:
+                self.samples.append(sample)
+
+    def summary(self):
+        """{stage: {"count": n, metric: {"total", "p50", "p90", "p95", "max"}}} over all samples."""
+        stages = {}
+        with self._lock:
+            samples = list(self.samples)
+        for sample in samples:
+            stages.setdefault(sample["stage"], []).append(sample)
+        summary = {}
+        for stage_name, stage_samples in stages.items():
+            entry = {"count": len(stage_samples)}
+            for metric in METRICS:
+                values = [sample[metric] for sample in stage_samples if sample.get(metric) is not None]
+                if not values:
+                    continue
+                stats = {f"p{p}": percentile(values, p) for p in PERCENTILES}
+                stats["max"] = max(values)
+                if metric != "peak_rss_mb":
+                    stats["total"] = sum(values)
+                entry[metric] = stats
+            summary[stage_name] = entry
+        return summary
+
+    def write_report(self, output_folder, **details):
+        """Writes the samples and per-stage summary to "Run Report.json" in output_folder. Returns its path."""
+        report_path = os.path.join(output_folder, RUN_REPORT_NAME)
+        report = {"started": self.started, "finished": time.strftime("%Y-%m-%d %H:%M:%S"), **details,
+                  "stages": self.summary(), "samples": self.samples}
+        tmp_path = f"{report_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(report, f, indent=2, default=str)
+        os.replace(tmp_path, report_path)
+        logging.info(f"Run report saved to {report_path}")
+        return report_path
@@ -0,0 +1,64 @@
+"""
+Deferred imports of the heavy libraries (numpy, vtk, SimpleITK, nibabel, pydicom).
+
+Importing them all takes seconds, which the GUI used to spend on a blank screen
+before its window appeared. The pipeline modules bind them with lazy_import
+instead, so each library is imported the first time a stage uses it:
+
+    vtk = lazy_import("vtk")
+    numpy_support = lazy_import("vtk.util.numpy_support")
+
+The GUI warms them in a background thread once its window is shown (warm_up),
+so the first run rarely waits for an import either.
+"""
+import importlib
+import logging
+import sys
+import threading
+import time
+import types
+
+HEAVY_LIBRARIES = ("numpy", "pydicom", "nibabel", "SimpleITK", "vtk", "vtk.util.numpy_support")
+
+
+class LazyModule(types.ModuleType):
+    """Stands in for a module until an attribute is first read, then imports it and takes over its namespace."""
+
+    def __getattr__(self, attr):
+        # Only called for names not in __dict__, i.e. until the module is loaded
+        module = importlib.import_module(self.__name__)
+        self.__dict__.update(module.__dict__)
+        return getattr(module, attr)
+
+    def __dir__(self):
+        return dir(importlib.import_module(self.__name__))
+
+
+def lazy_import(name):
+    """The module `name` if it was imported already, otherwise a LazyModule that imports it on first use."""
+    module = sys.modules.get(name)
+    return module if module is not None else LazyModule(name)
+
+
+def preload(names=HEAVY_LIBRARIES):
+    """Imports `names` now. Returns {name: seconds} for the ones that imported, failures are logged."""
+    seconds = {}
+    for name in names:
+        start = time.perf_counter()
+        try:
+            importlib.import_module(name)
+        except Exception as e:
+            logging.warning(f"Could not import {name}: {e}")
+            continue
+        seconds[name] = time.perf_counter() - start
+    return seconds
+
+
+def warm_up(names=HEAVY_LIBRARIES):
+    """Starts importing `names` in a daemon thread and returns it."""
+    def run():
+        seconds = preload(names)
+        logging.info(f"Libraries loaded in the background in {sum(seconds.values()):.1f} s")
+    thread = threading.Thread(target=run, name="import-warm-up", daemon=True)
+    thread.start()
+    return thread
@@ -1,25 +1,29 @@
 import customtkinter as ctk
 from tkinter import messagebox, filedialog
 import os
-import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import logging
-import subprocess
-import nibabel as nib
-import SimpleITK as sitk
-import pydicom
-import numpy as np
-from STLConvGUI import STLConverterGUI
 from tkinter.ttk import Progressbar
-import vtk
-import random  # Import the random module for shuffling
-from natsort import natsorted 
+from lazy_imports import warm_up
+from meshing import MESH_FORMATS
+from pipeline import PipelineOptions, PipelineError, run_pipeline
+from progress import EventChannel
 
 # Set up logging for detailed feedback
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+# Milliseconds between two looks at the pipeline's event channel
+POLL_INTERVAL_MS = 100
+# Notifications of one kind shown in full when several arrive together
+NOTIFICATIONS_SHOWN = 5
+
+# Set to 0 to import the heavy libraries only when a stage first needs them
+WARM_UP_ENV = "AIRWAY_WARM_IMPORTS"
+
 class UnifiedAirwaySegmentationGUI(ctk.CTk):
-    def __init__(self):
+    def __init__(self, warm_imports=None):
         super().__init__()
         self.title("UpperAirway Segmentator Tool")
         self.geometry("950x750")
@@ -34,9 +38,13 @@ class UnifiedAirwaySegmentationGUI(ctk.CTk):
         self.run_prediction = ctk.BooleanVar()
         self.calculate_volume = ctk.BooleanVar()
         self.export_stl = ctk.BooleanVar()
+        self.mesh_format = ctk.StringVar(value="stl")
+        self.compress_meshes = ctk.BooleanVar()
         self.data_nickname = ctk.StringVar(value='UA')  # Nickname for renaming
         self.starting_number = ctk.IntVar(value=1)  # Starting number for renaming
-        self.renamed_folders = {}  # Initialize the dictionary to store renamed folders
+
+        # Pipeline runs happen here, never on the Tk thread; one run at a time
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="pipeline")
 
         # Path setup for nnUNet data
         self.parent_dir = Path(os.getcwd()).parent
@@ -61,6 +69,12 @@ class UnifiedAirwaySegmentationGUI(ctk.CTk):
         min_height = 750
         self.minsize(min_width, min_height)
 
+        # numpy, vtk, SimpleITK etc. load in the background once the window is up
+        if warm_imports is None:
+            warm_imports = os.environ.get(WARM_UP_ENV, "1") != "0"
+        if warm_imports:
+            self.after(500, warm_up)
+
     def toggle_rename_fields(self):
         """Enable or disable nickname and starting number fields based on Rename Files checkbox."""
         if self.rename_files.get():
@@ -91,739 +105,113 @@ class UnifiedAirwaySegmentationGUI(ctk.CTk):
         if folder:
             self.input_path.set(folder)
 
-    def start_processing(self):
-        input_folder = self.input_path.get()
-        if not os.path.isdir(input_folder):
-            messagebox.showerror("Error", "Invalid input folder.")
-            return
-
-        # Check if the parent directory already has "_Processed" in its name
-        parent_dir = Path(input_folder).parent
-        if "_Processed" in parent_dir.name:
-            output_folder = str(parent_dir)  # Use the existing parent directory
-        else:
-            # Create a new output folder with a "_Processed" suffix
-            output_folder = os.path.join(parent_dir, f"{Path(input_folder).stem}_Processed")
-            os.makedirs(output_folder, exist_ok=True)
-
-        # Step 1: Anonymize and Rename if selected
-        if self.rename_files.get():
-            renamed_folder = os.path.join(output_folder, "Renamed_Anonymized")
-            os.makedirs(renamed_folder, exist_ok=True)
-            if self.file_type.get() == "NIfTI":
-                self.rename_nifti_structure(input_folder, renamed_folder)
-            else:
-                self.anonymize_and_rename_dicom_structure(input_folder, renamed_folder)
-                input_folder = renamed_folder  # Update input folder to renamed folder
-
-
-        # Step 2: Convert to NIfTI if selected
-        if self.convert_to_nifti.get():
-            nifti_folder = os.path.join(output_folder, "NIfTI_Converted")
-            os.makedirs(nifti_folder, exist_ok=True)
-            self.convert_dicom_to_nifti(input_folder, nifti_folder)
-            input_folder = nifti_folder  # Update input folder to NIfTI folder for further processing
-
-        # Step 3: Run nnUNet prediction if selected
-        if self.run_prediction.get():
-             # Set prediction output folder
-            prediction_folder = os.path.join(output_folder, "Segmentations")
-            os.makedirs(prediction_folder, exist_ok=True)
-            # Determine nnUNet_IN based on file type and conversion setting
-            if self.file_type.get() == "NIfTI":
-                # If already in NIfTI, use the input folder directly
-                nnUNet_IN = input_folder
-            elif self.file_type.get() == "DICOM":
-                # Enforce conversion to NIfTI for prediction if the files are in DICOM format
-                if not self.convert_to_nifti.get():
-                    print('Automatically converting files from DICOM to NIfTI')
-                # Convert DICOM to NIfTI
-                nifti_folder = os.path.join(output_folder, "NIfTI_Converted")
-                os.makedirs(nifti_folder, exist_ok=True)
-                self.convert_dicom_to_nifti(input_folder, nifti_folder)
-                nnUNet_IN = nifti_folder  # Use the converted NIfTI folder as input
-            else:
-                messagebox.showerror("Error", "Files must be either in NIfTI format or converted to NIfTI from DICOM.")
-                return
-
-            self.run_nnunet_prediction(output_folder, nnUNet_IN, prediction_folder)
-
-        # Added the else to do if not doing prediction
-        else:
-            # Step 4: If only volume calculation is selected, run it directly on the input folder
-            if self.calculate_volume.get():
-                self.calculate_airway_volumes(input_folder, output_folder)
-
-            # Step 5: Create STL from prediction
-            if self.export_stl.get():
-                stl_folder = os.path.join(output_folder, "STL_Exports")
-                os.makedirs(stl_folder, exist_ok=True)
-                self.export_predictions_to_stl(input_folder, stl_folder)
-
-    def contains_dicom_files(self, folder):
-        for item in os.listdir(folder):
-            item_path = os.path.join(folder, item)
-            # Check if the item is a file
-            if os.path.isfile(item_path):
-                try:
-                    # Attempt to read the file as DICOM
-                    pydicom.dcmread(item_path, stop_before_pixels=True)
-                    return True  # If no exception, it's a valid DICOM
-                except (pydicom.errors.InvalidDicomError, IsADirectoryError):
-                    # Invalid DICOM or directory, continue checking other files
-                    continue
-        return False
-        
-    def generate_randomized_mapping(self, items, starting_index):
-        """
-        Generate a consistent mapping from item names to randomized indices.
-
-        Parameters:
-            items (list): List of items (folders or file names).
-            starting_index (int): Starting index for renaming.
-
-        Returns:
-            dict: Mapping of original item names to randomized indices.
-        """
-        indices = list(range(starting_index, starting_index + len(items)))
-        random.shuffle(indices)
-        return dict(zip(items, indices))
-
-    def anonymize_and_rename_dicom_structure(self, source_dir, destination_dir):
-        """
-        Renames and anonymizes DICOM files while skipping any directories located in folders containing DICOM files.
-        """
-        # Gather all `P#T#` folders (patient and timepoint combination)
-        folders = []
-        for root, subdirs, files in os.walk(source_dir):
-            # Check if the current folder contains DICOM files
-            if self.contains_dicom_files(root):
-                # If DICOM files are found, ignore subdirectories and only process the files in this folder
-                subdirs.clear()  # Skip all subdirectories in the current folder
-                relative_path = os.path.relpath(root, source_dir)
-                folders.append((root, relative_path))
-        
-        # Debug: Check if folders were found
-        if not folders:
-            logging.warning("No DICOM folders found in the source directory.")
-            messagebox.showwarning("No Folders", "No DICOM folders containing files were found in the selected input directory.")
-            return
-
-        # Shuffle the list of folders to randomize the order
-        random.shuffle(folders)
-
-        # Create unique randomized indices for all folders
-        total_folders = len(folders)
-        indices = list(range(self.starting_number.get(), self.starting_number.get() + total_folders))
-
-        # Map each shuffled folder to a unique randomized name
-        folder_mapping = {relative_path: f"{self.data_nickname.get()}_{index}" for (_, relative_path), index in zip(folders, indices)}
-
-        # Ensure the destination directory exists
-        os.makedirs(destination_dir, exist_ok=True)
-
-        # Path for the renaming log file
-        rename_log_path = os.path.join(destination_dir, "rename_log.txt")
-
-        # Open the log file for recording the renaming process
-        with open(rename_log_path, 'w') as log_file:
-            log_file.write("Original Folder\tNew Folder\n")  # Log header
-
-            # Process each folder
-            for relative_path, new_folder_name in folder_mapping.items():
-                # Reconstruct the full original folder path
-                original_folder_path = os.path.join(source_dir, relative_path)
-
-                # Create the new folder in the destination directory
-                new_folder_path = os.path.join(destination_dir, new_folder_name)
-                os.makedirs(new_folder_path, exist_ok=True)
-
-                logging.info(f"Renaming folder {relative_path} to {new_folder_name}")
-
-                # Log the folder renaming
-                log_file.write(f"{relative_path}\t{new_folder_name}\n")
-                log_file.flush()  # Ensure the entry is written immediately
-
-                # Get a filtered list of valid files
-                valid_files = [
-                    file_name for file_name in os.listdir(original_folder_path)
-                    if os.path.isfile(os.path.join(original_folder_path, file_name)) and
-                    not file_name.startswith("._")  # Exclude hidden/system files
-                ]
-
-                # Process each valid file
-                for file_index, file_name in enumerate(valid_files, start=1):
-                    input_file_path = os.path.join(original_folder_path, file_name)
-
-                    # Anonymized file name
-                    anonymized_file_name = f"{new_folder_name}_{file_index}.dcm"
-                    output_file_path = os.path.join(new_folder_path, anonymized_file_name)
-
-                    # Anonymize and copy the file
-                    try:
-                        self.anonymize_dicom(input_file_path, output_file_path, patient_name=new_folder_name)
-                        # logging.info(f"Renamed {file_name} to {anonymized_file_name}")  # Logging the renaming of every file
-
-                    except Exception as e:
-                        logging.error(f"Error renaming file {file_name} in folder {relative_path}: {e}")
-                        messagebox.showerror("Renaming Error", f"Failed to rename {file_name} in folder {relative_path}. Error: {e}")
-
-        # After logging all names, rearrange alphabetically:
-        rename_log_path = os.path.join(destination_dir, "rename_log.txt")
-        self.rearrange_rename_log(rename_log_path)
-
-    def rearrange_rename_log(self, rename_log_path):
-        """
-        Rearranges the entries in rename_log.txt to sort original folder names alphabetically.
-        """
-        try:
-            with open(rename_log_path, 'r') as log_file:
-                lines = log_file.readlines()
-
-            # Preserve the header line
-            header = lines[0]
-            entries = lines[1:]  # Skip the header
-
-            # Sort entries alphabetically by the original folder name (first column)
-            sorted_entries = sorted(entries, key=lambda line: line.split("\t")[0])
-
-            # Rewrite the log file with sorted entries
-            with open(rename_log_path, 'w') as log_file:
-                log_file.write(header)  # Write the header back
-                log_file.writelines(sorted_entries)
-
-            # logging.info("Successfully rearranged rename_log.txt to alphabetical order.")
-        except Exception as e:
-            logging.error(f"Error rearranging rename_log.txt: {e}")
-            messagebox.showerror("Error", f"Failed to rearrange rename_log.txt. Error: {e}")
-
-
-    def process_dicom_files(self, input_folder, output_folder, patient_name):
-        """
-        Anonymize and rename DICOM files in a specified folder.
-        """
-        file_index = 1  # Start numbering from 1 or any other desired start point
-        for file_name in os.listdir(input_folder):
-            input_file_path = os.path.join(input_folder, file_name)
-
-            # Skip if it's a directory or unwanted files
-            if os.path.isdir(input_file_path) or file_name.startswith("._") or file_name == ".DS_Store":
+    def gui_notify(self, notifications):
+        """Shows pipeline messages as dialogs, one per kind for messages that arrived together."""
+        by_kind = {}
+        for kind, title, message in notifications:
+            by_kind.setdefault(kind, []).append((title, message))
+        for kind, messages in by_kind.items():
+            show = {"info": messagebox.showinfo, "warning": messagebox.showwarning}.get(kind, messagebox.showerror)
+            if len(messages) == 1:
+                show(*messages[0])
                 continue
+            shown = "\n\n".join(message for _, message in messages[:NOTIFICATIONS_SHOWN])
+            if len(messages) > NOTIFICATIONS_SHOWN:
+                shown += f"\n\n... and {len(messages) - NOTIFICATIONS_SHOWN} more, see the log."
+            show(f"{messages[0][0]} ({len(messages)} messages)", shown)
+
+    def build_options(self):
+        """Collects the current switches and entries into pipeline options."""
+        return PipelineOptions(
+            input_folder=self.input_path.get(),
+            file_type=self.file_type.get(),
+            rename_files=self.rename_files.get(),
+            convert_to_nifti=self.convert_to_nifti.get(),
+            run_prediction=self.run_prediction.get(),
+            calculate_volume=self.calculate_volume.get(),
+            export_stl=self.export_stl.get(),
+            mesh_format=self.mesh_format.get(),
+            compress_meshes=self.compress_meshes.get(),
+            data_nickname=self.data_nickname.get(),
+            starting_number=self.starting_number.get(),
+            nnunet_paths=(self.Path1, self.Path2, self.Path3),
+        )
 
-            # Process only DICOM files
-            if self.contains_dicom_files(input_folder):  # Check if file is a DICOM
-                anonymized_file_name = f"{patient_name}_{file_index}.dcm"
-                output_file_path = os.path.join(output_folder, anonymized_file_name)
-                
-                # Anonymize and rename each DICOM file
-                self.anonymize_dicom(input_file_path, output_file_path, patient_name)
-                file_index += 1  # Increment only for valid files
-
-    def anonymize_dicom(self, input_file, output_file, patient_name):
-        """
-        Anonymize DICOM file fields based on provided patient name.
-        """
-        dataset = pydicom.dcmread(input_file, force=True)
-        tags_to_anonymize = [
-            ("PatientName", patient_name),
-            ("PatientID", "ANON"),
-            ("PatientBirthDate", "N/A"),
-            ("PatientSex", "N/A"),
-        ]
-        for tag, value in tags_to_anonymize:
-            if tag in dataset:
-                dataset.data_element(tag).value = value
-        dataset.save_as(output_file)
-
-    def rename_nifti_structure(self, source_dir, destination_dir):
-        """
-        Renames NIfTI files based on a randomized mapping, ensuring unique names for all files.
-        """
-        # Gather all NIfTI files
-        nifti_files = []
-        for root, _, files in os.walk(source_dir):
-            for file_name in files:
-                if file_name.endswith('.nii.gz'):
-                    nifti_files.append((root, file_name))
-
-        # Debug: Check if files were found
-        if not nifti_files:
-            logging.warning("No NIfTI files found in the source directory.")
-            messagebox.showwarning("No Files", "No NIfTI files found in the selected input directory.")
+    def start_processing(self):
+        options = self.build_options()
+        if not os.path.isdir(options.input_folder):
+            messagebox.showerror("Error", "Invalid input folder.")
             return
 
-        # Create a unique randomized index for all files
-        total_files = len(nifti_files)
-        indices = list(range(self.starting_number.get(), self.starting_number.get() + total_files))
-        random.shuffle(indices)
-
-        # Map each file to a unique index
-        file_to_index = {file: idx for file, idx in zip(nifti_files, indices)}
-
-        # Ensure the destination directory exists
-        os.makedirs(destination_dir, exist_ok=True)
-
-        # Path for the renaming log file
-        rename_log_path = os.path.join(destination_dir, "rename_log.txt")
-
-        # Open the log file for recording the renaming process
-        with open(rename_log_path, 'w') as log_file:
-            log_file.write("Original File\tNew File\n")  # Log header
-
-            # Process each NIfTI file
-            for (root, file_name), unique_index in file_to_index.items():
-                new_file_name = f"{self.data_nickname.get()}_{unique_index}.nii.gz"
+        self.run_with_loading_dialog(options)
 
-                # Full paths for the input and renamed files
-                input_file_path = os.path.join(root, file_name)
-                new_file_path = os.path.join(destination_dir, new_file_name)
-
-                # Debug: Log file paths
-                logging.info(f"Renaming {input_file_path} to {new_file_path}")
-
-                try:
-                    # Rename (copy) the file
-                    with open(input_file_path, 'rb') as f_src:
-                        with open(new_file_path, 'wb') as f_dst:
-                            f_dst.write(f_src.read())
-
-                    # Log the renaming in the text file
-                    log_file.write(f"{file_name}\t{new_file_name}\n")
-                    logging.info(f"Successfully renamed {file_name} to {new_file_name}")
-
-                except Exception as e:
-                    logging.error(f"Error renaming file {file_name}: {e}")
-                    messagebox.showerror("Renaming Error", f"Failed to rename {file_name}. Error: {e}")
-
-
-    def convert_dicom_to_nifti(self, input_folder, output_folder):
+    def run_pipeline(self, options, channel):
+        """Runs on the executor thread: everything for the UI goes through `channel`."""
+        error = None
         try:
-            nifti_folder = output_folder
-            os.makedirs(nifti_folder, exist_ok=True)
-
-            def process_dicom_series(dicom_folder, patient_name, time_point=None):
-                reader = sitk.ImageSeriesReader()
-                series_ids = reader.GetGDCMSeriesIDs(dicom_folder)
-                if not series_ids:
-                    logging.warning(f"No DICOM series found in {dicom_folder}. Skipping.")
-                    return
-
-                for series_id in series_ids:
-                    dicom_names = reader.GetGDCMSeriesFileNames(dicom_folder, series_id)
-                    reader.SetFileNames(dicom_names)
-                    
-                    # Ensure no interpolation or resampling
-                    reader.MetaDataDictionaryArrayUpdateOn()
-                    image = reader.Execute()
-                    
-                    # Extract and log original voxel spacing
-                    spacing = image.GetSpacing()
-                    # logging.info(f"Original voxel spacing (x, y, z): {spacing}") # Logging voxel spacing in all 3 directions
-                    
-                    # Correct potential flipping in direction
-                    direction = image.GetDirection()
-                    if direction[8] < 0:
-                        image = sitk.Flip(image, [False, False, True])
-                        spacing = image.GetSpacing()  # Re-check after flipping
-                        logging.info(f"Flipped image. New voxel spacing (x, y, z): {spacing}")
-                    
-                    # Verify and log slice positions
-                    slice_positions = [
-                        float(image.TransformIndexToPhysicalPoint([0, 0, z])[2])
-                        for z in range(image.GetSize()[2])
-                    ]
-                    slice_differences = [
-                        round(slice_positions[i+1] - slice_positions[i], 5)
-                        for i in range(len(slice_positions) - 1)
-                    ]
-                    #logging.info(f"Slice position differences in z-direction: {slice_differences}") # Logging the voxel spacing in the z direction
-                    
-                    # Save as NIfTI
-                    nifti_filename = self.get_nifti_filename(patient_name, time_point, rename_enabled=self.rename_files.get())
-                    nifti_path = os.path.join(nifti_folder, nifti_filename)
-                    sitk.WriteImage(image, nifti_path)
-                    # logging.info(f"NIfTI file saved at: {nifti_path}") # Logging NIfTI saved location
-
-            # Main conversion loop
-            patient_folders = [
-                d for d in os.listdir(input_folder)
-                if os.path.isdir(os.path.join(input_folder, d))
-            ]
-            for patient_folder in patient_folders:
-                patient_path = os.path.join(input_folder, patient_folder)
-
-                # Determine patient name based on renaming
-                if self.rename_files.get():
-                    patient_name = self.renamed_folders.get(patient_folder, patient_folder)
-                else:
-                    patient_name = patient_folder
-
-                if self.contains_dicom_files(patient_path):
-                    # Process DICOM files in this folder and ignore subfolders
-                    process_dicom_series(patient_path, patient_name)
-                else:
-                    # Process subfolders
-                    subfolders = [
-                        d for d in os.listdir(patient_path)
-                        if os.path.isdir(os.path.join(patient_path, d))
-                    ]
-                    for time_point in subfolders:
-                        time_point_path = os.path.join(patient_path, time_point)
-                        if self.contains_dicom_files(time_point_path):
-                            # Determine time point name based on renaming
-                            if self.rename_files.get():
-                                time_point_name = f"{patient_name}_{time_point}"
-                            else:
-                                time_point_name = f"{patient_name}_{time_point}"
-                            process_dicom_series(time_point_path, patient_name, time_point=time_point)
-                        else:
-                            logging.warning(f"No DICOM files found in {time_point_path}. Skipping.")
+            run_pipeline(options, notify=channel.notify, progress=channel.progress)
+        except PipelineError as e:
+            logging.error(str(e))
+            error = str(e)
         except Exception as e:
-            logging.error(f"Error converting DICOM to NIfTI: {e}")
-            messagebox.showerror("Conversion Error", f"Failed to convert DICOM to NIfTI. Error: {e}")
-
-
-    def get_nifti_filename(self, patient_name, time_point=None, rename_enabled=False):
-        """
-        Constructs the NIfTI filename based on the provided patient name and time point.
-        Avoids duplicating time_point if already included in patient_name.
-        """
-        if rename_enabled:
-            # If renaming, avoid appending if time_point is already part of patient_name
-            if time_point and time_point not in patient_name:
-                return f"{patient_name}_{time_point}.nii.gz"
-            return f"{patient_name}.nii.gz"
-        else:
-            # Standard naming without renaming
-            if time_point:
-                return f"{patient_name}_{time_point}.nii.gz"
-            return f"{patient_name}.nii.gz"
-
-    def rename_files_in_folder(self, folder):
-        """Renames files and logs original to new names in a text file."""
-        rename_log_path = os.path.join(folder, "rename_log.txt")
-        with open(rename_log_path, 'w') as log_file:
-            log_file.write("Original Name\tNew Name\n")  # Header for clarity
-            for i, file in enumerate(os.listdir(folder), start=self.starting_number.get()):
-                base, ext = os.path.splitext(file)
-                new_name = f"{self.data_nickname.get()}_{i}{ext}"
-                original_path = os.path.join(folder, file)
-                new_path = os.path.join(folder, new_name)
-                
-                # Rename file
-                os.rename(original_path, new_path)
-                
-                # Log the rename operation
-                log_file.write(f"{file}\t{new_name}\n")
-                logging.info(f"Renamed {file} to {new_name}")
+            logging.exception("Processing failed")
+            error = f"Processing failed: {e}"
+        finally:
+            channel.finish(error)
 
     # ------------ NNUNET SECTION --------------------------------------
-    def run_nnunet_prediction(self, output_folder, nnUNet_IN, nnUNet_OUT):
+    def run_with_loading_dialog(self, options):
         # Set up the loading dialog with a progress bar
         loading = ctk.CTkToplevel(self)
         loading.title('Processing')
         label_font = ("Arial", 20)
-        ctk.CTkLabel(loading, text='Prediction is running, please wait...', font=label_font).pack(pady=10, padx=10)
-        
-        progress = Progressbar(loading, orient='horizontal', length=300, mode='indeterminate')
+        text = 'Prediction is running, please wait...' if options.run_prediction else 'Processing, please wait...'
+        ctk.CTkLabel(loading, text=text, font=label_font).pack(pady=10, padx=10)
+
+        # Indeterminate until the first case reports its progress
+        progress = Progressbar(loading, orient='horizontal', length=300, mode='indeterminate', maximum=1000)
         progress.pack(pady=10)
         progress.start()
+        status = ctk.CTkLabel(loading, text='Preparing cases...')
+        status.pack(pady=(0, 10), padx=10)
 
+        # A run cannot be stopped halfway through a stage, so the dialog stays until it ends
+        loading.protocol("WM_DELETE_WINDOW", lambda: None)
         loading.grab_set()
-
-        def script_execution():
-            if not nnUNet_IN or not nnUNet_OUT:
-                messagebox.showerror("Error", "Path to CBCT files in NIfTI format and/or Predictions folder not selected/valid")
-                loading.destroy()
-                return
-
-            # Set environment variables, if not already set
-            os.environ.setdefault('nnUNet_raw', str(self.Path1))
-            os.environ.setdefault('nnUNet_results', str(self.Path2))
-            os.environ.setdefault('nnUNet_preprocessed', str(self.Path3))
-
-            self.suffix_files(nnUNet_IN)
-
+        self.start_button.configure(state="disabled")
+        channel = EventChannel()
+
+        def poll_events():
+            # Runs on the Tk thread: only here are widgets touched and dialogs shown
+            batch = channel.drain()
+            if not batch.finished and future.done() and future.exception() is not None:
+                # run_pipeline always finishes the channel, this only guards against it dying first
+                batch.finished, batch.error = True, f"Processing failed: {future.exception()}"
             try:
-                result = subprocess.run([
-                    'nnUNetv2_predict', '-i', nnUNet_IN, '-o', nnUNet_OUT,
-                    '-d', '14', '-c', '3d_fullres', '-f', 'all',
-                ], capture_output=True, text=True)
-
-                logging.info('stdout: %s', result.stdout)
-                logging.error('stderr: %s', result.stderr)
-
-                result.check_returncode()
-
-                
-            except subprocess.CalledProcessError as e:
-                logging.error("Error: %s", e.stderr)
-                messagebox.showerror("Error", f"Failed to run nnUNet prediction: {e.stderr}")
-            except Exception as e:
-                logging.error("Unexpected error: %s", str(e))
-                messagebox.showerror("Error", f"An unexpected error occurred: {str(e)}")
+                if batch.progress is not None and loading.winfo_exists():
+                    if str(progress['mode']) == 'indeterminate':
+                        progress.stop()
+                        progress.configure(mode='determinate')
+                    progress['value'] = batch.progress.fraction * 1000
+                    status.configure(text=batch.progress.describe())
+                if batch.finished and loading.winfo_exists():
+                    progress.stop()
+                    loading.grab_release()
+                    loading.destroy()
+                if batch.notifications:
+                    self.gui_notify(batch.notifications)
+                if batch.finished and batch.error:
+                    messagebox.showerror("Error", batch.error)
             finally:
-                # Rename file to include _seg
-                self.rename_output_files(nnUNet_OUT)
-                self.remove_nnunet_internal(nnUNet_OUT)
-                # Calculate volume also, after prediction
-                self.calculate_airway_volumes(nnUNet_OUT, output_folder)
-                if self.export_stl.get():
-                    stl_folder = os.path.join(output_folder, "STL_Exports")
-                    os.makedirs(stl_folder, exist_ok=True)
-                    self.export_predictions_to_stl(nnUNet_OUT, stl_folder)
-                progress.stop()
-                loading.destroy()
-
-        threading.Thread(target=script_execution).start()
-    
-    def suffix_files(self, nnUNet_IN):
-        nifti_files = [f for f in os.scandir(nnUNet_IN) if f.name.endswith(('.nii', '.nii.gz'))]
-        for nifti_file in nifti_files:
-            base_name, ext = os.path.splitext(nifti_file.name)
-            if ext == ".gz":
-                base_name, ext2 = os.path.splitext(base_name)
-                ext = ext2 + ext
-            if not base_name.endswith('_0000'):
-                new_name = f"{base_name}_0000{ext}"
-                new_path = Path(nnUNet_IN) / new_name
-                if not new_path.exists():
-                    logging.info(f"Renaming NIfTI file {nifti_file.name} to {new_name}")
-                    os.rename(nifti_file.path, new_path)
-    
-    def rename_output_files(self, output_path):
-        for file in os.listdir(output_path):
-            if file.endswith('.nii.gz') and not file.endswith('_seg.nii.gz'):
-                old_path = os.path.join(output_path, file)
-                new_name = f"{os.path.splitext(os.path.splitext(file)[0])[0]}_seg.nii.gz"
-                new_path = os.path.join(output_path, new_name)
-                
-                if not os.path.exists(new_path):
-                    os.rename(old_path, new_path)
-                    logging.info(f"Renamed {file} to {new_name}")
+                # Whatever happened above, keep polling until the run ends, then allow the next one
+                if batch.finished:
+                    self.start_button.configure(state="normal")
                 else:
-                    logging.info(f"Skipped renaming {file} as {new_name} already exists")
-    
-    def remove_nnunet_internal(self, nnUNet_OUT):
-        # Loop through all files in the specified nnUNet_OUT
-        for filename in os.listdir(nnUNet_OUT):
-            # Check if the file ends with .json
-            if filename.endswith('.json'):
-                # Construct the full file path
-                file_path = os.path.join(nnUNet_OUT, filename)
-                # Remove the file
-                os.remove(file_path)
-                print(f"Removed: {file_path}")
-    
-    # Need to check if it works when starting from prediction all the way to volume calc and with multiple files tk
-    def calculate_airway_volumes(self, input_path, output_path, file_format="txt"):
-        if not os.path.exists(input_path):
-            messagebox.showwarning("Path Error", "Input path for volume calculation does not exist.")
-            return
-
-        volume_results = []
-        for file in Path(input_path).glob("*.nii.gz"):
-            volume = self.calculate_volume_from_file(file)
-            volume_results.append((file.name, volume))
-
-        try:
-            file_path = Path(output_path) / "Volume Calculations.txt"
-            with open(file_path, "w") as f:
-                f.write("Filename\tVolume (mm^3)\n")
-                for filename, volume in volume_results:
-                    f.write(f"{filename}\t{volume:.2f}\n")
-                    f.flush()  # Ensure the entry is written immediately
-                    print(file_path)
-
-        except Exception as e:
-            logging.error("Error in volume calculation: %s", e)
-            messagebox.showerror("Error", f"Failed to save volume calculation results: {e}")
-        print(file_path)
-        self.rearrange_volume_calculations(file_path)
-
-    def calculate_volume_from_file(self, file_path, airway_label=1):
-        """
-        Calculate the volume of the airway from a NIfTI file.
-
-        Parameters:
-        - file_path (Path): Path to the .nii.gz file
-        - airway_label (int): Label used for the airway segmentation in the mask (default is 1)
-
-        Returns:
-        - total_volume (float): Volume in ml^3
-        """
-        try:
-            # Load the NIfTI file
-            nifti_img = nib.load(file_path)
-            data = nifti_img.get_fdata()
-
-            # Log the affine matrix and zooms for debugging
-            affine = nifti_img.affine
-            voxel_sizes = nifti_img.header.get_zooms()  # Voxel dimensions in mm
-            # --- Login file path and info
-            #logging.info(f"File: {file_path}")
-            #logging.info(f"Affine matrix: \n{affine}")
-            #logging.info(f"Voxel dimensions (in mm): {voxel_sizes}")
+                    self.after(POLL_INTERVAL_MS, poll_events)
 
-            # Calculate the volume of a single voxel
-            voxel_volume = np.prod(voxel_sizes)  # Voxel volume in mm³
-            logging.info(f"Voxel volume: {voxel_volume:.2f} mm³")
+        future = self.executor.submit(self.run_pipeline, options, channel)
+        self.after(POLL_INTERVAL_MS, poll_events)
 
-            # Count the number of voxels in the airway region
-            airway_voxel_count = np.sum(data == airway_label)
-            logging.info(f"Total airway voxel count for label {airway_label}: {airway_voxel_count}")
-
-            # Calculate total volume in mm³
-            total_volume_mm3 = airway_voxel_count * voxel_volume
-            logging.info(f"Calculated airway volume: {total_volume_mm3:.2f} mm³")
-
-            return total_volume_mm3
-
-        except Exception as e:
-            logging.error(f"Failed to calculate volume for {file_path}: {e}")
-            return 0  # Return 0 if there was an error
-    
-    def rearrange_volume_calculations(self, file_path):
-        """
-        Rearranges the entries in the volume calculation file to sort filenames in natural order.
-        """
-        try:
-            # Read the contents of the file
-            with open(file_path, 'r') as f:
-                lines = f.readlines()
-
-            # Separate the header from the data
-            header = lines[0]
-            entries = lines[1:]
-
-            # Sort the entries in natural order based on the filename
-            sorted_entries = natsorted(entries, key=lambda line: line.split("\t")[0])
-
-            # Write the rearranged content back to the file
-            with open(file_path, 'w') as f:
-                f.write(header)  # Write the header first
-                f.writelines(sorted_entries)  # Write the sorted entries
-
-            logging.info(f"Rearranged volume calculations in natural order: {file_path}")
-
-        except Exception as e:
-            logging.error(f"Error rearranging volume calculations: {e}")
-            messagebox.showerror("Error", f"Failed to rearrange volume calculations: {e}")
-    
-    ## ------------------------------------------------------- ##
-    ## ------------ STL Creation ----------------------------- ##
-    ## ------------------------------------------------------- ##
-    def nifti_to_stl(self, nifti_file_path, stl_file_path, threshold_value=1, decimate=True, decimate_target_reduction=0.5):
-        try:
-            # Load NIfTI file
-            reader = vtk.vtkNIFTIImageReader()
-            reader.SetFileName(nifti_file_path)
-            reader.Update()
-
-            # Add padding to ensure closed surfaces
-            pad_filter = vtk.vtkImageConstantPad()
-            pad_filter.SetInputConnection(reader.GetOutputPort())
-            
-            # Set padding: Add one layer of zero-value voxels on all sides
-            extent = reader.GetDataExtent()
-            pad_filter.SetOutputWholeExtent(
-                extent[0] - 1, extent[1] + 1,  # X-axis padding
-                extent[2] - 1, extent[3] + 1,  # Y-axis padding
-                extent[4] - 1, extent[5] + 1   # Z-axis padding
-            )
-            pad_filter.SetConstant(0)  # Fill padding with zero
-            pad_filter.Update()
-
-            # Apply vtkDiscreteFlyingEdges3D
-            discrete_flying_edges = vtk.vtkDiscreteFlyingEdges3D()
-            discrete_flying_edges.SetInputConnection(pad_filter.GetOutputPort())
-            discrete_flying_edges.SetValue(0, threshold_value)
-            discrete_flying_edges.Update()
-
-            output_polydata = discrete_flying_edges.GetOutput()
-
-            # Apply decimation to reduce file size
-            if decimate:
-                decimator = vtk.vtkDecimatePro()
-                decimator.SetInputData(output_polydata)
-                decimator.SetTargetReduction(decimate_target_reduction)
-                decimator.PreserveTopologyOn()
-                decimator.Update()
-                output_polydata = decimator.GetOutput()
-
-            # Apply smoothing
-            smoothing_filter = vtk.vtkSmoothPolyDataFilter()
-            smoothing_filter.SetInputData(output_polydata)
-            smoothing_filter.SetNumberOfIterations(5)
-            smoothing_filter.SetRelaxationFactor(0.1)
-            smoothing_filter.FeatureEdgeSmoothingOff()
-            smoothing_filter.BoundarySmoothingOn()
-            smoothing_filter.Update()
-            output_polydata = smoothing_filter.GetOutput()
-
-            # Get QForm matrix
-            qform_matrix = reader.GetQFormMatrix()
-
-            # Create IJK to RAS transformation
-            ijk_to_ras = vtk.vtkMatrix4x4()
-            ijk_to_ras.DeepCopy(qform_matrix)
-
-            # Adjust for VTK's coordinate system
-            flip_xy = vtk.vtkMatrix4x4()
-            flip_xy.SetElement(0, 0, -1)
-            flip_xy.SetElement(1, 1, -1)
-
-            vtk.vtkMatrix4x4.Multiply4x4(flip_xy, ijk_to_ras, ijk_to_ras)
-
-            # Create transformation matrix
-            transform = vtk.vtkTransform()
-            transform.SetMatrix(ijk_to_ras)
-
-            # Apply transformation
-            transform_filter = vtk.vtkTransformPolyDataFilter()
-            transform_filter.SetInputData(output_polydata)
-            transform_filter.SetTransform(transform)
-            transform_filter.Update()
-            transformed_polydata = transform_filter.GetOutput()
-
-            # Compute normals
-            normals = vtk.vtkPolyDataNormals()
-            normals.SetInputData(transformed_polydata)
-            normals.SetFeatureAngle(60.0)
-            normals.ConsistencyOn()
-            normals.SplittingOff()
-            normals.Update()
-
-            # Write STL file
-            stl_writer = vtk.vtkSTLWriter()
-            stl_writer.SetFileTypeToBinary()
-            stl_writer.SetFileName(stl_file_path)
-            stl_writer.SetInputData(normals.GetOutput())
-            stl_writer.Write()
-
-        except Exception as e:
-            messagebox.showerror("Conversion Error", f"Failed to convert {nifti_file_path} to STL. Error: {e}")
-
-
-    def export_predictions_to_stl(self,input_path_str,output_path_str):
-
-        if not input_path_str or not output_path_str:
-            messagebox.showwarning("Input Error", "Please select both input and output directories.")
-            return
-
-        nifti_files = [f for f in os.listdir(input_path_str) if f.endswith('.nii') or f.endswith('.nii.gz')]
-        if not nifti_files:
-            messagebox.showwarning("Input Error", "No NIfTI files found in the selected input directory.")
-            return
-
-        for nifti_file in nifti_files:
-            nifti_file_path = os.path.join(input_path_str, nifti_file)
-            base_name = os.path.splitext(os.path.splitext(nifti_file)[0])[0]
-            stl_file_path = os.path.join(output_path_str, f"{base_name}.stl")
-            print(f"The base name is {base_name}")
-            print(f"The stl_file_path is {stl_file_path}")
-            self.nifti_to_stl(nifti_file_path, stl_file_path, threshold_value=1, decimate=True, decimate_target_reduction=0.5)
-    
     ## ------------------------------------------------------- ##
     ## ------------ GUI Widgets ------------------------------ ##
     ## ------------------------------------------------------- ##
@@ -877,7 +265,7 @@ class UnifiedAirwaySegmentationGUI(ctk.CTk):
                 "- Convert to NIfTI: Converts DICOM files to NIfTI format.\n"
                 "- Anonymize and Rename: Removes identifying information from DICOM file metadata, applies user-specified name and numbering to all files.\n"
                 "- Upper Airway Segmentation: Segments upper airway structures in 3-12 minutes per file, saving results with a '_seg' suffix for easy identification.\n"
-                "- Calculate Volume: Creates a .txt file containing the volumes of the airway segmentations that can be easily imported into Excel.\n"
+                "- Calculate Volume: Writes 'Volume Calculations.csv' with the airway volume of each segmentation, sorted by filename, for Excel.\n"
                 "- Export as STL: Saves 3D STL files of segmentations for 3D printing or CFD simulations."
             ),
             font=("Arial", 11),  # Normal font for text
@@ -977,9 +365,19 @@ class UnifiedAirwaySegmentationGUI(ctk.CTk):
         ctk.CTkSwitch(task_frame, text="Calculate Segmentation Volume", variable=self.calculate_volume).grid(row=4, column=0, padx=20, pady=5, sticky="w")
         ctk.CTkSwitch(task_frame, text="Export Segmentation as STL", variable=self.export_stl).grid(row=5, column=0, padx=20, pady=5, sticky="w")
 
+        # Mesh file format; PLY, OBJ and GLB share vertices and are much smaller than STL
+        mesh_format_label = ctk.CTkLabel(task_frame, text="Mesh Format:")
+        mesh_format_label.grid(row=5, column=1, sticky="", pady=5, padx=(10, 5))
+        ctk.CTkOptionMenu(task_frame, variable=self.mesh_format, values=list(MESH_FORMATS), width=100).grid(row=5, column=2, sticky="w", pady=5)
+        ctk.CTkCheckBox(task_frame, text="gzip", variable=self.compress_meshes).grid(row=5, column=3, sticky="w", pady=5, padx=(10, 5))
+
         # Start button
-        ctk.CTkButton(self, text="Start Processing", command=self.start_processing, font=("Times_New_Roman", 14, "bold")).grid(row=3, column=0, pady=5)
+        self.start_button = ctk.CTkButton(self, text="Start Processing", command=self.start_processing, font=("Times_New_Roman", 14, "bold"))
+        self.start_button.grid(row=3, column=0, pady=5)
 
 if __name__ == "__main__":
+    # In a frozen (PyInstaller) build the pool workers start this executable again;
+    # this lets them run their task instead of opening another window
+    multiprocessing.freeze_support()
     app = UnifiedAirwaySegmentationGUI()
     app.mainloop()
\ No newline at end of file
@@ -0,0 +1,142 @@
+"""
+Per-case stage manifest kept in the "_Processed" folder.
+
+The manifest records, for every case, which stages completed, what they produced
+(paths and values stored on the Case), a checksum of every output file and the
+parameters the stage ran with. When a run is restarted, stages whose outputs are
+still intact and whose parameters are unchanged are skipped, and the case resumes
+at its first incomplete stage.
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+MANIFEST_NAME = "pipeline_manifest.json"
+MANIFEST_VERSION = 1
+
+# Case attributes each stage fills in, and therefore records in the manifest
+STAGE_OUTPUTS = {
+    "anonymize": ("dicom_folder", "nifti_path"),
+    "convert": ("nifti_path", "image_key"),
+    "predict": ("seg_path", "label_key"),
+    "postprocess": ("volume", "label_stats", "stl_path", "stl_paths"),
+}
+
+
+def file_checksum(path, chunk_size=1 << 20):
+    """SHA-256 of a file, read in 1 MB chunks."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def describe_output(value):
+    """
+    Manifest entry for one stage output: files get size, mtime and checksum, lists of files an entry each.
+    Strings that are not paths on disk when recorded (e.g. cache keys) are marked as plain values.
+    """
+    entry = {"value": value}
+    if isinstance(value, list) and value and all(isinstance(item, str) for item in value):
+        entry["files"] = [describe_output(item) for item in value]
+        return entry
+    if isinstance(value, str):
+        entry["path"] = os.path.exists(value)
+        if os.path.isfile(value):
+            stat = os.stat(value)
+            entry.update(size=stat.st_size, mtime_ns=stat.st_mtime_ns, sha256=file_checksum(value))
+    return entry
+
+
+def output_intact(entry):
+    """True if a recorded output still exists unchanged."""
+    value = entry.get("value")
+    if "files" in entry:
+        return all(output_intact(item) for item in entry["files"])
+    if "sha256" not in entry:
+        # Folders only need to still be there, plain values always hold
+        return not (isinstance(value, str) and entry.get("path", True)) or os.path.exists(value)
+    if not os.path.isfile(value):
+        return False
+    stat = os.stat(value)
+    if stat.st_size != entry["size"]:
+        return False
+    if stat.st_mtime_ns == entry["mtime_ns"]:
+        return True
+    # Touched but possibly identical (e.g. copied back), fall back to the checksum
+    return file_checksum(value) == entry["sha256"]
+
+
+class RunManifest:
+    """Thread-safe reader/writer for the manifest of one output folder."""
+
+    def __init__(self, output_folder):
+        self.path = os.path.join(output_folder, MANIFEST_NAME)
+        self._lock = threading.Lock()
+        self.data = {"version": MANIFEST_VERSION, "cases": {}}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, "r") as f:
+                    data = json.load(f)
+                if data.get("version") == MANIFEST_VERSION:
+                    self.data = data
+                else:
+                    logging.warning(f"Ignoring manifest {self.path} with unknown version {data.get('version')}")
+            except (OSError, ValueError) as e:
+                logging.warning(f"Ignoring unreadable manifest {self.path}: {e}")
+
+    def source_names(self):
+        """Mapping of recorded case sources to case names, used to keep renamed names stable on rerun."""
+        return {entry["source"]: name for name, entry in self.data["cases"].items() if entry.get("source")}
+
+    def register_case(self, case, source):
+        with self._lock:
+            entry = self.data["cases"].setdefault(case.name, {"stages": {}})
+            if entry.get("source") != source:
+                # A different input now maps to this name, previous results do not apply
+                entry["source"] = source
+                entry["stages"] = {}
+
+    def completed(self, case, stage, params=None, required=()):
+        """
+        True if `stage` already finished for `case` with the same `params`, produced every
+        output named in `required` and its outputs are intact.
+        """
+        with self._lock:
+            record = self.data["cases"].get(case.name, {}).get("stages", {}).get(stage)
+        if record is None or record.get("params") != params:
+            return False
+        if any(attribute not in record["outputs"] for attribute in required):
+            return False
+        return all(output_intact(entry) for entry in record["outputs"].values())
+
+    def restore(self, case, stage):
+        """Copies the recorded outputs of a completed stage back onto the case."""
+        with self._lock:
+            record = self.data["cases"][case.name]["stages"][stage]
+        for attribute, entry in record["outputs"].items():
+            setattr(case, attribute, entry["value"])
+
+    def record(self, case, stage, params=None):
+        """Marks `stage` complete for `case`, storing the outputs it set and its params, and saves the manifest."""
+        outputs = {
+            attribute: describe_output(getattr(case, attribute))
+            for attribute in STAGE_OUTPUTS.get(stage, ())
+            if getattr(case, attribute) is not None
+        }
+        with self._lock:
+            entry = self.data["cases"].setdefault(case.name, {"stages": {}})
+            entry["stages"][stage] = {"outputs": outputs, "params": params,
+                                      "completed_at": time.strftime("%Y-%m-%d %H:%M:%S")}
+            self._save()
+
+    def _save(self):
+        # Write to a temporary file first so a crash never leaves a truncated manifest
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.data, f, indent=2)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,409 @@
+"""
+Surface extraction for label maps, with selectable engines.
+
+- "flying_edges": vtkDiscreteFlyingEdges3D, the engine the app has always used
+- "surface_nets": vtkSurfaceNets3D (VTK 9.3+), smooth surfaces straight from labels
+- "marching_cubes": skimage.measure.marching_cubes on the label mask
+
+Every engine returns a triangle vtkPolyData in image coordinates (origin +
+index * spacing), so the rest of the STL pipeline does not depend on the choice.
+Images are first cropped to the label's bounding box and padded with one voxel
+of background, which keeps the surface closed and the work proportional to the
+airway rather than the scan. benchmark_meshing.py compares the engines.
+
+image_to_stl then decimates the surface, either by a fixed ratio or down to a
+triangle budget (a triangle count, or a file size, since a binary STL takes 50
+bytes per triangle), and smooths it, in either order. image_to_stl_levels writes
+several levels of detail (e.g. case_lod0.stl for printing, case_lod2.stl for
+review) from a single extraction. Besides STL, which repeats the three vertices
+of every triangle, meshes can be written as indexed PLY, OBJ or GLB files with
+shared vertices, optionally gzip compressed; the format follows the file name.
+"""
+import gzip
+import json
+import logging
+import os
+import shutil
+import struct
+import time
+
+from lazy_imports import lazy_import
+from volume import VOLUME_CHUNK_SIZE
+
+np = lazy_import("numpy")
+vtk = lazy_import("vtk")
+numpy_support = lazy_import("vtk.util.numpy_support")
+
+ENGINES = ("flying_edges", "surface_nets", "marching_cubes")
+DEFAULT_ENGINE = "flying_edges"
+
+# "quadric": vtkQuadricDecimation, fast on dense meshes; "pro": vtkDecimatePro, topology preserving
+DECIMATIONS = ("pro", "quadric")
+DEFAULT_DECIMATION = "pro"
+
+# Written with shared vertices except STL; any of them can be gzip compressed (".gz")
+MESH_FORMATS = ("stl", "ply", "obj", "glb")
+
+# Binary STL: 80 byte header and a 4 byte count, then 50 bytes per triangle
+STL_HEADER_BYTES = 84
+STL_TRIANGLE_BYTES = 50
+
+
+def label_extent(image_data, label, chunk_size=VOLUME_CHUNK_SIZE):
+    """
+    VTK extent (x0, x1, y0, y1, z0, z1) of the voxels of a single-component vtkImageData
+    equal to `label`, or None if there are none. The scalars are read in place, in z
+    slabs of about chunk_size bytes, so no temporary is larger than one slab.
+    """
+    x0, x1, y0, y1, z0, z1 = image_data.GetExtent()
+    nx, ny, nz = x1 - x0 + 1, y1 - y0 + 1, z1 - z0 + 1
+    # VTK stores x fastest, so the C-order view is (z, y, x)
+    values = numpy_support.vtk_to_numpy(image_data.GetPointData().GetScalars()).reshape(nz, ny, nx)
+    in_x = np.zeros(nx, dtype=bool)
+    in_y = np.zeros(ny, dtype=bool)
+    in_z = np.zeros(nz, dtype=bool)
+    step = max(1, chunk_size // max(1, nx * ny * values.itemsize))
+    for k in range(0, nz, step):
+        slab = values[k:k + step] == label
+        in_z[k:k + step] = slab.any(axis=(1, 2))
+        in_y |= slab.any(axis=(0, 2))
+        in_x |= slab.any(axis=(0, 1))
+    if not in_z.any():
+        return None
+
+    def span(mask, start):
+        return start + int(np.argmax(mask)), start + len(mask) - 1 - int(np.argmax(mask[::-1]))
+    return span(in_x, x0) + span(in_y, y0) + span(in_z, z0)
+
+
+def crop_to_label(image_data, label):
+    """
+    The label's bounding box of image_data plus one voxel of zero padding on every side.
+    Extents keep their indices, so points land at the same coordinates as uncropped.
+    An image without the label is only padded.
+    """
+    extent = label_extent(image_data, label) or image_data.GetExtent()
+    pad_filter = vtk.vtkImageConstantPad()
+    pad_filter.SetInputData(image_data)
+    pad_filter.SetOutputWholeExtent(
+        extent[0] - 1, extent[1] + 1,  # X-axis padding
+        extent[2] - 1, extent[3] + 1,  # Y-axis padding
+        extent[4] - 1, extent[5] + 1   # Z-axis padding
+    )
+    pad_filter.SetConstant(0)  # Fill padding with zero
+    pad_filter.Update()
+    return pad_filter.GetOutput()
+
+
+def extract_surface(image_data, label, engine=DEFAULT_ENGINE):
+    """Triangle surface of the voxels of image_data equal to `label`, using `engine`."""
+    if engine == "flying_edges":
+        discrete_flying_edges = vtk.vtkDiscreteFlyingEdges3D()
+        discrete_flying_edges.SetInputData(image_data)
+        discrete_flying_edges.SetValue(0, label)
+        discrete_flying_edges.Update()
+        return discrete_flying_edges.GetOutput()
+    if engine == "surface_nets":
+        if not hasattr(vtk, "vtkSurfaceNets3D"):
+            raise ValueError("The surface_nets engine needs VTK 9.3 or newer")
+        surface_nets = vtk.vtkSurfaceNets3D()
+        surface_nets.SetInputData(image_data)
+        surface_nets.SetValue(0, label)
+        surface_nets.SetOutputMeshTypeToTriangles()
+        surface_nets.Update()
+        return surface_nets.GetOutput()
+    if engine == "marching_cubes":
+        return _marching_cubes(image_data, label)
+    raise ValueError(f"Unknown mesh engine {engine!r}, expected one of {', '.join(ENGINES)}")
+
+
+def _marching_cubes(image_data, label):
+    from skimage import measure
+
+    x0, x1, y0, y1, z0, z1 = image_data.GetExtent()
+    shape = (z1 - z0 + 1, y1 - y0 + 1, x1 - x0 + 1)
+    values = numpy_support.vtk_to_numpy(image_data.GetPointData().GetScalars()).reshape(shape)
+    spacing = image_data.GetSpacing()
+    origin = image_data.GetOrigin()
+
+    mask = (values == label).view(np.uint8)
+    verts, faces, _, _ = measure.marching_cubes(mask, level=0.5, spacing=spacing[::-1])
+    # (z, y, x) to (x, y, z) mirrors the mesh, reversing each face keeps the normals outward
+    verts = verts[:, ::-1] + np.array([origin[i] + start * spacing[i] for i, start in enumerate((x0, y0, z0))])
+    faces = faces[:, ::-1]
+
+    points = vtk.vtkPoints()
+    points.SetData(numpy_support.numpy_to_vtk(np.ascontiguousarray(verts, dtype=np.float32), deep=True))
+    offsets = np.arange(0, 3 * len(faces) + 1, 3, dtype=np.int64)
+    polys = vtk.vtkCellArray()
+    polys.SetData(numpy_support.numpy_to_vtkIdTypeArray(offsets, deep=True),
+                  numpy_support.numpy_to_vtkIdTypeArray(np.ascontiguousarray(faces, dtype=np.int64).ravel(), deep=True))
+    polydata = vtk.vtkPolyData()
+    polydata.SetPoints(points)
+    polydata.SetPolys(polys)
+    return polydata
+
+
+def stl_triangle_budget(max_file_mb):
+    """Most triangles a binary STL of at most max_file_mb megabytes can hold."""
+    return max(0, int((max_file_mb * 1024 * 1024 - STL_HEADER_BYTES) // STL_TRIANGLE_BYTES))
+
+
+def decimate_mesh(polydata, algorithm=DEFAULT_DECIMATION, target_reduction=0.5, target_triangles=None):
+    """
+    Reduces a triangle mesh with `algorithm` ("quadric" or "pro"). With target_triangles the
+    reduction is chosen to land on that many triangles (no-op if the mesh is already smaller),
+    otherwise target_reduction (0-1) is removed. DecimatePro preserves topology and may stop short
+    of the target, quadric decimation reaches it but may close small holes.
+    """
+    triangles = polydata.GetNumberOfPolys()
+    if target_triangles is not None:
+        if triangles <= target_triangles:
+            return polydata
+        target_reduction = 1.0 - target_triangles / triangles
+    if target_reduction <= 0:
+        return polydata
+    if algorithm == "quadric":
+        decimator = vtk.vtkQuadricDecimation()
+        decimator.SetInputData(polydata)
+        decimator.SetTargetReduction(target_reduction)
+        decimator.VolumePreservationOn()
+    elif algorithm == "pro":
+        decimator = vtk.vtkDecimatePro()
+        decimator.SetInputData(polydata)
+        decimator.SetTargetReduction(target_reduction)
+        decimator.PreserveTopologyOn()
+    else:
+        raise ValueError(f"Unknown decimation algorithm {algorithm!r}, expected one of {', '.join(DECIMATIONS)}")
+    decimator.Update()
+    return decimator.GetOutput()
+
+
+def smooth_mesh(polydata, iterations=5, relaxation_factor=0.1):
+    """Laplacian smoothing, feature edges left free, boundaries smoothed."""
+    smoothing_filter = vtk.vtkSmoothPolyDataFilter()
+    smoothing_filter.SetInputData(polydata)
+    smoothing_filter.SetNumberOfIterations(iterations)
+    smoothing_filter.SetRelaxationFactor(relaxation_factor)
+    smoothing_filter.FeatureEdgeSmoothingOff()
+    smoothing_filter.BoundarySmoothingOn()
+    smoothing_filter.Update()
+    return smoothing_filter.GetOutput()
+
+
+def ras_transform(ijk_to_ras_matrix):
+    """vtkTransform from image coordinates to the RAS space the STL files are written in."""
+    # Create IJK to RAS transformation from the QForm matrix
+    ijk_to_ras = vtk.vtkMatrix4x4()
+    ijk_to_ras.DeepCopy(ijk_to_ras_matrix)
+
+    # Adjust for VTK's coordinate system
+    flip_xy = vtk.vtkMatrix4x4()
+    flip_xy.SetElement(0, 0, -1)
+    flip_xy.SetElement(1, 1, -1)
+    vtk.vtkMatrix4x4.Multiply4x4(flip_xy, ijk_to_ras, ijk_to_ras)
+
+    transform = vtk.vtkTransform()
+    transform.SetMatrix(ijk_to_ras)
+    return transform
+
+
+def mesh_file_path(root, mesh_format="stl", compress=False):
+    """"case" -> "case.ply" or, compressed, "case.ply.gz"."""
+    return f"{root}.{mesh_format}" + (".gz" if compress else "")
+
+
+def split_mesh_path(file_path):
+    """(root, format, compressed) of a mesh file path such as "case.glb.gz"."""
+    compressed = file_path.lower().endswith(".gz")
+    root, ext = os.path.splitext(file_path[:-3] if compressed else file_path)
+    return root, ext[1:].lower(), compressed
+
+
+def lod_paths(file_path, levels):
+    """"case.stl" -> ["case_lod0.stl", "case_lod1.stl", ...], one path per level of detail."""
+    root, mesh_format, compressed = split_mesh_path(file_path)
+    return [mesh_file_path(f"{root}_lod{level}", mesh_format, compressed) for level in range(levels)]
+
+
+def write_glb(polydata, glb_path):
+    """
+    Writes a triangle mesh with point normals as a binary glTF 2.0 (.glb) file: one float32
+    position and normal per shared vertex and uint32 triangle indices. Units stay millimetres.
+    """
+    points = polydata.GetPoints()
+    positions = (np.ascontiguousarray(numpy_support.vtk_to_numpy(points.GetData()), dtype=np.float32)
+                 if points is not None else np.zeros((0, 3), dtype=np.float32))
+    normals = polydata.GetPointData().GetNormals()
+    normals = np.ascontiguousarray(numpy_support.vtk_to_numpy(normals), dtype=np.float32) if normals else None
+    polys = polydata.GetPolys()
+    indices = np.ascontiguousarray(numpy_support.vtk_to_numpy(polys.GetConnectivityArray()), dtype=np.uint32)
+
+    # Every array is made of 4 byte values, so the views stay 4 byte aligned
+    arrays = [(positions, 34962), (indices, 34963)] + ([(normals, 34962)] if normals is not None else [])
+    buffer_views, offset = [], 0
+    for array, target in arrays:
+        buffer_views.append({"buffer": 0, "byteOffset": offset, "byteLength": array.nbytes, "target": target})
+        offset += array.nbytes
+    accessors = [
+        {"bufferView": 0, "componentType": 5126, "count": len(positions), "type": "VEC3",
+         "min": positions.min(axis=0).tolist() if len(positions) else [0, 0, 0],
+         "max": positions.max(axis=0).tolist() if len(positions) else [0, 0, 0]},
+        {"bufferView": 1, "componentType": 5125, "count": len(indices), "type": "SCALAR"},
+    ]
+    attributes = {"POSITION": 0}
+    if normals is not None:
+        accessors.append({"bufferView": 2, "componentType": 5126, "count": len(normals), "type": "VEC3"})
+        attributes["NORMAL"] = 2
+    gltf = {
+        "asset": {"version": "2.0", "generator": "AirwaySegmentator"},
+        "scene": 0,
+        "scenes": [{"nodes": [0]}],
+        "nodes": [{"mesh": 0}],
+        "meshes": [{"primitives": [{"attributes": attributes, "indices": 1, "mode": 4}]}],
+        "buffers": [{"byteLength": offset}],
+        "bufferViews": buffer_views,
+        "accessors": accessors,
+    }
+    json_chunk = json.dumps(gltf, separators=(",", ":")).encode()
+    json_chunk += b" " * (-len(json_chunk) % 4)
+    with open(glb_path, "wb") as f:
+        f.write(struct.pack("<4sII", b"glTF", 2, 12 + 8 + len(json_chunk) + 8 + offset))
+        f.write(struct.pack("<I4s", len(json_chunk), b"JSON"))
+        f.write(json_chunk)
+        f.write(struct.pack("<I4s", offset, b"BIN\0"))
+        for array, _ in arrays:
+            f.write(array.tobytes())
+
+
+def write_mesh(polydata, transform, file_path, flip_normals=False):
+    """
+    Transforms a mesh, computes its normals and writes it in the format of the file extension:
+    binary STL, binary PLY, OBJ or GLB, gzip compressed if it ends in ".gz". Returns the file size.
+    """
+    transform_filter = vtk.vtkTransformPolyDataFilter()
+    transform_filter.SetInputData(polydata)
+    transform_filter.SetTransform(transform)
+    transform_filter.Update()
+
+    # Compute normals
+    normals = vtk.vtkPolyDataNormals()
+    normals.SetInputData(transform_filter.GetOutput())
+    normals.SetFeatureAngle(60.0)
+    normals.ConsistencyOn()
+    normals.SplittingOff()
+    normals.SetFlipNormals(flip_normals)
+    normals.Update()
+
+    root, mesh_format, compressed = split_mesh_path(file_path)
+    # Compressed files are written next to their target first, then packed
+    out_path = f"{root}.partial.{mesh_format}" if compressed else file_path
+    if mesh_format == "stl":
+        writer = vtk.vtkSTLWriter()
+        writer.SetFileTypeToBinary()
+    elif mesh_format == "ply":
+        writer = vtk.vtkPLYWriter()
+        writer.SetFileTypeToBinary()
+    elif mesh_format == "obj":
+        writer = vtk.vtkOBJWriter()
+    elif mesh_format == "glb":
+        writer = None
+        write_glb(normals.GetOutput(), out_path)
+    else:
+        raise ValueError(f"Unknown mesh format {mesh_format!r}, expected one of {', '.join(MESH_FORMATS)}")
+    if writer is not None:
+        writer.SetFileName(out_path)
+        writer.SetInputData(normals.GetOutput())
+        writer.Write()
+
+    if compressed:
+        try:
+            with open(out_path, "rb") as src, gzip.open(file_path, "wb", compresslevel=6) as dst:
+                shutil.copyfileobj(src, dst, 1 << 20)
+        finally:
+            os.remove(out_path)
+    return os.path.getsize(file_path)
+
+
+def image_to_stl_levels(image_data, ijk_to_ras_matrix, stl_file_paths, reductions, threshold_value=1,
+                        flip_normals=False, engine=DEFAULT_ENGINE, decimate_algorithm=DEFAULT_DECIMATION,
+                        target_triangles=None, max_file_mb=None, smooth_first=False):
+    """
+    Meshes a label image (vtkImageData) with `engine` once and writes one mesh file per level
+    of detail, in the format of its extension (see write_mesh): stl_file_paths[i] keeps
+    1 - reductions[i] of the extracted triangles (None: no decimation). target_triangles and/or
+    max_file_mb cap every decimated level (the smaller one wins); max_file_mb is sized for binary
+    STL, the indexed formats come out smaller. Levels are decimated from the next finer level rather than from the full
+    surface, so each decimation works on an already reduced mesh.
+
+    `ijk_to_ras_matrix` maps image coordinates to the qform space; `flip_normals` restores
+    outward normals when that matrix mirrors. Only the label's bounding box is meshed, so
+    time and memory follow the size of the label, not the image. smooth_first smooths the
+    dense mesh once before decimating instead of each level after.
+
+    Returns the mesh statistics of every file (path, triangle counts, decimation/smoothing
+    seconds, file size); the shared extraction time is counted on the first file.
+    """
+    start = time.perf_counter()
+    surface = extract_surface(crop_to_label(image_data, threshold_value), threshold_value, engine)
+    extract_seconds = time.perf_counter() - start
+    extracted = surface.GetNumberOfPolys()
+    smooth_seconds = 0.0
+    if smooth_first:
+        start = time.perf_counter()
+        surface = smooth_mesh(surface)
+        smooth_seconds = time.perf_counter() - start
+    transform = ras_transform(ijk_to_ras_matrix)
+
+    caps = [target_triangles, stl_triangle_budget(max_file_mb) if max_file_mb is not None else None]
+    cap = min((c for c in caps if c is not None), default=None)
+
+    all_stats = [None] * len(stl_file_paths)
+    source = surface
+    # Finest level first, each coarser level continues from the previous one
+    order = sorted(range(len(stl_file_paths)), key=lambda i: -1 if reductions[i] is None else reductions[i])
+    for i in order:
+        stats = {"path": stl_file_paths[i], "triangles_extracted": extracted}
+        polydata = source
+        if reductions[i] is not None:
+            budget = int(extracted * (1.0 - reductions[i]))
+            if cap is not None:
+                budget = min(budget, cap)
+            start = time.perf_counter()
+            polydata = source = decimate_mesh(source, decimate_algorithm, target_triangles=budget)
+            stats["decimate_seconds"] = time.perf_counter() - start
+            if cap is not None and polydata.GetNumberOfPolys() > cap:
+                logging.warning(f"{os.path.basename(stl_file_paths[i])}: {polydata.GetNumberOfPolys()} triangles "
+                                f"left, over the budget of {cap} after {decimate_algorithm} decimation")
+        # Decimation reduces file size, smoothing removes the voxel staircase
+        if not smooth_first:
+            start = time.perf_counter()
+            polydata = smooth_mesh(polydata)
+            stats["smooth_seconds"] = time.perf_counter() - start
+        stats["triangles"] = polydata.GetNumberOfPolys()
+        stats["file_bytes"] = write_mesh(polydata, transform, stl_file_paths[i], flip_normals)
+        all_stats[i] = stats
+
+    all_stats[0]["extract_seconds"] = extract_seconds
+    if smooth_first:
+        all_stats[0]["smooth_seconds"] = smooth_seconds
+    return all_stats
+
+
+def image_to_stl(image_data, ijk_to_ras_matrix, stl_file_path, threshold_value=1, decimate=True,
+                 decimate_target_reduction=0.5, flip_normals=False, engine=DEFAULT_ENGINE,
+                 decimate_algorithm=DEFAULT_DECIMATION, target_triangles=None, max_file_mb=None, smooth_first=False):
+    """
+    Meshes a label image and writes it as a single mesh file (binary STL unless the extension
+    names another format), see image_to_stl_levels.
+    Decimation removes decimate_target_reduction of the triangles, unless target_triangles
+    and/or max_file_mb set a triangle budget instead. Returns the mesh statistics of the file.
+    """
+    reduction = None
+    if decimate:
+        reduction = 0.0 if target_triangles is not None or max_file_mb is not None else decimate_target_reduction
+    return image_to_stl_levels(image_data, ijk_to_ras_matrix, [stl_file_path], [reduction],
+                               threshold_value=threshold_value,
+                               flip_normals=flip_normals, engine=engine, decimate_algorithm=decimate_algorithm,
+                               target_triangles=target_triangles, max_file_mb=max_file_mb,
+                               smooth_first=smooth_first)[0]
@@ -13,6 +13,7 @@ from STLConvGUI import STLConverterGUI
 import csv
 import nibabel as nib
 import numpy as np
+from volume import count_label_voxels
 
 
 
@@ -202,9 +203,8 @@ class nnUNetScript(ctk.CTkFrame):
         - total_volume (float): Volume in cubic millimeters
         """
         try:
-            # Load the NIfTI file
+            # Only the header is read here, voxels are streamed when counting
             nifti_img = nib.load(file_path)
-            data = nifti_img.get_fdata()
 
             # Log the affine matrix and zooms for debugging
             affine = nifti_img.affine
@@ -214,11 +214,11 @@ class nnUNetScript(ctk.CTkFrame):
             logging.info(f"Voxel dimensions (in mm): {voxel_sizes}")
 
             # Calculate the volume of a single voxel
-            voxel_volume = np.prod(voxel_sizes)  # Voxel volume in mm³
+            voxel_volume = np.prod(voxel_sizes[:3])  # Voxel volume in mm³
             logging.info(f"Voxel volume: {voxel_volume:.2f} mm³")
 
             # Count the number of voxels in the airway region
-            airway_voxel_count = np.sum(data == airway_label)
+            airway_voxel_count = count_label_voxels(nifti_img, file_path, airway_label)
             logging.info(f"Total airway voxel count for label {airway_label}: {airway_voxel_count}")
 
             # Calculate total volume in mm³
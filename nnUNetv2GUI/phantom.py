@@ -0,0 +1,230 @@
+"""
+Synthetic CBCT phantoms for benchmarking without patient data.
+
+A phantom is a head-sized ellipse of soft tissue inside a bone shell, with a
+winding air-filled tube of varying radius (the "airway") running through most
+of the slices, plus noise. generate_dataset writes phantoms as DICOM series in
+the layouts the pipeline accepts (patient folders, or patient/time-point
+folders) and the matching airway label maps as NIfTI:
+
+    <output>/DICOM/<patient>[/<time point>]/slice_0001.dcm ...
+    <output>/Labels/<patient>[_<time point>]_seg.nii.gz
+
+ThresholdPredictor stands in for the nnUNet predictor: it segments the air
+inside the head by thresholding, which is right for phantoms and needs no GPU or
+model. benchmark_pipeline.py builds its benchmark suite on both.
+
+    python phantom.py /tmp/phantoms --patients 3 --time-points T1 T2 --slices 160 --size 256
+"""
+import argparse
+import logging
+import os
+import sys
+
+import nibabel as nib
+import numpy as np
+import pydicom
+from pydicom.dataset import FileDataset, FileMetaDataset
+from pydicom.uid import (CTImageStorage, DeflatedExplicitVRLittleEndian, ExplicitVRLittleEndian,
+                         ImplicitVRLittleEndian, RLELossless, generate_uid)
+
+TRANSFER_SYNTAXES = {
+    "explicit": ExplicitVRLittleEndian,
+    "implicit": ImplicitVRLittleEndian,
+    "deflated": DeflatedExplicitVRLittleEndian,
+    "rle": RLELossless,
+}
+
+AIR_HU = -1000
+TISSUE_HU = 40
+BONE_HU = 1000
+NOISE_HU = 20
+# Voxels below this are air, for ThresholdPredictor
+AIR_THRESHOLD = -400
+
+
+class Phantom:
+    """Geometry of one phantom; slice(k) renders slice k as (HU int16, airway uint8), both (rows, columns)."""
+
+    def __init__(self, slices, rows, columns, seed=0):
+        self.shape = (slices, rows, columns)
+        self.rng = np.random.default_rng(seed)
+        # Each phantom winds a little differently
+        self.phase = self.rng.uniform(0, 2 * np.pi)
+        self.y, self.x = np.mgrid[0:rows, 0:columns].astype(np.float32)
+
+    def slice(self, k):
+        slices, rows, columns = self.shape
+        t = k / max(1, slices - 1)
+        # Head outline: an ellipse that narrows towards the top and bottom
+        ry, rx = 0.45 * rows * (0.85 + 0.15 * np.sin(np.pi * t)), 0.42 * columns * (0.85 + 0.15 * np.sin(np.pi * t))
+        head = ((self.y - rows / 2) / ry) ** 2 + ((self.x - columns / 2) / rx) ** 2
+        hu = np.full((rows, columns), AIR_HU, dtype=np.float32)
+        hu[head <= 1.0] = BONE_HU
+        hu[head <= 0.85] = TISSUE_HU
+
+        airway = np.zeros((rows, columns), dtype=np.uint8)
+        if 0.1 <= t <= 0.9:
+            cy = rows * (0.55 + 0.05 * np.sin(2 * np.pi * t + self.phase))
+            cx = columns * (0.5 + 0.08 * np.sin(3 * np.pi * t + self.phase))
+            radius = 0.06 * min(rows, columns) * (1.0 + 0.4 * np.sin(4 * np.pi * t + self.phase))
+            airway[(self.y - cy) ** 2 + (self.x - cx) ** 2 <= radius ** 2] = 1
+            hu[airway == 1] = AIR_HU
+
+        hu += self.rng.normal(0, NOISE_HU, hu.shape).astype(np.float32)
+        return np.clip(hu, -1024, 3071).astype(np.int16), airway
+
+
+def _save_dataset(dataset, path):
+    if int(pydicom.__version__.split(".")[0]) >= 3:
+        dataset.save_as(path, enforce_file_format=True)
+    else:
+        dataset.save_as(path, write_like_original=False)
+
+
+def _slice_dataset(pixels, k, spacing, origin, transfer_syntax, uids, patient_name, file_path):
+    file_meta = FileMetaDataset()
+    file_meta.MediaStorageSOPClassUID = CTImageStorage
+    file_meta.MediaStorageSOPInstanceUID = generate_uid()
+    file_meta.TransferSyntaxUID = TRANSFER_SYNTAXES[transfer_syntax]
+
+    dataset = FileDataset(file_path, {}, file_meta=file_meta, preamble=b"\0" * 128)
+    if int(pydicom.__version__.split(".")[0]) < 3:
+        dataset.is_little_endian = True
+        dataset.is_implicit_VR = transfer_syntax == "implicit"
+    dataset.SOPClassUID = CTImageStorage
+    dataset.SOPInstanceUID = file_meta.MediaStorageSOPInstanceUID
+    dataset.StudyInstanceUID, dataset.SeriesInstanceUID, dataset.FrameOfReferenceUID = uids
+    dataset.Modality = "CT"
+    dataset.PatientName = patient_name
+    dataset.PatientID = patient_name
+    dataset.PatientBirthDate = "19700101"
+    dataset.PatientSex = "O"
+    dataset.StudyDate = "20240101"
+    dataset.SeriesNumber = 1
+    dataset.InstanceNumber = k + 1
+    sx, sy, sz = spacing
+    dataset.ImagePositionPatient = [origin[0], origin[1], origin[2] + k * sz]
+    dataset.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+    dataset.PixelSpacing = [sy, sx]
+    dataset.SliceThickness = sz
+    dataset.SamplesPerPixel = 1
+    dataset.PhotometricInterpretation = "MONOCHROME2"
+    dataset.Rows, dataset.Columns = pixels.shape
+    dataset.BitsAllocated = 16
+    dataset.BitsStored = 16
+    dataset.HighBit = 15
+    dataset.PixelRepresentation = 1
+    dataset.RescaleIntercept = 0
+    dataset.RescaleSlope = 1
+    if transfer_syntax == "rle":
+        dataset.compress(RLELossless, pixels)
+    else:
+        dataset.PixelData = pixels.tobytes()
+    return dataset
+
+
+def write_phantom(dicom_folder, label_path, slices=128, size=256, spacing=(0.4, 0.4, 0.4),
+                  transfer_syntax="explicit", patient_name="PHANTOM", seed=0):
+    """
+    Writes one phantom as a DICOM series (one file per slice) in dicom_folder and its airway
+    label map as NIfTI in label_path, in the geometry SimpleITK gives the converted series.
+    Returns the number of airway voxels.
+    """
+    if transfer_syntax not in TRANSFER_SYNTAXES:
+        raise ValueError(f"Unknown transfer syntax {transfer_syntax!r}, expected one of {', '.join(TRANSFER_SYNTAXES)}")
+    os.makedirs(dicom_folder, exist_ok=True)
+    phantom = Phantom(slices, size, size, seed)
+    sx, sy, sz = spacing
+    origin = (-size * sx / 2, -size * sy / 2, -slices * sz / 2)
+    uids = (generate_uid(), generate_uid(), generate_uid())
+    # NIfTI keeps x fastest: (columns, rows, slices)
+    label = np.zeros((size, size, slices), dtype=np.uint8)
+    for k in range(slices):
+        pixels, airway = phantom.slice(k)
+        label[:, :, k] = airway.T
+        file_path = os.path.join(dicom_folder, f"slice_{k + 1:04d}.dcm")
+        _save_dataset(_slice_dataset(pixels, k, spacing, origin, transfer_syntax, uids, patient_name, file_path),
+                      file_path)
+
+    # DICOM is LPS, NIfTI RAS: x and y flip
+    affine = np.diag([-sx, -sy, sz, 1.0])
+    affine[:3, 3] = [-origin[0], -origin[1], origin[2]]
+    label_img = nib.Nifti1Image(label, affine)
+    label_img.set_qform(affine, code=1)
+    label_img.set_sform(affine, code=1)
+    os.makedirs(os.path.dirname(label_path), exist_ok=True)
+    nib.save(label_img, label_path)
+    return int(np.count_nonzero(label))
+
+
+def generate_dataset(output_folder, patients=2, time_points=(), slices=128, size=256, spacing=(0.4, 0.4, 0.4),
+                     transfer_syntax="explicit", seed=0):
+    """
+    Writes `patients` phantoms (one per time point, if any) under output_folder/DICOM and their
+    label maps under output_folder/Labels. Returns one dict per case: name, dicom_folder,
+    label_path, airway_voxels.
+    """
+    cases = []
+    dicom_root = os.path.join(output_folder, "DICOM")
+    for patient in range(1, patients + 1):
+        patient_name = f"Patient{patient:03d}"
+        for time_point in (time_points or [None]):
+            name = f"{patient_name}_{time_point}" if time_point else patient_name
+            dicom_folder = os.path.join(dicom_root, patient_name, *([time_point] if time_point else []))
+            label_path = os.path.join(output_folder, "Labels", f"{name}_seg.nii.gz")
+            airway_voxels = write_phantom(dicom_folder, label_path, slices, size, spacing, transfer_syntax,
+                                          patient_name, seed=seed + len(cases))
+            logging.info(f"Wrote phantom {name}: {slices} x {size} x {size}, {airway_voxels} airway voxels")
+            cases.append({"name": name, "dicom_folder": dicom_folder, "label_path": label_path,
+                          "airway_voxels": airway_voxels})
+    return cases
+
+
+class ThresholdPredictor:
+    """
+    Stand-in for predictor.AirwayPredictor on phantoms: labels the air enclosed by tissue
+    along each image row. Same predict() interface, runs on any CPU.
+    """
+
+    def __init__(self, slab_size=16):
+        self.slab_size = slab_size
+
+    def predict(self, image_path, seg_path, on_tiles=None):
+        image = nib.load(image_path)
+        data = np.asanyarray(image.dataobj)
+        label = np.zeros(data.shape[:3], dtype=np.uint8)
+        depth = data.shape[2]
+        for k in range(0, depth, self.slab_size):
+            tissue = data[:, :, k:k + self.slab_size] > AIR_THRESHOLD
+            # Air with tissue on both sides along x is inside the head
+            inside = np.logical_or.accumulate(tissue, axis=0) & np.logical_or.accumulate(tissue[::-1], axis=0)[::-1]
+            label[:, :, k:k + self.slab_size] = ~tissue & inside
+            if on_tiles is not None:
+                on_tiles(min(k + self.slab_size, depth), depth)
+        seg = nib.Nifti1Image(label, image.affine)
+        seg.set_qform(image.get_qform(), code=1)
+        seg.set_sform(image.get_sform(), code=1)
+        nib.save(seg, seg_path)
+
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Write synthetic CBCT DICOM series and airway label maps.")
+    parser.add_argument("output_folder")
+    parser.add_argument("--patients", type=int, default=2)
+    parser.add_argument("--time-points", nargs="*", default=[],
+                        help="Time point folders per patient, e.g. T1 T2 (default: DICOM directly in the patient folder)")
+    parser.add_argument("--slices", type=int, default=128)
+    parser.add_argument("--size", type=int, default=256, help="Rows and columns of every slice")
+    parser.add_argument("--spacing", type=float, nargs=3, default=[0.4, 0.4, 0.4], metavar=("X", "Y", "Z"))
+    parser.add_argument("--transfer-syntax", choices=TRANSFER_SYNTAXES, default="explicit")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+    generate_dataset(args.output_folder, args.patients, args.time_points, args.slices, args.size,
+                     tuple(args.spacing), args.transfer_syntax, args.seed)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
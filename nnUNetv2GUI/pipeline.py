@@ -0,0 +1,1006 @@
+"""
+Tk-free airway segmentation pipeline.
+
+Every stage that used to live inside UnifiedAirwaySegmentationGUI (anonymize and
+rename, DICOM to NIfTI conversion, nnUNet prediction, volume calculation and STL
+export) is implemented here as plain functions so it can be driven either by the
+GUI in main.py or headless by run_batch.py.
+
+The input folder is first split into cases (one scan each). Each case then flows
+through the selected stages on its own: every stage runs in its own worker thread
+and hands cases to the next stage through a bounded queue, so conversion and
+meshing of one case overlap with the prediction of another. Completed stages are
+recorded in a manifest (see manifest.py) so an interrupted run resumes where each
+case left off, and results are looked up in a content-addressed cache (see
+cache.py) so a scan processed before under the same settings is not redone.
+Prediction uses a model kept loaded in this process (see predictor.py) instead
+of starting nnUNetv2_predict for every case, and reports per-case and per-tile
+progress with an ETA through a `progress(event)` callback (see progress.py).
+
+User-facing messages are sent through a `notify(kind, title, message)` callback
+instead of messagebox. `kind` is one of "info", "warning" or "error". The default
+callback only logs. The GUI runs the pipeline on a worker thread and passes the
+notify and progress of an EventChannel (see progress.py), which it drains from Tk.
+"""
+import os
+import logging
+import queue
+import random
+import shutil
+import subprocess
+import threading
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+
+
+from anonymize import AnonymizationEngine
+from cache import ResultCache, checkpoint_identity, dicom_series_key, nifti_key, stage_key
+from discovery import INDEX_NAME, DicomIndex
+from instrumentation import StageRecorder, add_worker_metrics, measure_call
+from lazy_imports import lazy_import
+from manifest import RunManifest
+from meshing import DEFAULT_DECIMATION, DEFAULT_ENGINE, image_to_stl, image_to_stl_levels, lod_paths, mesh_file_path
+from postprocess import AIRWAY_LABEL, LabelMap
+from predictor import get_predictor, set_nnunet_environment
+from profiling import active_profile, profile_settings, profiled, profiled_call
+from progress import PredictionTracker, log_progress, parse_tile_progress
+from report import VolumeReport
+from stl_export import StlExportResult, describe_mesh_stats, plan_workers, set_vtk_threads, write_summary
+from volume import label_statistics
+
+# Imported on first use, see lazy_imports.py
+sitk = lazy_import("SimpleITK")
+vtk = lazy_import("vtk")
+
+# Number of cases allowed to wait between two stages
+QUEUE_SIZE = 2
+
+# Lines of nnUNetv2_predict output kept for the error message when it fails
+PREDICT_OUTPUT_TAIL = 50
+
+# Settings used for STL export, also part of the STL cache key
+STL_PARAMS = {"threshold_value": 1, "decimate": True, "decimate_target_reduction": 0.5,
+              "decimate_algorithm": DEFAULT_DECIMATION, "target_triangles": None, "max_file_mb": None,
+              "smooth_first": False}
+
+
+class PipelineError(Exception):
+    """Raised when a stage cannot continue (bad input folder, failed prediction...)."""
+
+
+def log_notify(kind, title, message):
+    """Default notify callback: route user-facing messages to the log."""
+    level = {"info": logging.INFO, "warning": logging.WARNING}.get(kind, logging.ERROR)
+    logging.log(level, f"{title}: {message}")
+
+
+def default_workers():
+    """Worker processes used for CPU-bound stages: all cores but one."""
+    return max(1, (os.cpu_count() or 2) - 1)
+
+
+def default_nnunet_paths():
+    """nnUNet raw/results/preprocessed folders, resolved the same way the GUI always has."""
+    nnunet_root = Path(os.getcwd()).parent.parent / 'nnUNet_training_v2'
+    return (
+        nnunet_root / 'nnUNet_raw',
+        nnunet_root / 'nnUNet_results',
+        nnunet_root / 'nnUNet_preprocessed',
+    )
+
+
+@dataclass
+class PipelineOptions:
+    """Options for one run of the pipeline, mirroring the switches in the GUI."""
+    input_folder: str
+    file_type: str = "DICOM"
+    rename_files: bool = False
+    convert_to_nifti: bool = False
+    run_prediction: bool = False
+    calculate_volume: bool = False
+    export_stl: bool = False
+    data_nickname: str = "UA"
+    starting_number: int = 1
+    nnunet_paths: tuple = field(default_factory=default_nnunet_paths)
+    use_cache: bool = True
+    cache_dir: str = None  # Defaults to AIRWAY_CACHE_DIR or ~/.airway_segmentator_cache
+    conversion_workers: int = field(default_factory=default_workers)
+    anonymize_workers: int = field(default_factory=default_workers)
+    anonymize_processes: bool = False  # True anonymizes with processes instead of threads
+    anonymize_header_only: bool = True  # False re-parses and re-writes the pixel data too
+    persistent_predictor: bool = True  # False runs nnUNetv2_predict in a new process per case
+    mesh_engine: str = DEFAULT_ENGINE  # Surface extraction engine, see meshing.ENGINES
+    decimate_algorithm: str = DEFAULT_DECIMATION  # See meshing.DECIMATIONS
+    target_triangles: int = None  # Decimate to at most this many triangles instead of by half
+    max_stl_mb: float = None  # Decimate so that each STL stays under this size
+    smooth_before_decimate: bool = False
+    lod_reductions: tuple = None  # e.g. (0.0, 0.5, 0.9): one STL per level of detail from a single extraction
+    mesh_format: str = "stl"  # Or an indexed format with shared vertices, see meshing.MESH_FORMATS
+    compress_meshes: bool = False  # gzip every mesh file (".stl.gz")
+    profile_stages: tuple = None  # Stages to profile into Diagnostics, defaults to AIRWAY_PROFILE, see profiling.py
+    profile_mode: str = None  # "cprofile" or "sampling", defaults to AIRWAY_PROFILE_MODE or cprofile
+
+
+@dataclass
+class Case:
+    """One scan moving through the pipeline, with the outputs each stage produced."""
+    name: str
+    source: str = None  # Path of the case relative to the input folder
+    dicom_folder: str = None
+    nifti_path: str = None
+    seg_path: str = None
+    volume: float = None
+    stl_path: str = None
+    label_stats: dict = None  # Airway voxels, bounding box and per-label counts of the label map
+    stl_paths: list = None  # Every STL of the case, one per level of detail (stl_path is the first)
+    mesh_stats: list = None  # Triangles, decimation time and size of each STL meshed in this run
+    error: str = None
+    image_key: str = None  # Cache key of the NIfTI image
+    label_key: str = None  # Cache key of the predicted segmentation
+
+    @property
+    def label_path(self):
+        """The label map volume/STL stages work on: the prediction if there is one, else the NIfTI input."""
+        return self.seg_path or self.nifti_path
+
+
+def get_output_folder(input_folder):
+    """
+    Returns the "_Processed" output folder for an input folder, creating it if needed.
+    If the input already lives inside a "_Processed" folder that folder is reused.
+    """
+    parent_dir = Path(input_folder).parent
+    if "_Processed" in parent_dir.name:
+        return str(parent_dir)
+    output_folder = os.path.join(parent_dir, f"{Path(input_folder).stem}_Processed")
+    os.makedirs(output_folder, exist_ok=True)
+    return output_folder
+
+
+class PipelineRun:
+    """
+    State shared by the stages of one run: options, output folders and the notify callback.
+    Each `*_case` method processes a single case and records its outputs on it.
+    """
+
+    def __init__(self, options, notify=log_notify, progress=log_progress):
+        self.options = options
+        self.notify = notify
+        self.progress = progress
+        self.prediction_tracker = None
+        self.input_folder = options.input_folder
+        self.output_folder = get_output_folder(options.input_folder)
+        self.renamed_folder = os.path.join(self.output_folder, "Renamed_Anonymized")
+        self.nifti_folder = os.path.join(self.output_folder, "NIfTI_Converted")
+        self.prediction_folder = os.path.join(self.output_folder, "Segmentations")
+        self.prediction_staging = os.path.join(self.output_folder, ".nnunet_input")
+        self.stl_folder = os.path.join(self.output_folder, "STL_Exports")
+        self.volume_report = VolumeReport(self.output_folder)
+        self.manifest = RunManifest(self.output_folder)
+        # Shared by discovery, anonymization, conversion and cache keys
+        self.dicom_index = DicomIndex(os.path.join(self.output_folder, INDEX_NAME))
+        self.cache = ResultCache(options.cache_dir) if options.use_cache else None
+        self._model_identity = None
+        self._process_pool = None
+        self._pool_lock = threading.Lock()
+        self.anonymizer = None
+        self._use_subprocess_prediction = not options.persistent_predictor
+        # Cases that redid a stage this run, their later stages cannot be skipped
+        self._redone = set()
+        self.recorder = StageRecorder()
+        self.profile = profile_settings(options.profile_stages, self.output_folder, options.profile_mode)
+
+    def stages(self):
+        """The (name, function) pairs selected by the options, in execution order."""
+        options = self.options
+        is_dicom = options.file_type == "DICOM"
+        stages = []
+        if options.rename_files:
+            stages.append(("anonymize", self.anonymize_case))
+        # Prediction needs NIfTI input, DICOM is converted automatically
+        if is_dicom and (options.convert_to_nifti or options.run_prediction):
+            if options.run_prediction and not options.convert_to_nifti:
+                logging.info('Automatically converting files from DICOM to NIfTI')
+            stages.append(("convert", self.convert_case))
+        if options.run_prediction:
+            stages.append(("predict", self.predict_case))
+        # Volume and STL share one read of the label map
+        if self.wants_volume() or options.export_stl:
+            stages.append(("postprocess", self.postprocess_case))
+        stages = [(name, self.resumable(name, self.instrumented(name, stage_fn))) for name, stage_fn in stages]
+        # Outside of resumable so resumed cases count towards the progress too
+        return [(name, self.track_prediction(stage_fn) if name == "predict" else stage_fn)
+                for name, stage_fn in stages]
+
+    def track_prediction(self, stage_fn):
+        """Wraps the prediction stage so every case leaving it, predicted or not, counts as done."""
+        def run_stage(case):
+            try:
+                stage_fn(case)
+            finally:
+                self.prediction_tracker.finish_case(case.name)
+        return run_stage
+
+    def prediction_skipped(self, upstream):
+        """
+        on_failure hook of run_streaming: a case that fails in one of the `upstream` stages
+        never reaches prediction, but counts as done there so the progress reaches the end.
+        """
+        def on_failure(case, stage_name):
+            if stage_name in upstream:
+                self.prediction_tracker.finish_case(case.name)
+        return on_failure
+
+    def instrumented(self, stage_name, stage_fn):
+        """Wraps a stage so its time, CPU, memory and I/O for each case go into the run report."""
+        # The model runs on torch's threads or in a nnUNetv2_predict process, not on the stage thread
+        cpu_scope = "process" if stage_name == "predict" else "thread"
+
+        def run_stage(case):
+            with self.measured(stage_name, case.name, cpu_scope):
+                stage_fn(case)
+        return run_stage
+
+    @contextmanager
+    def measured(self, stage_name, case_name=None, cpu_scope="thread"):
+        """Records the block as one stage sample, and profiles it when the stage is in the profile settings."""
+        with self.recorder.stage(stage_name, case_name, cpu_scope):
+            if self.profile is not None and self.profile.wants(stage_name):
+                with profiled(self.profile, f"{case_name or 'run'}_{stage_name}"):
+                    yield
+            else:
+                yield
+
+    def resumable(self, stage_name, stage_fn):
+        """Wraps a stage so it is skipped when the manifest shows it already completed with this run's settings."""
+        params, required = self.stage_params(stage_name), self.stage_required_outputs(stage_name)
+
+        def run_stage(case):
+            if case.name not in self._redone and self.manifest.completed(case, stage_name, params, required):
+                self.manifest.restore(case, stage_name)
+                logging.info(f"Skipping {stage_name} for {case.name}, already completed")
+                return
+            self._redone.add(case.name)
+            stage_fn(case)
+            self.manifest.record(case, stage_name, params)
+        return run_stage
+
+    def stage_params(self, stage_name):
+        """What a stage is asked to produce, recorded in the manifest: a stage that ran with other params is redone."""
+        if stage_name != "postprocess":
+            return None
+        # The digest covers the same mesh settings as the STL cache keys
+        return {"volume": self.wants_volume(), "stl": self.options.export_stl,
+                "mesh": stage_key(None, "stl", self.mesh_params()) if self.options.export_stl else None}
+
+    def stage_required_outputs(self, stage_name):
+        """Case attributes a completed stage must have recorded for this run."""
+        if stage_name != "postprocess":
+            return ()
+        return (("label_stats",) if self.wants_volume() else ()) + (("stl_paths",) if self.options.export_stl else ())
+
+    ## ------------ Case discovery ------------------------------ ##
+    def discover_cases(self):
+        """Splits the input folder into cases and writes the rename log when renaming."""
+        if self.options.file_type == "NIfTI":
+            return self.discover_nifti_cases()
+        cases = self.discover_dicom_cases()
+        self.dicom_index.save()
+        return cases
+
+    def discover_dicom_cases(self):
+        options = self.options
+        if options.rename_files:
+            folders = self.dicom_index.dicom_folders(self.input_folder)
+            if not folders:
+                self.notify("warning", "No Folders", "No DICOM folders containing files were found in the selected input directory.")
+                return []
+            mapping = randomized_mapping(folders, options.data_nickname, options.starting_number,
+                                         existing=self.manifest.source_names())
+            write_rename_log(self.renamed_folder, "Original Folder\tNew Folder", mapping)
+            return [
+                Case(name=new_name, source=relative_path, dicom_folder=os.path.join(self.input_folder, relative_path))
+                for relative_path, new_name in mapping.items()
+            ]
+
+        # Patient folders holding DICOM files, or patient/time-point folders
+        cases = []
+        index = self.dicom_index
+        for patient_folder in index.subfolders(self.input_folder):
+            patient_path = os.path.join(self.input_folder, patient_folder)
+            if index.contains_dicom(patient_path):
+                cases.append(Case(name=patient_folder, source=patient_folder, dicom_folder=patient_path))
+                continue
+            for time_point in index.subfolders(patient_path):
+                time_point_path = os.path.join(patient_path, time_point)
+                if index.contains_dicom(time_point_path):
+                    cases.append(Case(name=f"{patient_folder}_{time_point}", source=os.path.join(patient_folder, time_point),
+                                      dicom_folder=time_point_path))
+                else:
+                    logging.warning(f"No DICOM files found in {time_point_path}. Skipping.")
+        return cases
+
+    def discover_nifti_cases(self):
+        options = self.options
+        if options.rename_files:
+            nifti_files = [
+                os.path.relpath(os.path.join(root, file_name), self.input_folder)
+                for root, _, files in os.walk(self.input_folder)
+                for file_name in files if file_name.endswith('.nii.gz')
+            ]
+            if not nifti_files:
+                self.notify("warning", "No Files", "No NIfTI files found in the selected input directory.")
+                return []
+            mapping = randomized_mapping(nifti_files, options.data_nickname, options.starting_number,
+                                         existing=self.manifest.source_names())
+            write_rename_log(self.renamed_folder, "Original File\tNew File", mapping)
+            return [
+                Case(name=new_name, source=relative_path, nifti_path=os.path.join(self.input_folder, relative_path))
+                for relative_path, new_name in mapping.items()
+            ]
+
+        return [
+            Case(name=strip_nifti_suffix(file_name), source=file_name, nifti_path=os.path.join(self.input_folder, file_name))
+            for file_name in sorted(os.listdir(self.input_folder))
+            if file_name.endswith(('.nii', '.nii.gz'))
+        ]
+
+    ## ------------ Per-case stages ------------------------------ ##
+    def anonymize_case(self, case):
+        """Anonymized copy of the case under Renamed_Anonymized, named after the case."""
+        if case.nifti_path:
+            os.makedirs(self.renamed_folder, exist_ok=True)
+            new_file_path = os.path.join(self.renamed_folder, f"{case.name}.nii.gz")
+            shutil.copyfile(case.nifti_path, new_file_path)
+            logging.info(f"Renamed {case.nifti_path} to {new_file_path}")
+            case.nifti_path = new_file_path
+            return
+
+        new_folder_path = os.path.join(self.renamed_folder, case.name)
+        logging.info(f"Renaming folder {case.dicom_folder} to {case.name}")
+        # Failed files are reported once for the whole run, see report_anonymization_failures
+        self.anonymizer.anonymize_folder(case.dicom_folder, new_folder_path, case.name,
+                                         file_names=self.dicom_index.dicom_files(case.dicom_folder))
+        case.dicom_folder = new_folder_path
+
+    def convert_case(self, case):
+        os.makedirs(self.nifti_folder, exist_ok=True)
+        if self.cache:
+            file_names = self.dicom_index.dicom_files(case.dicom_folder)
+            case.image_key = stage_key(self.run_in_pool(dicom_series_key, case.dicom_folder, file_names), "convert")
+            nifti_path = os.path.join(self.nifti_folder, get_nifti_filename(case.name))
+            if self.cache.get_file(case.image_key, nifti_path):
+                case.nifti_path = nifti_path
+                return
+
+        series_files = list(self.dicom_index.series(case.dicom_folder).values())
+        nifti_path = self.run_in_pool(process_dicom_series, case.dicom_folder, self.nifti_folder, case.name,
+                                      None, False, series_files)
+        if nifti_path is None:
+            raise PipelineError(f"No DICOM series found in {case.dicom_folder}")
+        case.nifti_path = nifti_path
+        if self.cache:
+            self.cache.put_file(case.image_key, nifti_path)
+
+    def load_predictor(self):
+        """
+        The shared in-process nnUNet predictor. Returns None, and switches this run to
+        nnUNetv2_predict subprocesses, if nnunetv2 cannot be imported here.
+        """
+        set_nnunet_environment(self.options.nnunet_paths)
+        try:
+            return get_predictor(self.results_folder())
+        except ImportError as e:
+            logging.warning(f"In-process nnUNet unavailable ({e}), falling back to nnUNetv2_predict")
+            self._use_subprocess_prediction = True
+            return None
+        except FileNotFoundError as e:
+            raise PipelineError(str(e)) from e
+
+    def predict_case(self, case):
+        """Runs nnUNet on this case alone and stores the result as <name>_seg.nii.gz."""
+        os.makedirs(self.prediction_folder, exist_ok=True)
+        seg_path = os.path.join(self.prediction_folder, f"{case.name}_seg.nii.gz")
+        if self.cache:
+            case.label_key = stage_key(self.image_key(case), "predict", self.model_identity())
+            if self.cache.get_file(case.label_key, seg_path):
+                case.seg_path = seg_path
+                return
+
+        tracker = self.prediction_tracker
+        if not self._use_subprocess_prediction:
+            predictor = self.load_predictor()
+            if predictor is not None:
+                tracker.start_case(case.name)
+                try:
+                    predictor.predict(case.nifti_path, seg_path, on_tiles=tracker.update_tiles)
+                except Exception as e:
+                    raise PipelineError(f"Failed to run nnUNet prediction: {e}") from e
+                logging.info(f"Predicted {case.name} to {seg_path}")
+                case.seg_path = seg_path
+                if self.cache:
+                    self.cache.put_file(case.label_key, seg_path)
+                return
+
+        # Stage the input under the nnUNet channel name without touching the original file
+        case_input = os.path.join(self.prediction_staging, case.name)
+        os.makedirs(case_input, exist_ok=True)
+        staged_path = os.path.join(case_input, f"{case.name}_0000.nii.gz")
+        if not os.path.exists(staged_path):
+            try:
+                os.link(case.nifti_path, staged_path)
+            except OSError:
+                shutil.copyfile(case.nifti_path, staged_path)
+
+        tracker.start_case(case.name)
+        try:
+            run_nnunet_prediction(case_input, self.prediction_folder, self.options.nnunet_paths,
+                                  on_tiles=tracker.update_tiles)
+        finally:
+            shutil.rmtree(case_input, ignore_errors=True)
+            remove_nnunet_internal(self.prediction_folder)
+
+        predicted_path = os.path.join(self.prediction_folder, f"{case.name}.nii.gz")
+        os.replace(predicted_path, seg_path)
+        logging.info(f"Renamed {case.name}.nii.gz to {case.name}_seg.nii.gz")
+        case.seg_path = seg_path
+        if self.cache:
+            self.cache.put_file(case.label_key, seg_path)
+
+    def stl_params(self):
+        """STL settings of this run, also part of the STL cache key."""
+        options = self.options
+        return dict(STL_PARAMS, engine=options.mesh_engine, decimate_algorithm=options.decimate_algorithm,
+                    target_triangles=options.target_triangles, max_file_mb=options.max_stl_mb,
+                    smooth_first=options.smooth_before_decimate)
+
+    def stl_file_paths(self, base_name):
+        """The case's mesh file, or its "_lod<n>" files when levels of detail are exported."""
+        stl_file_path = mesh_file_path(os.path.join(self.stl_folder, base_name), self.options.mesh_format,
+                                       self.options.compress_meshes)
+        lods = self.options.lod_reductions
+        return lod_paths(stl_file_path, len(lods)) if lods else [stl_file_path]
+
+    def mesh_params(self):
+        """Every setting that shapes the mesh files: part of the STL cache keys and of the manifest record."""
+        params = self.stl_params()
+        if self.options.mesh_format != "stl" or self.options.compress_meshes:
+            params.update(mesh_format=self.options.mesh_format, compress=self.options.compress_meshes)
+        if self.options.lod_reductions:
+            params["lod_reductions"] = list(self.options.lod_reductions)
+        return params
+
+    def stl_cache_keys(self, label_key):
+        """Cache key of each mesh file of a case, in stl_file_paths order."""
+        params = self.mesh_params()
+        lods = self.options.lod_reductions
+        if not lods:
+            return [stage_key(label_key, "stl", params)]
+        return [stage_key(label_key, "stl", dict(params, level=level)) for level in range(len(lods))]
+
+    def pool_initializer(self):
+        """
+        (initializer, initargs) of the process pool. With STL export any worker may mesh a label
+        map, so like export_stl_files each caps VTK's SMP threads to its share of the cores.
+        """
+        if not self.options.export_stl:
+            return None, ()
+        workers = self.options.conversion_workers
+        _, vtk_threads = plan_workers(workers, workers)
+        return set_vtk_threads, (vtk_threads,)
+
+    def wants_volume(self):
+        # Volumes are always reported after a prediction
+        return self.options.calculate_volume or self.options.run_prediction
+
+    def postprocess_case(self, case):
+        """
+        Airway volume and label statistics and/or the STL mesh of the case's label map.
+        Whatever is not in the cache is computed from a single read of the label map.
+        """
+        if not case.label_path:
+            return
+        want_volume = self.wants_volume()
+        want_stl = self.options.export_stl
+        base_name = strip_nifti_suffix(os.path.basename(case.label_path))
+        stl_file_paths = self.stl_file_paths(base_name)
+        if want_stl:
+            os.makedirs(self.stl_folder, exist_ok=True)
+
+        stats_key = stl_keys = None
+        if self.cache:
+            label_key = self.label_key(case)
+            if want_volume:
+                stats_key = stage_key(label_key, "label_stats", {"airway_label": AIRWAY_LABEL})
+                stats = self.cache.get_value(stats_key)
+                if stats is not None:
+                    case.label_stats = stats
+            if want_stl:
+                stl_keys = self.stl_cache_keys(label_key)
+                if all(self.cache.get_file(key, path) for key, path in zip(stl_keys, stl_file_paths)):
+                    case.stl_path, case.stl_paths = stl_file_paths[0], stl_file_paths
+
+        need_stats = want_volume and case.label_stats is None
+        need_stl = want_stl and case.stl_path is None
+        if need_stl:
+            logging.info(f"Exporting {case.label_path} to {', '.join(stl_file_paths)}")
+            try:
+                # The statistics come from the same read of the label map as the mesh
+                with self.measured("stl", case.name):
+                    stats, case.mesh_stats = self.run_in_pool(postprocess_label_map, case.label_path, need_stats,
+                                                              stl_file_paths, self.stl_params(),
+                                                              self.options.lod_reductions)
+            except PipelineError:
+                raise
+            except Exception as e:
+                raise PipelineError(f"Failed to convert {case.label_path} to STL. Error: {e}") from e
+            logging.info(f"Exported {case.name}{describe_mesh_stats(case.mesh_stats)}")
+            case.stl_path, case.stl_paths = stl_file_paths[0], stl_file_paths
+            if self.cache:
+                for key, path in zip(stl_keys, stl_file_paths):
+                    self.cache.put_file(key, path)
+            if need_stats:
+                case.label_stats = stats
+        elif need_stats:
+            try:
+                # Without a mesh to build, the label map is streamed in a worker process
+                with self.measured("volume", case.name):
+                    case.label_stats = self.run_in_pool(label_statistics, case.label_path)
+            except PipelineError:
+                raise
+            except Exception as e:
+                raise PipelineError(f"Failed to calculate the volume of {case.label_path}. Error: {e}") from e
+
+        if need_stats:
+            logging.info(f"{case.name}: {case.label_stats['airway_voxels']} airway voxels, "
+                         f"{case.label_stats['volume']:.2f} mm³, bounding box {case.label_stats['bbox']}")
+            if self.cache:
+                self.cache.put_value(stats_key, case.label_stats)
+        if want_volume:
+            case.volume = case.label_stats["volume"]
+            self.volume_report.append(os.path.basename(case.label_path), case.name, case.label_stats)
+
+    def report_anonymization_failures(self):
+        """One message for all files that could not be anonymized, with the full list written to disk."""
+        failures = self.anonymizer.failures
+        if not failures:
+            return
+        report_path = self.anonymizer.write_failure_report(self.renamed_folder)
+        examples = "\n".join(f"{os.path.basename(path)}: {error}" for path, error in failures[:5])
+        self.notify("error", "Renaming Error",
+                    f"Failed to anonymize {len(failures)} file(s). First failures:\n{examples}\n\nFull list: {report_path}")
+
+    def write_stl_summary(self, cases):
+        """stl_export_summary.txt in the STL folder; STL files reused from the cache have no mesh statistics."""
+        results = [StlExportResult(case.label_path, case.stl_path,
+                                   seconds=sum(v for stats in case.mesh_stats or [] for k, v in stats.items()
+                                               if k.endswith("_seconds")),
+                                   mesh_stats=case.mesh_stats)
+                   for case in cases if case.stl_path]
+        if results:
+            write_summary(results, self.stl_folder)
+
+    def complete_volume_report(self, cases):
+        """
+        Adds the cases resumed from an earlier run that are missing from the volume report,
+        then writes the CSV sorted by filename with one row per file.
+        """
+        recorded = self.volume_report.recorded()
+        for case in cases:
+            if case.label_stats is not None and os.path.basename(case.label_path) not in recorded:
+                self.volume_report.append(os.path.basename(case.label_path), case.name, case.label_stats)
+        self.volume_report.write_sorted_csv()
+        logging.info(f"Volume calculations saved to {self.volume_report.csv_path}")
+
+    ## ------------ Process pool ------------------------------ ##
+    def run_in_pool(self, fn, *args):
+        """
+        Runs fn(*args) in the run's process pool and waits for the result. If a worker
+        dies (e.g. a crash inside ITK) only the case that hit it fails: the pool is
+        replaced for the cases that follow. Inside a profiled stage fn is profiled in the worker.
+        """
+        with self._pool_lock:
+            if self._process_pool is None:
+                initializer, initargs = self.pool_initializer()
+                self._process_pool = ProcessPoolExecutor(max_workers=self.options.conversion_workers,
+                                                         initializer=initializer, initargs=initargs)
+            pool = self._process_pool
+        active = active_profile()
+        if active is not None:
+            fn, args = profiled_call, (*active, fn, *args)
+        try:
+            result, metrics = pool.submit(measure_call, fn, *args).result()
+        except BrokenProcessPool:
+            with self._pool_lock:
+                if self._process_pool is pool:
+                    self._process_pool = None
+            pool.shutdown(wait=False)
+            raise PipelineError("Worker process crashed")
+        # The work counts towards the stage that submitted it
+        add_worker_metrics(metrics)
+        return result
+
+    def shutdown_pool(self):
+        with self._pool_lock:
+            if self._process_pool is not None:
+                self._process_pool.shutdown()
+                self._process_pool = None
+
+    ## ------------ Cache keys ------------------------------ ##
+    def image_key(self, case):
+        """Cache key of the case's NIfTI image, hashed from the file if no stage set it."""
+        if case.image_key is None:
+            case.image_key = nifti_key(case.nifti_path)
+        return case.image_key
+
+    def label_key(self, case):
+        """Cache key of the label map the volume and STL stages work on."""
+        if case.seg_path is None:
+            return self.image_key(case)
+        if case.label_key is None:
+            case.label_key = nifti_key(case.seg_path)
+        return case.label_key
+
+    def model_identity(self):
+        if self._model_identity is None:
+            self._model_identity = checkpoint_identity(self.results_folder())
+        return self._model_identity
+
+    def results_folder(self):
+        return os.environ.get('nnUNet_results', str(self.options.nnunet_paths[1]))
+
+    ## ------------ Driver ------------------------------ ##
+    def run(self):
+        """Streams every case through the selected stages and writes the volume and run reports."""
+        with self.measured("discovery"):
+            cases = self.discover_cases()
+        for case in cases:
+            self.manifest.register_case(case, case.source)
+        stages = self.stages()
+        stage_names = [name for name, _ in stages]
+        on_failure = None
+        if "predict" in stage_names:
+            self.prediction_tracker = PredictionTracker(len(cases), self.progress)
+            on_failure = self.prediction_skipped(set(stage_names[:stage_names.index("predict")]))
+        if cases and stages:
+            if self.options.rename_files and self.options.file_type == "DICOM":
+                self.anonymizer = AnonymizationEngine(self.options.anonymize_workers,
+                                                      use_processes=self.options.anonymize_processes,
+                                                      header_only=self.options.anonymize_header_only)
+            # Conversion and postprocessing run in the process pool, one stage thread per
+            # worker keeps it busy; the next case's files are queued while the previous
+            # case's finish anonymizing
+            stage_workers = {"convert": self.options.conversion_workers, "anonymize": 2,
+                             "postprocess": self.options.conversion_workers}
+            try:
+                run_streaming(cases, stages, self.notify, stage_workers=stage_workers, on_failure=on_failure)
+            finally:
+                self.shutdown_pool()
+                self.dicom_index.save()
+                if self.anonymizer is not None:
+                    self.anonymizer.close()
+                    self.report_anonymization_failures()
+            shutil.rmtree(self.prediction_staging, ignore_errors=True)
+            log_summary(cases)
+            if self.options.export_stl:
+                self.write_stl_summary(cases)
+        if self.wants_volume():
+            self.complete_volume_report(cases)
+        self.recorder.write_report(self.output_folder, cases=len(cases),
+                                   failed=sum(1 for case in cases if case.error), options=asdict(self.options))
+        return cases
+
+
+def run_pipeline(options, notify=log_notify, progress=log_progress):
+    """
+    Runs the selected stages on `options.input_folder`. `progress` receives a
+    PredictionProgress event whenever prediction starts or finishes a case or
+    advances through its tiles.
+
+    Returns:
+    - output_folder (str): the "_Processed" folder holding all results
+    """
+    if not os.path.isdir(options.input_folder):
+        raise PipelineError("Invalid input folder.")
+    run = PipelineRun(options, notify=notify, progress=progress)
+    run.run()
+    return run.output_folder
+
+
+# Marks the end of the case stream in the stage queues
+_DONE = object()
+
+
+def run_streaming(cases, stages, notify=log_notify, queue_size=QUEUE_SIZE, stage_workers=None, on_failure=None):
+    """
+    Pushes each case through `stages` independently. Every stage has its own worker
+    thread(s) reading from a bounded queue, so a slow stage only holds back the cases
+    behind it. `stage_workers` maps a stage name to its number of threads (default 1).
+    A case whose stage fails is marked with the error and skips the remaining stages;
+    `on_failure(case, stage_name)` is then called, if given.
+    """
+    stage_workers = stage_workers or {}
+    # The last queue collects finished cases and is drained after feeding, so it is unbounded
+    queues = [queue.Queue(maxsize=queue_size) for _ in stages] + [queue.Queue()]
+    remaining = {name: max(1, stage_workers.get(name, 1)) for name, _ in stages}
+    remaining_lock = threading.Lock()
+
+    def worker(stage_name, stage_fn, q_in, q_out):
+        while True:
+            case = q_in.get()
+            if case is _DONE:
+                # Let the other threads of this stage see the end too; the last one passes it on
+                with remaining_lock:
+                    remaining[stage_name] -= 1
+                    last = remaining[stage_name] == 0
+                if last:
+                    q_out.put(_DONE)
+                else:
+                    q_in.put(_DONE)
+                return
+            if case.error is None:
+                try:
+                    stage_fn(case)
+                except Exception as e:
+                    case.error = f"{stage_name}: {e}"
+                    logging.error(f"Case {case.name} failed during {stage_name}: {e}")
+                    notify("error", "Processing Error", f"{case.name} failed during {stage_name}. Error: {e}")
+                    if on_failure is not None:
+                        on_failure(case, stage_name)
+            q_out.put(case)
+
+    workers = [
+        threading.Thread(target=worker, args=(name, fn, queues[i], queues[i + 1]), name=f"pipeline-{name}-{n}", daemon=True)
+        for i, (name, fn) in enumerate(stages)
+        for n in range(remaining[name])
+    ]
+    for thread in workers:
+        thread.start()
+
+    for case in cases:
+        queues[0].put(case)
+    queues[0].put(_DONE)
+
+    while (case := queues[-1].get()) is not _DONE:
+        if case.error is None:
+            logging.info(f"Finished case {case.name}")
+    for thread in workers:
+        thread.join()
+    return cases
+
+
+def log_summary(cases):
+    """Logs one line per case, in discovery order, with its outputs or the error that stopped it."""
+    failed = [case for case in cases if case.error]
+    logging.info(f"Processed {len(cases) - len(failed)} of {len(cases)} case(s) successfully")
+    for case in cases:
+        if case.error:
+            logging.info(f"  {case.name}: FAILED ({case.error})")
+        else:
+            outputs = [path for path in (case.nifti_path, case.seg_path, *(case.stl_paths or [case.stl_path])) if path]
+            volume = f", {case.volume:.2f} mm^3" if case.volume is not None else ""
+            logging.info(f"  {case.name}: {', '.join(os.path.basename(p) for p in outputs)}{volume}")
+
+
+## ------------------------------------------------------- ##
+## ------------ Anonymize and Rename --------------------- ##
+## ------------------------------------------------------- ##
+def randomized_mapping(items, data_nickname, starting_number, existing=None):
+    """
+    Maps each item to a unique "<nickname>_<index>" name, with indices assigned in random order.
+    Items already named in `existing` (from a previous run with the same nickname) keep their name.
+    """
+    existing = existing or {}
+    mapping = {
+        item: existing[item] for item in items
+        if item in existing and existing[item].startswith(f"{data_nickname}_")
+    }
+    used = set(mapping.values())
+
+    # Hand out the lowest free indices to the new items, in random order
+    new_items = [item for item in items if item not in mapping]
+    indices = []
+    index = starting_number
+    while len(indices) < len(new_items):
+        if f"{data_nickname}_{index}" not in used:
+            indices.append(index)
+        index += 1
+    random.shuffle(indices)
+    mapping.update({item: f"{data_nickname}_{index}" for item, index in zip(new_items, indices)})
+    return mapping
+
+
+def write_rename_log(destination_dir, header, mapping):
+    """Writes rename_log.txt with the mapping sorted alphabetically by original name."""
+    os.makedirs(destination_dir, exist_ok=True)
+    rename_log_path = os.path.join(destination_dir, "rename_log.txt")
+    with open(rename_log_path, 'w') as log_file:
+        log_file.write(f"{header}\n")
+        for original, new_name in sorted(mapping.items()):
+            log_file.write(f"{original}\t{new_name}\n")
+    return rename_log_path
+
+
+## ------------------------------------------------------- ##
+## ------------ DICOM to NIfTI --------------------------- ##
+## ------------------------------------------------------- ##
+def process_dicom_series(dicom_folder, nifti_folder, patient_name, time_point=None, rename_enabled=False,
+                         series_files=None):
+    """
+    Reads every DICOM series in `dicom_folder` and writes it to `nifti_folder` as NIfTI.
+    `series_files` (one list of slice paths per series, e.g. from DicomIndex.series)
+    saves GDCM from rescanning the folder; without it the series are looked up with GDCM.
+
+    Returns:
+    - nifti_path (str): path of the written file, None if the folder held no series
+    """
+    reader = sitk.ImageSeriesReader()
+    if series_files is None:
+        series_files = [reader.GetGDCMSeriesFileNames(dicom_folder, series_id)
+                        for series_id in reader.GetGDCMSeriesIDs(dicom_folder)]
+    if not series_files:
+        logging.warning(f"No DICOM series found in {dicom_folder}. Skipping.")
+        return None
+
+    nifti_path = None
+    for dicom_names in series_files:
+        reader.SetFileNames(dicom_names)
+
+        # Ensure no interpolation or resampling
+        reader.MetaDataDictionaryArrayUpdateOn()
+        image = reader.Execute()
+
+        # Correct potential flipping in direction
+        direction = image.GetDirection()
+        if direction[8] < 0:
+            image = sitk.Flip(image, [False, False, True])
+            logging.info(f"Flipped image. New voxel spacing (x, y, z): {image.GetSpacing()}")
+
+        # Save as NIfTI
+        nifti_filename = get_nifti_filename(patient_name, time_point, rename_enabled=rename_enabled)
+        nifti_path = os.path.join(nifti_folder, nifti_filename)
+        sitk.WriteImage(image, nifti_path)
+    return nifti_path
+
+
+def get_nifti_filename(patient_name, time_point=None, rename_enabled=False):
+    """
+    Constructs the NIfTI filename based on the provided patient name and time point.
+    Avoids duplicating time_point if already included in patient_name.
+    """
+    if rename_enabled:
+        # If renaming, avoid appending if time_point is already part of patient_name
+        if time_point and time_point not in patient_name:
+            return f"{patient_name}_{time_point}.nii.gz"
+        return f"{patient_name}.nii.gz"
+    if time_point:
+        return f"{patient_name}_{time_point}.nii.gz"
+    return f"{patient_name}.nii.gz"
+
+
+def strip_nifti_suffix(file_name):
+    """Case name of a NIfTI file: drops .nii/.nii.gz and the nnUNet channel suffix."""
+    base_name = os.path.splitext(os.path.splitext(file_name)[0])[0]
+    if base_name.endswith('_0000'):
+        base_name = base_name[:-len('_0000')]
+    return base_name
+
+
+## ------------------------------------------------------- ##
+## ------------ nnUNet Prediction ------------------------ ##
+## ------------------------------------------------------- ##
+def run_nnunet_prediction(nnUNet_IN, nnUNet_OUT, nnunet_paths=None, on_tiles=None):
+    """
+    Runs nnUNetv2_predict (dataset 14, 3d_fullres, fold all) on every case in nnUNet_IN.
+    Its output is logged line by line as it arrives; the sliding-window progress bars
+    in it are passed to `on_tiles(done, total)`. Raises PipelineError if the prediction fails.
+    """
+    if not nnUNet_IN or not nnUNet_OUT:
+        raise PipelineError("Path to CBCT files in NIfTI format and/or Predictions folder not selected/valid")
+
+    set_nnunet_environment(nnunet_paths or default_nnunet_paths())
+
+    suffix_files(nnUNet_IN)
+
+    # Only the end of the output is kept, for the error message
+    tail = deque(maxlen=PREDICT_OUTPUT_TAIL)
+    try:
+        # Text mode splits on the carriage returns tqdm redraws its bar with, too
+        with subprocess.Popen([
+            'nnUNetv2_predict', '-i', nnUNet_IN, '-o', nnUNet_OUT,
+            '-d', '14', '-c', '3d_fullres', '-f', 'all',
+        ], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, bufsize=1) as process:
+            for line in process.stdout:
+                line = line.rstrip()
+                if not line:
+                    continue
+                tiles = parse_tile_progress(line)
+                if tiles is not None:
+                    if on_tiles is not None:
+                        on_tiles(*tiles)
+                    continue
+                logging.info('nnUNet: %s', line)
+                tail.append(line)
+        if process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, process.args, output="\n".join(tail))
+    except subprocess.CalledProcessError as e:
+        logging.error("Error: %s", e.output)
+        raise PipelineError(f"Failed to run nnUNet prediction: {e.output}") from e
+    except Exception as e:
+        logging.error("Unexpected error: %s", str(e))
+        raise PipelineError(f"An unexpected error occurred: {str(e)}") from e
+
+
+def suffix_files(nnUNet_IN):
+    """Adds the nnUNet channel suffix (_0000) to every NIfTI file that lacks it."""
+    nifti_files = [f for f in os.scandir(nnUNet_IN) if f.name.endswith(('.nii', '.nii.gz'))]
+    for nifti_file in nifti_files:
+        base_name, ext = os.path.splitext(nifti_file.name)
+        if ext == ".gz":
+            base_name, ext2 = os.path.splitext(base_name)
+            ext = ext2 + ext
+        if not base_name.endswith('_0000'):
+            new_name = f"{base_name}_0000{ext}"
+            new_path = Path(nnUNet_IN) / new_name
+            if not new_path.exists():
+                logging.info(f"Renaming NIfTI file {nifti_file.name} to {new_name}")
+                os.rename(nifti_file.path, new_path)
+
+
+def remove_nnunet_internal(nnUNet_OUT):
+    """Removes the .json bookkeeping files nnUNet leaves in its output folder."""
+    for filename in os.listdir(nnUNet_OUT):
+        if filename.endswith('.json'):
+            file_path = os.path.join(nnUNet_OUT, filename)
+            os.remove(file_path)
+            logging.info(f"Removed: {file_path}")
+
+
+## ------------------------------------------------------- ##
+## ------------ STL Creation ----------------------------- ##
+## ------------------------------------------------------- ##
+def postprocess_label_map(label_path, with_stats, mesh_paths, mesh_params, lod_reductions=None):
+    """
+    Meshes a label map to mesh_paths (one per level of detail, if any) from a single read, with its
+    label statistics when with_stats is set. Module-level so it runs in the process pool: a mesh needs
+    the whole label map in memory, which stays in the worker. Returns (label stats or None, mesh stats per file).
+    """
+    label_map = LabelMap(label_path)
+    stats = label_map.statistics() if with_stats else None
+    ijk_to_ras, mirrored = label_map.ijk_to_ras()
+    if lod_reductions:
+        # One extraction, every level decimated from it
+        params = {k: v for k, v in mesh_params.items() if k not in ("decimate", "decimate_target_reduction")}
+        mesh_stats = image_to_stl_levels(label_map.to_vtk_image(), ijk_to_ras, mesh_paths, list(lod_reductions),
+                                         flip_normals=mirrored, **params)
+    else:
+        mesh_stats = [image_to_stl(label_map.to_vtk_image(), ijk_to_ras, mesh_paths[0], flip_normals=mirrored,
+                                   **mesh_params)]
+    return stats, mesh_stats
+
+
+def nifti_to_stl(nifti_file_path, stl_file_path, threshold_value=1, decimate=True, decimate_target_reduction=0.5,
+                 engine=DEFAULT_ENGINE, lod_reductions=None, **mesh_options):
+    """
+    Extracts the label surface from a NIfTI segmentation and writes it as a binary STL in RAS coordinates
+    (or PLY, OBJ or GLB, optionally gzipped, as the extension of stl_file_path says).
+    With lod_reductions, one "_lod<n>" file per reduction is written from that single extraction instead.
+    mesh_options are the decimation settings of meshing.image_to_stl. Returns the mesh statistics
+    of every file written. Raises on failure, callers decide how to report it.
+    """
+    # Load NIfTI file
+    reader = vtk.vtkNIFTIImageReader()
+    reader.SetFileName(nifti_file_path)
+    reader.Update()
+    if lod_reductions:
+        return image_to_stl_levels(reader.GetOutput(), reader.GetQFormMatrix(),
+                                   lod_paths(stl_file_path, len(lod_reductions)), list(lod_reductions),
+                                   threshold_value=threshold_value, engine=engine, **mesh_options)
+    return [image_to_stl(reader.GetOutput(), reader.GetQFormMatrix(), stl_file_path, threshold_value=threshold_value,
+                         decimate=decimate, decimate_target_reduction=decimate_target_reduction, engine=engine,
+                         **mesh_options)]
+
@@ -0,0 +1,74 @@
+"""
+Single-read post-processing of segmentations.
+
+Volume calculation and STL export used to read every segmentation separately
+(nibabel for the volume, vtkNIFTIImageReader for the mesh), so each label map
+was decompressed twice. Here a segmentation is loaded once, in its stored
+dtype; the airway volume, bounding box and per-label voxel counts are computed
+chunk by chunk from that array, and the same buffer is wrapped as vtkImageData
+(no copy) for mesh extraction.
+"""
+from lazy_imports import lazy_import
+from volume import AIRWAY_LABEL, VOLUME_CHUNK_SIZE, statistics_from_chunks
+
+nib = lazy_import("nibabel")
+np = lazy_import("numpy")
+vtk = lazy_import("vtk")
+numpy_support = lazy_import("vtk.util.numpy_support")
+
+
+class LabelMap:
+    """A segmentation held in memory: voxels in stored dtype (x fastest), zooms and qform."""
+
+    def __init__(self, path):
+        img = nib.load(path)
+        data = np.asanyarray(img.dataobj)
+        # Label maps are 3D, drop trailing singleton dimensions some writers add
+        while data.ndim > 3 and data.shape[-1] == 1:
+            data = data[..., 0]
+        if not data.dtype.isnative:
+            data = data.astype(data.dtype.newbyteorder("="))
+        self.path = path
+        self.data = data
+        self.zooms = tuple(float(z) for z in img.header.get_zooms()[:3])
+        self.qform = img.header.get_qform()
+
+    def statistics(self, airway_label=AIRWAY_LABEL, chunk_size=VOLUME_CHUNK_SIZE):
+        """Airway volume, bounding box and label counts (see volume.statistics_from_chunks)."""
+        flat = self.data.ravel(order="F")
+        step = max(1, chunk_size // self.data.dtype.itemsize)
+        chunks = (flat[start:start + step] for start in range(0, flat.size, step))
+        return statistics_from_chunks(chunks, self.data.shape, self.zooms, airway_label)
+
+    def to_vtk_image(self):
+        """
+        The voxels as vtkImageData with the zooms as spacing and origin 0, like
+        vtkNIFTIImageReader produces. The VTK array shares the numpy buffer.
+        """
+        data = self.data
+        if not data.flags.f_contiguous:
+            data = np.asfortranarray(data)
+        scalars = numpy_support.numpy_to_vtk(data.ravel(order="F"), deep=False)
+        image = vtk.vtkImageData()
+        image.SetDimensions(*data.shape)
+        image.SetSpacing(*self.zooms)
+        image.SetOrigin(0.0, 0.0, 0.0)
+        # numpy_to_vtk keeps a reference to `data`, so the buffer lives as long as the image
+        image.GetPointData().SetScalars(scalars)
+        return image
+
+    def ijk_to_ras(self):
+        """
+        vtkMatrix4x4 from image coordinates (index * spacing) to the qform space, and
+        whether it mirrors (negative qfac), in which case mesh normals must be flipped.
+        vtkNIFTIImageReader reverses the slices instead; the surface is the same.
+        """
+        zooms = np.array([z if z else 1.0 for z in self.zooms])
+        matrix = np.array(self.qform, dtype=float)
+        matrix[:3, :3] = matrix[:3, :3] / zooms
+        vtk_matrix = vtk.vtkMatrix4x4()
+        for row in range(4):
+            for col in range(4):
+                vtk_matrix.SetElement(row, col, matrix[row, col])
+        return vtk_matrix, bool(np.linalg.det(matrix[:3, :3]) < 0)
+
@@ -0,0 +1,131 @@
+"""
+Long-lived nnUNet predictor for the airway model (dataset 14, 3d_fullres, fold all).
+
+nnUNetv2_predict starts a new interpreter for every call, imports torch, reads the
+plans and deserializes the checkpoint before it looks at a single voxel, which
+dominates the small batches this tool usually runs. AirwayPredictor loads the
+model once and keeps it in memory; get_predictor hands out one shared instance
+per process, so the GUI reuses it across cases and across runs.
+
+torch and nnunetv2 are only imported when a predictor is first created.
+Sliding-window tiles are counted as the network works through them, so callers
+get per-tile progress without parsing nnUNet's console output.
+"""
+import glob
+import logging
+import os
+import threading
+
+DATASET_ID = 14
+CONFIGURATION = "3d_fullres"
+FOLD = "all"
+CHECKPOINT_NAME = "checkpoint_final.pth"
+
+_predictors = {}
+_predictors_lock = threading.Lock()
+
+
+def set_nnunet_environment(nnunet_paths):
+    """Exports nnUNet_raw/results/preprocessed, keeping values the user already set."""
+    raw, results, preprocessed = nnunet_paths
+    os.environ.setdefault('nnUNet_raw', str(raw))
+    os.environ.setdefault('nnUNet_results', str(results))
+    os.environ.setdefault('nnUNet_preprocessed', str(preprocessed))
+
+
+def find_model_folder(results_folder, dataset_id=DATASET_ID, configuration=CONFIGURATION):
+    """The trained model folder (<trainer>__<plans>__<configuration>) of a dataset, or None."""
+    pattern = os.path.join(str(results_folder), f"Dataset{dataset_id:03d}_*", f"*__{configuration}")
+    folders = sorted(glob.glob(pattern))
+    return folders[0] if folders else None
+
+
+class AirwayPredictor:
+    """
+    nnUNet model loaded once and reused for every prediction. Calls are serialized,
+    the network holds the whole GPU (or all CPU cores) while it runs anyway.
+    """
+
+    def __init__(self, model_folder, device=None):
+        import torch
+        from nnunetv2.inference.predict_from_raw_data import nnUNetPredictor
+
+        if device is None:
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+        device = torch.device(device)
+        self.model_folder = model_folder
+        self._lock = threading.Lock()
+        self.predictor = nnUNetPredictor(
+            tile_step_size=0.5,
+            use_gaussian=True,
+            use_mirroring=True,
+            perform_everything_on_device=device.type == "cuda",
+            device=device,
+            verbose=False,
+            allow_tqdm=False,
+        )
+        logging.info(f"Loading nnUNet model from {model_folder} on {device}")
+        self.predictor.initialize_from_trained_model_folder(model_folder, use_folds=(FOLD,),
+                                                            checkpoint_name=CHECKPOINT_NAME)
+        self.image_io = self.predictor.plans_manager.image_reader_writer_class()
+
+        self._on_tiles = None
+        get_slicers = self.predictor._internal_get_sliding_window_slicers
+
+        def counted_slicers(image_size):
+            return _TileCounter(get_slicers(image_size), self._report_tiles)
+        self.predictor._internal_get_sliding_window_slicers = counted_slicers
+
+    def _report_tiles(self, tiles_done, tiles_total):
+        if self._on_tiles is not None:
+            self._on_tiles(tiles_done, tiles_total)
+
+    def predict(self, image_path, seg_path, on_tiles=None):
+        """
+        Segments the NIfTI image at image_path and writes the label map to seg_path.
+        `on_tiles(done, total)` is called as the sliding window advances.
+        """
+        image, properties = self.image_io.read_images([image_path])
+        with self._lock:
+            self._on_tiles = on_tiles
+            try:
+                segmentation = self.predictor.predict_single_npy_array(image, properties, None, None, False)
+            finally:
+                self._on_tiles = None
+        self.image_io.write_seg(segmentation, seg_path, properties)
+
+
+class _TileCounter:
+    """Sliding-window slicers that report how many tiles were consumed so far."""
+
+    def __init__(self, slicers, on_tile):
+        self.slicers = slicers
+        self.on_tile = on_tile
+
+    def __len__(self):
+        return len(self.slicers)
+
+    def __iter__(self):
+        total = len(self.slicers)
+        for index, slicer in enumerate(self.slicers, start=1):
+            yield slicer
+            self.on_tile(index, total)
+
+
+def get_predictor(results_folder):
+    """
+    Shared AirwayPredictor for the model under results_folder. A retrained checkpoint
+    (different size or mtime) is loaded again instead of reusing the stale model.
+    Raises FileNotFoundError if no trained model is found.
+    """
+    model_folder = find_model_folder(results_folder)
+    checkpoint = model_folder and os.path.join(model_folder, f"fold_{FOLD}", CHECKPOINT_NAME)
+    if not checkpoint or not os.path.isfile(checkpoint):
+        raise FileNotFoundError(f"No trained nnUNet model for dataset {DATASET_ID} in {results_folder}")
+    stat = os.stat(checkpoint)
+    identity = (checkpoint, stat.st_size, stat.st_mtime_ns)
+    with _predictors_lock:
+        predictor = _predictors.get(model_folder)
+        if predictor is None or predictor[0] != identity:
+            _predictors[model_folder] = predictor = (identity, AirwayPredictor(model_folder))
+        return predictor[1]
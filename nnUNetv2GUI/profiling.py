@@ -0,0 +1,205 @@
+"""
+Opt-in profiling of chosen pipeline stages.
+
+Set AIRWAY_PROFILE (or run_batch --profile) to a comma-separated list of stage
+names, or "all", and every case's run of those stages is profiled. The stages
+are the pipeline's (discovery, anonymize, convert, predict, postprocess, volume,
+stl); the function names convert_dicom_to_nifti, process_dicom_series,
+nifti_to_stl and image_to_stl are accepted too. Work a profiled stage sends to
+the process pool is profiled in the worker.
+
+For each profiled stage and case, the "Diagnostics" folder in the output folder gets:
+- <case>_<stage>.prof: cProfile statistics (open with pstats or snakeviz), or
+  with AIRWAY_PROFILE_MODE=sampling <case>_<stage>.collapsed.txt, stacks
+  sampled every 5 ms in the collapsed format flamegraph.pl and speedscope read
+- <case>_<stage>.allocations.txt: tracemalloc's peak and the lines that
+  allocated the most memory during the stage
+
+Only one cProfile session can run per process at a time; a stage that starts
+while another is profiled falls back to sampling. tracemalloc traces the whole
+process, so stages running at the same time share allocations. Without the
+setting nothing is wrapped and the stages run as before.
+"""
+import cProfile
+import logging
+import os
+import re
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+from dataclasses import dataclass
+
+PROFILE_ENV = "AIRWAY_PROFILE"
+PROFILE_MODE_ENV = "AIRWAY_PROFILE_MODE"
+PROFILE_MODES = ("cprofile", "sampling")
+DIAGNOSTICS_FOLDER = "Diagnostics"
+
+# Function names users know the stages by
+STAGE_ALIASES = {
+    "convert_dicom_to_nifti": "convert",
+    "process_dicom_series": "convert",
+    "nifti_to_stl": "stl",
+    "image_to_stl": "stl",
+    "calculate_volume": "volume",
+    "label_statistics": "volume",
+}
+
+SAMPLE_INTERVAL = 0.005
+TOP_ALLOCATIONS = 25
+
+_cprofile_lock = threading.Lock()
+_tracemalloc_lock = threading.Lock()
+_tracemalloc_users = 0
+_active = threading.local()
+
+
+def _reset_after_fork():
+    # A forked pool worker inherits the locks as the profiled parent thread held them
+    global _cprofile_lock, _tracemalloc_lock, _tracemalloc_users, _active
+    _cprofile_lock, _tracemalloc_lock = threading.Lock(), threading.Lock()
+    _tracemalloc_users = 0
+    _active = threading.local()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+@dataclass(frozen=True)
+class ProfileSettings:
+    stages: frozenset
+    folder: str
+    mode: str = "cprofile"
+
+    def wants(self, stage_name):
+        return "all" in self.stages or stage_name in self.stages
+
+
+def profile_settings(stages, output_folder, mode=None):
+    """
+    ProfileSettings for the comma-separated (or listed) `stages`, falling back to the
+    AIRWAY_PROFILE / AIRWAY_PROFILE_MODE environment variables. None when nothing is profiled.
+    """
+    if stages is None:
+        stages = os.environ.get(PROFILE_ENV, "")
+    if isinstance(stages, str):
+        stages = stages.split(",")
+    stages = frozenset(STAGE_ALIASES.get(name.strip(), name.strip()) for name in stages if name.strip())
+    if not stages:
+        return None
+    mode = mode or os.environ.get(PROFILE_MODE_ENV, "cprofile")
+    if mode not in PROFILE_MODES:
+        raise ValueError(f"Unknown profile mode {mode!r}, expected one of {', '.join(PROFILE_MODES)}")
+    return ProfileSettings(stages, os.path.join(output_folder, DIAGNOSTICS_FOLDER), mode)
+
+
+def active_profile():
+    """(settings, label) of the profiled stage running on this thread, or None."""
+    return getattr(_active, "profile", None)
+
+
+class SamplingProfiler:
+    """Samples the stack of one thread at a fixed interval from a background thread."""
+
+    def __init__(self, thread_id, interval=SAMPLE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, name="profiling-sampler", daemon=True)
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}")
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def write(self, path):
+        with open(path, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+def _start_tracemalloc():
+    global _tracemalloc_users
+    with _tracemalloc_lock:
+        if _tracemalloc_users == 0:
+            tracemalloc.start()
+        _tracemalloc_users += 1
+    tracemalloc.reset_peak()
+
+
+def _stop_tracemalloc():
+    global _tracemalloc_users
+    with _tracemalloc_lock:
+        _tracemalloc_users -= 1
+        if _tracemalloc_users == 0:
+            tracemalloc.stop()
+
+
+def _write_allocations(path, label, before, after, peak, seconds):
+    with open(path, "w") as f:
+        f.write(f"{label}: {seconds:.2f} s, traced peak {peak / (1024 * 1024):.1f} MB\n\n")
+        f.write(f"Top {TOP_ALLOCATIONS} allocating lines (net growth during the stage):\n")
+        for stat in after.compare_to(before, "lineno")[:TOP_ALLOCATIONS]:
+            f.write(f"{stat}\n")
+
+
+@contextmanager
+def profiled(settings, label):
+    """Profiles the calling thread and traces allocations while the block runs, see the module docstring."""
+    os.makedirs(settings.folder, exist_ok=True)
+    base_path = os.path.join(settings.folder, re.sub(r"[^\w.-]", "_", label))
+    use_cprofile = settings.mode == "cprofile" and _cprofile_lock.acquire(blocking=False)
+    if settings.mode == "cprofile" and not use_cprofile:
+        logging.info(f"Another stage is being profiled with cProfile, sampling {label} instead")
+
+    _start_tracemalloc()
+    before = tracemalloc.take_snapshot()
+    if use_cprofile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    else:
+        profiler = SamplingProfiler(threading.get_ident())
+        profiler.start()
+    outer = active_profile()
+    _active.profile = (settings, label)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        _active.profile = outer
+        if use_cprofile:
+            profiler.disable()
+            _cprofile_lock.release()
+            profiler.dump_stats(f"{base_path}.prof")
+        else:
+            profiler.stop()
+            profiler.write(f"{base_path}.collapsed.txt")
+        after = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        _stop_tracemalloc()
+        _write_allocations(f"{base_path}.allocations.txt", label, before, after, peak, seconds)
+        logging.info(f"Profile of {label} written to {settings.folder}")
+
+
+def profiled_call(settings, label, fn, *args):
+    """Runs fn(*args) under `profiled`. Picklable, for profiling in pool workers."""
+    with profiled(settings, f"{label}_worker_{fn.__name__}"):
+        return fn(*args)
@@ -0,0 +1,218 @@
+"""
+Progress and ETA of the prediction stage.
+
+Prediction is by far the slowest stage (up to tens of minutes per scan on a CPU),
+so it reports progress per case and per sliding-window tile. PredictionTracker
+turns those updates into PredictionProgress events with cases done, the current
+case, the time per case and an estimate of the time left, and hands them to a
+`progress(event)` callback. Tile updates are throttled so a GUI is not flooded.
+
+EventChannel carries those events, notifications and the end of a run from the
+pipeline threads to a GUI, which drains it from its own event loop.
+"""
+import logging
+import queue
+import re
+import threading
+import time
+from dataclasses import dataclass
+
+# Minimum seconds between two tile events
+TILE_EVENT_INTERVAL = 0.5
+
+# tqdm progress line as printed by nnUNetv2_predict, e.g. " 45%|####5     | 9/20 [00:10<00:12,  1.1s/it]"
+TQDM_PATTERN = re.compile(r"(\d+)/(\d+) \[")
+
+
+@dataclass
+class PredictionProgress:
+    """State of the prediction stage when an event was sent."""
+    event: str  # "start", "tiles" or "finish"
+    cases_done: int
+    cases_total: int
+    current_case: str = None
+    tiles_done: int = 0
+    tiles_total: int = 0
+    elapsed: float = 0.0  # seconds since the first case started
+    seconds_per_case: float = None  # mean over the cases predicted so far
+    eta: float = None  # estimated seconds until every case is predicted
+
+    @property
+    def fraction(self):
+        """Overall fraction done, counting the tiles of the current case."""
+        if not self.cases_total:
+            return 1.0
+        current = self.tiles_done / self.tiles_total if self.current_case and self.tiles_total else 0.0
+        return min(1.0, (self.cases_done + current) / self.cases_total)
+
+    def describe(self):
+        """One-line summary, e.g. "Case 2/5: UA_3 (tile 40/120) - 6.1 min/case - about 18 min left"."""
+        if self.current_case:
+            text = f"Case {self.cases_done + 1}/{self.cases_total}: {self.current_case}"
+            text += f" (tile {self.tiles_done}/{self.tiles_total})" if self.tiles_total else " (preprocessing)"
+        else:
+            text = f"{self.cases_done}/{self.cases_total} case(s) predicted"
+        if self.seconds_per_case is not None:
+            text += f" - {format_duration(self.seconds_per_case)}/case"
+        if self.eta is not None and self.cases_done < self.cases_total:
+            text += f" - about {format_duration(self.eta)} left"
+        return text
+
+
+def format_duration(seconds):
+    """Rounded human-readable duration: "45 s", "6.1 min" or "2.3 h"."""
+    if seconds < 90:
+        return f"{seconds:.0f} s"
+    if seconds < 5400:
+        return f"{seconds / 60:.1f} min"
+    return f"{seconds / 3600:.1f} h"
+
+
+def log_progress(progress):
+    """Default progress callback: logs case starts and finishes, not individual tiles."""
+    if progress.event != "tiles":
+        logging.info(f"Prediction progress: {progress.describe()}")
+
+
+def parse_tile_progress(line):
+    """(tiles done, tiles total) from a tqdm line of nnUNet's output, or None."""
+    match = TQDM_PATTERN.search(line)
+    if match is None:
+        return None
+    return int(match.group(1)), int(match.group(2))
+
+
+class PredictionTracker:
+    """
+    Collects case and tile updates from the prediction stage and sends PredictionProgress
+    events to `callback`. Cases that finish without running the model (cache hits,
+    resumed runs) count as done but do not affect the time per case.
+    """
+
+    def __init__(self, cases_total, callback=log_progress):
+        self.cases_total = cases_total
+        self.callback = callback
+        self._lock = threading.Lock()
+        self.cases_done = 0
+        self.durations = []
+        self.current_case = None
+        self.tiles_done = 0
+        self.tiles_total = 0
+        self._started = None
+        self._case_started = None
+        self._last_tile_event = 0.0
+
+    def start_case(self, case_name):
+        """Called right before the model runs on a case."""
+        with self._lock:
+            now = time.monotonic()
+            if self._started is None:
+                self._started = now
+            self.current_case = case_name
+            self._case_started = now
+            self.tiles_done = self.tiles_total = 0
+            event = self._event("start", now)
+        self.callback(event)
+
+    def update_tiles(self, tiles_done, tiles_total):
+        with self._lock:
+            if self.current_case is None:
+                return
+            self.tiles_done, self.tiles_total = tiles_done, tiles_total
+            now = time.monotonic()
+            if now - self._last_tile_event < TILE_EVENT_INTERVAL and tiles_done < tiles_total:
+                return
+            self._last_tile_event = now
+            event = self._event("tiles", now)
+        self.callback(event)
+
+    def finish_case(self, case_name):
+        """Called once for every case leaving the prediction stage, predicted or not."""
+        with self._lock:
+            now = time.monotonic()
+            self.cases_done += 1
+            if self.current_case == case_name:
+                self.durations.append(now - self._case_started)
+                self.current_case = None
+            event = self._event("finish", now)
+        self.callback(event)
+
+    def _event(self, kind, now):
+        seconds_per_case = sum(self.durations) / len(self.durations) if self.durations else None
+        current_elapsed = now - self._case_started if self.current_case else 0.0
+        fraction = self.tiles_done / self.tiles_total if self.current_case and self.tiles_total else 0.0
+
+        # The current case's own tile rate is the best guess for its remainder; later
+        # cases take the mean time per case, or this case's projected time before any finished
+        estimate = seconds_per_case
+        current_left = None
+        if fraction >= 0.05:
+            projected = current_elapsed / fraction
+            current_left = projected - current_elapsed
+            estimate = estimate if estimate is not None else projected
+        elif self.current_case and estimate is not None:
+            current_left = max(0.0, estimate - current_elapsed)
+
+        eta = None
+        waiting = self.cases_total - self.cases_done - (1 if self.current_case else 0)
+        if estimate is not None:
+            eta = waiting * estimate + (current_left or 0.0)
+        return PredictionProgress(
+            event=kind,
+            cases_done=self.cases_done,
+            cases_total=self.cases_total,
+            current_case=self.current_case,
+            tiles_done=self.tiles_done,
+            tiles_total=self.tiles_total,
+            elapsed=now - self._started if self._started is not None else 0.0,
+            seconds_per_case=seconds_per_case,
+            eta=eta,
+        )
+
+
+@dataclass
+class ChannelBatch:
+    """Everything drained from an EventChannel at once."""
+    progress: PredictionProgress = None  # Only the latest progress event counts
+    notifications: list = None  # (kind, title, message) in the order they were sent
+    finished: bool = False
+    error: str = None  # Why the run stopped, if it failed
+
+
+class EventChannel:
+    """
+    Thread-safe hand-over from the pipeline threads to a UI thread. Pass `notify` and
+    `progress` to run_pipeline, call `finish` when the run ends, and `drain` from the UI.
+    """
+
+    def __init__(self):
+        self._queue = queue.SimpleQueue()
+
+    def notify(self, kind, title, message):
+        self._queue.put(("notify", (kind, title, message)))
+
+    def progress(self, event):
+        self._queue.put(("progress", event))
+
+    def finish(self, error=None):
+        self._queue.put(("finish", error))
+
+    def drain(self, max_events=1000):
+        """
+        Takes up to `max_events` waiting events without blocking and returns them as one
+        ChannelBatch, so a burst of updates costs the UI a single redraw.
+        """
+        batch = ChannelBatch(notifications=[])
+        for _ in range(max_events):
+            try:
+                kind, payload = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if kind == "progress":
+                batch.progress = payload
+            elif kind == "notify":
+                batch.notifications.append(payload)
+            else:
+                batch.finished, batch.error = True, payload
+                break
+        return batch
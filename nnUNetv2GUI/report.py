@@ -0,0 +1,110 @@
+"""
+Volume report written while the batch runs.
+
+Every case is appended to "Volume Calculations.csv" (for spreadsheets) and
+"Volume Calculations.jsonl" (one JSON object per line, with the full label
+statistics) as soon as its volume is known. Each row is flushed and synced to
+disk, so the results of finished cases survive a crash mid-batch. While the
+batch runs rows are in completion order, and a case measured again in a later
+run is appended again. The JSON lines file is never rewritten; when the batch
+ends the CSV is rewritten from it with the newest row per file, in natural
+filename order (the order read_volume_report returns).
+"""
+import csv
+import json
+import logging
+import os
+import threading
+
+from natsort import natsorted
+
+REPORT_NAME = "Volume Calculations"
+CSV_COLUMNS = [
+    "Filename", "Case", "Volume (mm^3)", "Airway voxels", "Voxel volume (mm^3)",
+    "Bounding box min (i j k)", "Bounding box max (i j k)", "Bounding box size (mm)",
+]
+
+
+def report_paths(output_folder):
+    """(CSV path, JSON lines path) of the volume report in output_folder."""
+    base = os.path.join(output_folder, REPORT_NAME)
+    return f"{base}.csv", f"{base}.jsonl"
+
+
+def _join(values, fmt="{}"):
+    return " ".join(fmt.format(v) for v in values) if values is not None else ""
+
+
+def _csv_row(row):
+    bbox = row.get("bbox") or (None, None)
+    return [
+        row["filename"], row["case"], f"{row['volume']:.2f}", row["airway_voxels"], f"{row['voxel_volume']:.4f}",
+        _join(bbox[0]), _join(bbox[1]), _join(row.get("bbox_size_mm"), "{:.2f}"),
+    ]
+
+
+class VolumeReport:
+    """Appends one row per case to the CSV and JSON lines report. Thread-safe."""
+
+    def __init__(self, output_folder):
+        self.csv_path, self.json_path = report_paths(output_folder)
+        self._lock = threading.Lock()
+
+    def append(self, filename, case_name, stats):
+        """Records the label statistics (see volume.statistics_from_chunks) of one segmentation."""
+        row = {"filename": filename, "case": case_name, **stats}
+        csv_row = _csv_row(row)
+        with self._lock:
+            new_csv = not os.path.exists(self.csv_path)
+            with open(self.csv_path, "a", newline="") as f:
+                writer = csv.writer(f)
+                if new_csv:
+                    writer.writerow(CSV_COLUMNS)
+                writer.writerow(csv_row)
+                f.flush()
+                os.fsync(f.fileno())
+            with open(self.json_path, "a") as f:
+                f.write(json.dumps(row) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+    def recorded(self):
+        """Filenames that already have a row."""
+        return {row["filename"] for row in read_volume_report(os.path.dirname(self.json_path))}
+
+    def write_sorted_csv(self):
+        """Rewrites the CSV from the JSON lines report: newest row per filename, in natural filename order."""
+        with self._lock:
+            rows = read_volume_report(os.path.dirname(self.json_path))
+            if not rows:
+                return
+            # Replace in one step so the CSV is never left half written
+            tmp_path = f"{self.csv_path}.tmp"
+            with open(tmp_path, "w", newline="") as f:
+                writer = csv.writer(f)
+                writer.writerow(CSV_COLUMNS)
+                writer.writerows(_csv_row(row) for row in rows)
+            os.replace(tmp_path, self.csv_path)
+
+
+def read_volume_report(output_folder):
+    """
+    Rows of the JSON lines report, newest row per filename, in natural filename order.
+    A line cut off by a crash is skipped.
+    """
+    _, json_path = report_paths(output_folder)
+    rows = {}
+    if not os.path.exists(json_path):
+        return []
+    with open(json_path, "r") as f:
+        for line_number, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError:
+                logging.warning(f"Skipping incomplete line {line_number} of {json_path}")
+                continue
+            rows[row["filename"]] = row
+    return natsorted(rows.values(), key=lambda row: row["filename"])
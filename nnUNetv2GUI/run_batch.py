@@ -0,0 +1,118 @@
+"""
+Headless batch runner for the airway segmentation pipeline.
+
+Runs the same stages as the "Start Processing" button in main.py without a display,
+for example on a Linux server:
+
+    python run_batch.py /data/CBCT_batch --rename --predict --volume --stl
+"""
+import argparse
+import logging
+import sys
+
+from meshing import DECIMATIONS, DEFAULT_DECIMATION, DEFAULT_ENGINE, ENGINES, MESH_FORMATS
+from pipeline import PipelineOptions, PipelineError, default_workers, log_notify, run_pipeline
+from profiling import PROFILE_MODES
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Run the UpperAirway Segmentator pipeline without the GUI.")
+    parser.add_argument("input_folder", help="Folder with patient (or patient/time point) DICOM folders or NIfTI files")
+    parser.add_argument("--file-type", choices=["DICOM", "NIfTI"], default="DICOM", help="Starting file type (default: DICOM)")
+    parser.add_argument("--rename", action="store_true", help="Anonymize and rename files")
+    parser.add_argument("--nickname", default="UA", help="Name applied to renamed files (default: UA)")
+    parser.add_argument("--start-number", type=int, default=1, help="Starting number for renamed files (default: 1)")
+    parser.add_argument("--convert", action="store_true", help="Convert DICOM to NIfTI")
+    parser.add_argument("--predict", action="store_true", help="Segment (predict) the upper airway with nnUNet")
+    parser.add_argument("--volume", action="store_true", help="Calculate segmentation volumes")
+    parser.add_argument("--stl", action="store_true", help="Export segmentations as STL")
+    parser.add_argument("--mesh-engine", choices=ENGINES, default=DEFAULT_ENGINE,
+                        help=f"Surface extraction engine for STL export (default: {DEFAULT_ENGINE})")
+    parser.add_argument("--decimation", choices=DECIMATIONS, default=DEFAULT_DECIMATION,
+                        help=f"Mesh decimation algorithm: quadric is faster on dense meshes (default: {DEFAULT_DECIMATION})")
+    parser.add_argument("--target-triangles", type=int,
+                        help="Decimate each STL to at most this many triangles instead of by half")
+    parser.add_argument("--max-stl-mb", type=float, help="Decimate so that each STL file stays under this size")
+    parser.add_argument("--smooth-first", action="store_true", help="Smooth the mesh before decimating it")
+    parser.add_argument("--mesh-format", choices=MESH_FORMATS, default="stl",
+                        help="Mesh file format: ply, obj and glb share vertices and are several times smaller (default: stl)")
+    parser.add_argument("--gzip", action="store_true", help="gzip compress every mesh file")
+    parser.add_argument("--lods", type=float, nargs="+", metavar="REDUCTION",
+                        help="Write one STL per level of detail (<case>_lod0.stl, ...) from a single extraction, "
+                             "each with this fraction of triangles removed, e.g. --lods 0 0.5 0.9")
+    parser.add_argument("--workers", type=int, default=default_workers(),
+                        help="Processes used for DICOM to NIfTI conversion (default: all cores but one)")
+    parser.add_argument("--anonymize-workers", type=int, default=default_workers(),
+                        help="Workers used to anonymize DICOM files (default: all cores but one)")
+    parser.add_argument("--anonymize-processes", action="store_true",
+                        help="Anonymize with processes instead of threads")
+    parser.add_argument("--full-parse-anonymize", action="store_true",
+                        help="Decode and re-write the whole dataset instead of only the header")
+    parser.add_argument("--subprocess-predict", action="store_true",
+                        help="Run nnUNetv2_predict per case instead of keeping the model loaded in this process")
+    parser.add_argument("--no-cache", action="store_true", help="Do not reuse or store results in the result cache")
+    parser.add_argument("--cache-dir", help="Result cache folder (default: AIRWAY_CACHE_DIR or ~/.airway_segmentator_cache)")
+    parser.add_argument("--profile", metavar="STAGES",
+                        help="Profile these comma-separated stages (e.g. convert,stl or all) into the Diagnostics "
+                             "folder (default: AIRWAY_PROFILE)")
+    parser.add_argument("--profile-mode", choices=PROFILE_MODES,
+                        help="Profiler for --profile (default: AIRWAY_PROFILE_MODE or cprofile)")
+    args = parser.parse_args(argv)
+    if args.lods and not all(0.0 <= reduction < 1.0 for reduction in args.lods):
+        parser.error("--lods reductions must be between 0 (full detail) and 1")
+    return args
+
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    args = parse_args(argv)
+
+    options = PipelineOptions(
+        input_folder=args.input_folder,
+        file_type=args.file_type,
+        rename_files=args.rename,
+        convert_to_nifti=args.convert,
+        run_prediction=args.predict,
+        calculate_volume=args.volume,
+        export_stl=args.stl,
+        data_nickname=args.nickname,
+        starting_number=args.start_number,
+        use_cache=not args.no_cache,
+        cache_dir=args.cache_dir,
+        conversion_workers=args.workers,
+        anonymize_workers=args.anonymize_workers,
+        anonymize_processes=args.anonymize_processes,
+        anonymize_header_only=not args.full_parse_anonymize,
+        persistent_predictor=not args.subprocess_predict,
+        mesh_engine=args.mesh_engine,
+        decimate_algorithm=args.decimation,
+        target_triangles=args.target_triangles,
+        max_stl_mb=args.max_stl_mb,
+        smooth_before_decimate=args.smooth_first,
+        lod_reductions=tuple(args.lods) if args.lods else None,
+        mesh_format=args.mesh_format,
+        compress_meshes=args.gzip,
+        profile_stages=args.profile,
+        profile_mode=args.profile_mode,
+    )
+
+    # Remember whether any stage reported an error so the exit code reflects it
+    errors = []
+
+    def notify(kind, title, message):
+        log_notify(kind, title, message)
+        if kind == "error":
+            errors.append(message)
+
+    try:
+        output_folder = run_pipeline(options, notify=notify)
+    except PipelineError as e:
+        logging.error(str(e))
+        return 2
+
+    logging.info(f"Results saved to {output_folder}")
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
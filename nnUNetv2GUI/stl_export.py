@@ -0,0 +1,130 @@
+"""
+Batch STL export in a process pool.
+
+Meshing is CPU bound and VTK's own SMP backend (vtkDiscreteFlyingEdges3D and
+friends) would start one thread per core in every worker, so each worker is
+limited to its share of the cores. Each file is converted in isolation: an
+error (or a crashed worker) marks that file as failed and the rest of the batch
+carries on. The outcome of every file, with the mesh statistics the conversion
+returns (triangles, decimation time, file size), is returned, written to
+stl_export_summary.txt and reported to the user once.
+"""
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import dataclass
+
+from lazy_imports import lazy_import
+
+vtk = lazy_import("vtk")
+
+SUMMARY_NAME = "stl_export_summary.txt"
+
+
+@dataclass
+class StlExportResult:
+    nifti_path: str
+    stl_path: str
+    error: str = None
+    seconds: float = 0.0
+    mesh_stats: dict = None  # What convert_fn returned: one dict, or a list with one per level of detail
+
+
+def set_vtk_threads(threads):
+    """Caps the threads VTK's SMP tools use in this process."""
+    vtk.vtkSMPTools.Initialize(threads)
+
+
+def plan_workers(job_count, workers=None):
+    """(worker processes, VTK threads per worker) so that together they fill, not exceed, the cores."""
+    cores = os.cpu_count() or 2
+    workers = max(1, min(job_count, workers or max(1, cores - 1)))
+    return workers, max(1, cores // workers)
+
+
+def _convert(convert_fn, nifti_path, stl_path, convert_kwargs):
+    start = time.perf_counter()
+    try:
+        mesh_stats = convert_fn(nifti_path, stl_path, **convert_kwargs)
+        return None, time.perf_counter() - start, mesh_stats
+    except Exception as e:
+        return str(e), time.perf_counter() - start, None
+
+
+def export_stl_files(jobs, convert_fn, workers=None, **convert_kwargs):
+    """
+    Runs `convert_fn(nifti_path, stl_path, **convert_kwargs)` for every (nifti_path, stl_path)
+    in jobs on a process pool. convert_fn must be a module-level function that raises on failure.
+    Returns a StlExportResult per job, in job order.
+    """
+    if not jobs:
+        return []
+    workers, threads = plan_workers(len(jobs), workers)
+    logging.info(f"Exporting {len(jobs)} STL file(s) with {workers} worker(s), {threads} VTK thread(s) each")
+    results = {}
+    with ProcessPoolExecutor(max_workers=workers, initializer=set_vtk_threads, initargs=(threads,)) as executor:
+        futures = {
+            executor.submit(_convert, convert_fn, nifti_path, stl_path, convert_kwargs): (nifti_path, stl_path)
+            for nifti_path, stl_path in jobs
+        }
+        for future in as_completed(futures):
+            nifti_path, stl_path = futures[future]
+            try:
+                error, seconds, mesh_stats = future.result()
+            except Exception as e:
+                # The worker died (e.g. out of memory); the pool reports it for every pending file
+                error, seconds, mesh_stats = f"Worker process failed: {e}", 0.0, None
+            if error:
+                logging.error(f"Failed to convert {nifti_path} to STL: {error}")
+            else:
+                logging.info(f"Exported {stl_path} in {seconds:.1f} s{describe_mesh_stats(mesh_stats)}")
+            results[nifti_path, stl_path] = StlExportResult(nifti_path, stl_path, error, seconds, mesh_stats)
+    return [results[job] for job in jobs]
+
+
+def _as_levels(mesh_stats):
+    return mesh_stats if isinstance(mesh_stats, list) else [mesh_stats] if mesh_stats else []
+
+
+def describe_mesh_stats(mesh_stats):
+    """Short log suffix with the triangle counts, decimation time and file size of each file, if known."""
+    return "".join(
+        f", {os.path.basename(stats['path']) + ': ' if 'path' in stats else ''}"
+        f"{stats['triangles_extracted']} -> {stats['triangles']} triangles, "
+        f"decimated in {stats.get('decimate_seconds', 0.0):.2f} s, {stats['file_bytes'] / (1024 * 1024):.1f} MB"
+        for stats in _as_levels(mesh_stats)
+    )
+
+
+def write_summary(results, output_folder):
+    """
+    Writes one line per output file (status, seconds, triangles before and after decimation,
+    decimation seconds, file size, input, output or error) and returns the path. Levels of
+    detail exported from one input get a line each.
+    """
+    summary_path = os.path.join(output_folder, SUMMARY_NAME)
+    with open(summary_path, "w") as f:
+        f.write("Status\tSeconds\tTriangles extracted\tTriangles\tDecimate seconds\tMB\tInput\tMesh file or error\n")
+        for result in results:
+            for stats in _as_levels(result.mesh_stats) or [{}]:
+                status, detail = ("FAILED", result.error) if result.error else ("OK", stats.get("path", result.stl_path))
+                mesh_columns = [
+                    stats.get("triangles_extracted", ""), stats.get("triangles", ""),
+                    f"{stats['decimate_seconds']:.2f}" if "decimate_seconds" in stats else "",
+                    f"{stats['file_bytes'] / (1024 * 1024):.2f}" if "file_bytes" in stats else "",
+                ]
+                f.write("\t".join([status, f"{result.seconds:.1f}", *map(str, mesh_columns),
+                                   os.path.basename(result.nifti_path), detail]) + "\n")
+    return summary_path
+
+
+def summary_message(results, summary_path):
+    """(kind, title, message) of the single notification for a finished export."""
+    failed = [result for result in results if result.error]
+    if not failed:
+        return "info", "Conversion Complete", f"All {len(results)} NIfTI file(s) have been converted to STL files."
+    examples = "\n".join(f"{os.path.basename(r.nifti_path)}: {r.error}" for r in failed[:5])
+    return ("error", "Conversion Error",
+            f"{len(failed)} of {len(results)} file(s) could not be converted. First failures:\n{examples}"
+            f"\n\nFull list: {summary_path}")
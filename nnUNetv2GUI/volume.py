@@ -0,0 +1,107 @@
+"""
+Airway volume from a NIfTI label map without loading the image.
+
+get_fdata() turns a uint8 label map into a float64 array eight times its size
+(cached on the image) and `data == label` adds another full-size array. Counting
+a label does not need the voxels in their spatial layout, so the voxel data is
+instead streamed through the (de)compressor in fixed-size chunks and compared in
+its stored dtype. Peak memory is one chunk, whatever the size of the scan.
+
+The same chunks also give the airway bounding box and per-label voxel counts
+(label_statistics): a voxel's position follows from its offset in the file,
+which NIfTI stores with x varying fastest.
+"""
+from lazy_imports import lazy_import
+
+nib = lazy_import("nibabel")
+np = lazy_import("numpy")
+openers = lazy_import("nibabel.openers")
+
+# Bytes of voxel data read and compared at a time
+VOLUME_CHUNK_SIZE = 1 << 22
+
+AIRWAY_LABEL = 1
+
+
+def iter_voxel_chunks(nifti_img, file_path, chunk_size=VOLUME_CHUNK_SIZE):
+    """
+    Yields the voxels of a loaded (not read) NIfTI image as flat arrays in file order,
+    in the stored dtype unless the header asks for scaling.
+    Raises ValueError if the file holds fewer voxels than its header announces.
+    """
+    header = nifti_img.header
+    dtype = header.get_data_dtype()
+    remaining = int(np.prod(header.get_data_shape())) * dtype.itemsize
+    # Loading moves the data offset and scaling from the header (which then reads
+    # 0 and no scaling) to the array proxy, so they are taken from there
+    proxy = nifti_img.dataobj
+    # Scaled label maps are rare, their chunks are scaled before use
+    slope, inter = proxy.slope, proxy.inter
+    scaled = slope not in (None, 1.0) or inter not in (None, 0.0)
+    chunk_size -= chunk_size % dtype.itemsize
+
+    with openers.ImageOpener(file_path) as f:
+        f.seek(int(proxy.offset))
+        while remaining > 0:
+            chunk = f.read(min(chunk_size, remaining))
+            if not chunk:
+                raise ValueError(f"{file_path} ends {remaining} bytes before the end of its voxel data")
+            remaining -= len(chunk)
+            values = np.frombuffer(chunk, dtype=dtype)
+            if scaled:
+                values = values * (1.0 if slope is None else slope) + (0.0 if inter is None else inter)
+            yield values
+
+
+def count_label_voxels(nifti_img, file_path, label, chunk_size=VOLUME_CHUNK_SIZE):
+    """Number of voxels of a loaded (not read) NIfTI image equal to `label`."""
+    return sum(int(np.count_nonzero(values == label))
+               for values in iter_voxel_chunks(nifti_img, file_path, chunk_size))
+
+
+def statistics_from_chunks(chunks, shape, zooms, airway_label=AIRWAY_LABEL):
+    """
+    Airway voxel count and volume (mm^3), its bounding box in voxels and mm, and the
+    voxel count of every label, from flat voxel chunks in x-fastest order.
+    """
+    nx, ny = shape[0], shape[1]
+    label_counts = {}
+    lower = upper = None
+    offset = 0
+    for values in chunks:
+        labels, counts = np.unique(values, return_counts=True)
+        for label, count in zip(labels.tolist(), counts.tolist()):
+            label_counts[label] = label_counts.get(label, 0) + count
+        hits = np.flatnonzero(values == airway_label)
+        if hits.size:
+            # Only the first and last hit of the chunk can extend z, x and y need all of them
+            hits += offset
+            x, y = hits % nx, (hits // nx) % ny
+            z_first, z_last = int(hits[0] // (nx * ny)), int(hits[-1] // (nx * ny))
+            chunk_lower = [int(x.min()), int(y.min()), z_first]
+            chunk_upper = [int(x.max()), int(y.max()), z_last]
+            lower = chunk_lower if lower is None else [min(a, b) for a, b in zip(lower, chunk_lower)]
+            upper = chunk_upper if upper is None else [max(a, b) for a, b in zip(upper, chunk_upper)]
+        offset += values.size
+
+    voxel_volume = float(np.prod(zooms[:3]))
+    airway_voxels = label_counts.get(airway_label, 0)
+    return {
+        "airway_voxels": airway_voxels,
+        "volume": airway_voxels * voxel_volume,
+        "voxel_volume": voxel_volume,
+        "bbox": [lower, upper] if lower is not None else None,
+        "bbox_size_mm": [(hi - lo + 1) * float(zoom) for lo, hi, zoom in zip(lower, upper, zooms)]
+        if lower is not None else None,
+        "labels": {str(label): count for label, count in sorted(label_counts.items())},
+    }
+
+
+def label_statistics(file_path, airway_label=AIRWAY_LABEL):
+    """statistics_from_chunks for a NIfTI file, streamed one chunk at a time. Picklable for process pools."""
+    nifti_img = nib.load(file_path)
+    header = nifti_img.header
+    # Python floats like LabelMap, so both paths compute the same volume
+    zooms = tuple(float(z) for z in header.get_zooms()[:3])
+    return statistics_from_chunks(iter_voxel_chunks(nifti_img, file_path), header.get_data_shape(), zooms,
+                                  airway_label)
@@ -0,0 +1,19 @@
+import os
+import sys
+
+import pytest
+
+# The application is a folder of scripts importing each other by module name
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "nnUNetv2GUI"))
+
+
+@pytest.fixture(scope="session")
+def phantom_case(tmp_path_factory):
+    """One small phantom: (DICOM folder, label map path, airway voxels)."""
+    from phantom import write_phantom
+
+    root = tmp_path_factory.mktemp("phantom")
+    dicom_folder = str(root / "DICOM")
+    label_path = str(root / "Labels" / "Phantom_seg.nii.gz")
+    airway_voxels = write_phantom(dicom_folder, label_path, slices=24, size=48)
+    return dicom_folder, label_path, airway_voxels
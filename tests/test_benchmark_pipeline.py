@@ -0,0 +1,19 @@
+import benchmark_pipeline
+from phantom import generate_dataset
+from volume import label_statistics
+
+
+def test_phantom_volumes_match_generated_airway(tmp_path):
+    cases = generate_dataset(str(tmp_path), patients=2, time_points=["T1", "T2"], slices=24, size=48)
+    for case in cases:
+        assert label_statistics(case["label_path"])["airway_voxels"] == case["airway_voxels"]
+
+
+def test_benchmark_size_runs_every_stage(tmp_path, monkeypatch):
+    monkeypatch.setitem(benchmark_pipeline.SIZES, "tiny", (16, 32, 0.8))
+    rows = benchmark_pipeline.benchmark_size("tiny", str(tmp_path), patients=2, time_points=[],
+                                             transfer_syntax="explicit", repeats=1, workers=1)
+    assert [row["stage"] for row in rows] == [
+        "discovery (cold)", "discovery (saved index)", "anonymization", "conversion", "prediction (stand-in)",
+        "volume", "stl export", "end to end"]
+    assert all(row["cases"] == 2 and row["seconds"] >= 0 for row in rows)
@@ -0,0 +1,109 @@
+import os
+
+import nibabel as nib
+import numpy as np
+import pydicom
+
+from cache import ResultCache, dicom_series_key, nifti_key, stage_key
+
+
+def test_file_round_trip_is_a_copy(tmp_path):
+    cache = ResultCache(str(tmp_path / "cache"))
+    source = tmp_path / "seg.nii.gz"
+    source.write_bytes(b"label map")
+    key = stage_key("image", "predict")
+    assert not cache.get_file(key, str(tmp_path / "miss.nii.gz"))
+    cache.put_file(key, str(source))
+
+    restored = tmp_path / "restored.nii.gz"
+    assert cache.get_file(key, str(restored))
+    assert restored.read_bytes() == b"label map"
+    # Editing a restored output never reaches the cache
+    restored.write_bytes(b"edited")
+    assert cache.get_file(key, str(tmp_path / "again.nii.gz"))
+    assert (tmp_path / "again.nii.gz").read_bytes() == b"label map"
+
+
+def test_value_round_trip_keeps_the_first_entry(tmp_path):
+    cache = ResultCache(str(tmp_path / "cache"))
+    key = stage_key("label", "volume", {"airway_label": 1})
+    assert cache.get_value(key) is None
+    cache.put_value(key, {"volume": 12.5})
+    cache.put_value(key, {"volume": 99.0})
+    assert cache.get_value(key) == {"volume": 12.5}
+    assert os.path.isdir(os.path.join(cache.objects, key[:2], key))
+
+
+def test_stage_key_follows_input_stage_and_params():
+    key = stage_key("label", "stl", {"decimate": True})
+    assert stage_key("label", "stl", {"decimate": True}) == key
+    assert stage_key("other", "stl", {"decimate": True}) != key
+    assert stage_key("label", "volume", {"decimate": True}) != key
+    assert stage_key("label", "stl", {"decimate": False}) != key
+
+
+def save(path, data):
+    nib.save(nib.Nifti1Image(data, np.diag([0.4, 0.4, 0.4, 1.0])), str(path))
+    return str(path)
+
+
+def test_nifti_key_hashes_voxels_not_header(tmp_path):
+    data = np.zeros((20, 20, 10), dtype=np.uint8)
+    img = nib.Nifti1Image(data, np.diag([0.4, 0.4, 0.4, 1.0]))
+    nib.save(img, str(tmp_path / "a.nii.gz"))
+    # A header field outside the geometry does not change the content
+    img.header["descrip"] = b"renamed"
+    nib.save(img, str(tmp_path / "b.nii.gz"))
+    key = nifti_key(str(tmp_path / "a.nii.gz"))
+    assert nifti_key(str(tmp_path / "b.nii.gz")) == key
+    data[-1, -1, -1] = 1
+    assert nifti_key(save(tmp_path / "c.nii.gz", data)) != key
+
+
+def test_nifti_key_ignores_compression(tmp_path):
+    data = np.arange(20 * 20 * 10, dtype=np.int16).reshape(20, 20, 10)
+    assert nifti_key(save(tmp_path / "a.nii", data)) == nifti_key(save(tmp_path / "a.nii.gz", data))
+
+
+def test_dicom_series_key_follows_pixels_not_names(phantom_case, tmp_path):
+    dicom_folder, _, _ = phantom_case
+    key = dicom_series_key(dicom_folder)
+    copy = tmp_path / "copy"
+    copy.mkdir()
+    for i, name in enumerate(sorted(os.listdir(dicom_folder))):
+        dataset = pydicom.dcmread(os.path.join(dicom_folder, name))
+        dataset.PatientName = "Someone^Else"
+        dataset.save_as(str(copy / f"slice{i}.dcm"))
+    # Other file names and patient tags, same series
+    assert dicom_series_key(str(copy)) == key
+
+    dataset = pydicom.dcmread(str(copy / "slice0.dcm"))
+    pixels = bytearray(dataset.PixelData)
+    pixels[-1] ^= 1
+    dataset.PixelData = bytes(pixels)
+    dataset.save_as(str(copy / "slice0.dcm"))
+    assert dicom_series_key(str(copy)) != key
+
+
+def test_cache_evicts_least_recently_used_past_limit(tmp_path):
+    cache = ResultCache(str(tmp_path / "cache"), max_bytes=3000)
+    for i in range(5):
+        source = tmp_path / f"file{i}"
+        source.write_bytes(bytes(1000))
+        cache.put_file(f"key{i}", str(source))
+        # Distinct last-used times, oldest first
+        os.utime(os.path.join(cache.objects, "ke", f"key{i}", "meta.json"), (i, i))
+    assert not cache.get_file("key0", str(tmp_path / "out"))
+    assert not cache.get_file("key1", str(tmp_path / "out"))
+    assert cache.get_file("key4", str(tmp_path / "out"))
+
+
+def test_cache_scans_once_while_under_limit(tmp_path, monkeypatch):
+    cache = ResultCache(str(tmp_path / "cache"), max_bytes=1 << 20)
+    scans = []
+    scan = cache._scan
+    monkeypatch.setattr(cache, "_scan", lambda: scans.append(1) or scan())
+    for i in range(5):
+        cache.put_value(f"key{i}", i)
+    assert len(scans) == 1
+    assert cache._size == sum(size for _, size, _ in scan())
@@ -0,0 +1,50 @@
+import os
+
+from manifest import RunManifest
+from pipeline import Case
+
+
+def converted_case(tmp_path, content=b"voxels"):
+    nifti_path = tmp_path / "case.nii.gz"
+    nifti_path.write_bytes(content)
+    return Case(name="case", nifti_path=str(nifti_path))
+
+
+def test_recorded_stage_is_completed_after_reload(tmp_path):
+    case = converted_case(tmp_path)
+    manifest = RunManifest(str(tmp_path))
+    manifest.register_case(case, "input/case")
+    manifest.record(case, "convert")
+
+    reloaded = RunManifest(str(tmp_path))
+    resumed = Case(name="case")
+    assert reloaded.completed(resumed, "convert")
+    assert not reloaded.completed(resumed, "predict")
+    reloaded.restore(resumed, "convert")
+    assert resumed.nifti_path == case.nifti_path
+
+
+def test_changed_or_missing_output_is_not_completed(tmp_path):
+    case = converted_case(tmp_path)
+    manifest = RunManifest(str(tmp_path))
+    manifest.register_case(case, "input/case")
+    manifest.record(case, "convert")
+
+    # Touched but identical: the checksum still matches
+    os.utime(case.nifti_path, ns=(0, 0))
+    assert manifest.completed(case, "convert")
+    with open(case.nifti_path, "wb") as f:
+        f.write(b"other voxels")
+    assert not manifest.completed(case, "convert")
+    os.remove(case.nifti_path)
+    assert not manifest.completed(case, "convert")
+
+
+def test_other_input_under_the_same_name_starts_over(tmp_path):
+    case = converted_case(tmp_path)
+    manifest = RunManifest(str(tmp_path))
+    manifest.register_case(case, "input/case")
+    manifest.record(case, "convert")
+    assert manifest.source_names() == {"input/case": "case"}
+    manifest.register_case(case, "other/case")
+    assert not manifest.completed(case, "convert")
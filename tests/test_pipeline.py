@@ -0,0 +1,35 @@
+import os
+
+from benchmark_pipeline import StandInRun
+from phantom import generate_dataset
+from pipeline import PipelineOptions, PipelineRun
+from stl_export import set_vtk_threads
+
+
+def test_pool_workers_cap_vtk_threads_when_meshing(tmp_path):
+    options = dict(input_folder=str(tmp_path / "input"), file_type="NIfTI", use_cache=False, conversion_workers=4)
+    # Every pool worker may mesh, VTK gets that worker's share of the cores
+    initializer, initargs = PipelineRun(PipelineOptions(export_stl=True, **options)).pool_initializer()
+    assert initializer is set_vtk_threads
+    assert initargs == (max(1, (os.cpu_count() or 2) // 4),)
+    # Volume-only runs leave VTK alone
+    assert PipelineRun(PipelineOptions(calculate_volume=True, **options)).pool_initializer() == (None, ())
+
+
+def test_cases_failing_before_prediction_count_as_done(tmp_path, monkeypatch):
+    generate_dataset(str(tmp_path / "data"), patients=3, slices=16, size=32)
+    convert_case = StandInRun.convert_case
+
+    def failing_convert(run, case):
+        if case.name.endswith("1"):
+            raise RuntimeError("unreadable series")
+        convert_case(run, case)
+
+    monkeypatch.setattr(StandInRun, "convert_case", failing_convert)
+    events = []
+    options = PipelineOptions(input_folder=str(tmp_path / "data" / "DICOM"), run_prediction=True, use_cache=False,
+                              conversion_workers=1)
+    cases = StandInRun(options, progress=events.append).run()
+    assert sum(1 for case in cases if case.error) == 1
+    assert events[-1].cases_done == events[-1].cases_total == 3
+    assert events[-1].fraction == 1.0
@@ -0,0 +1,43 @@
+import csv
+import json
+
+from report import VolumeReport, read_volume_report
+
+
+def stats(volume):
+    return {"volume": volume, "airway_voxels": int(volume), "voxel_volume": 1.0, "bbox": [[0, 0, 0], [1, 1, 1]],
+            "bbox_size_mm": [2.0, 2.0, 2.0]}
+
+
+def test_rows_are_on_disk_as_soon_as_appended(tmp_path):
+    report = VolumeReport(str(tmp_path))
+    report.append("P1_seg.nii.gz", "P1", stats(5))
+    with open(report.csv_path, newline="") as f:
+        header, row = list(csv.reader(f))
+    assert header[0] == "Filename"
+    assert row[:4] == ["P1_seg.nii.gz", "P1", "5.00", "5"]
+    with open(report.json_path) as f:
+        assert json.loads(f.readline())["volume"] == 5
+    assert report.recorded() == {"P1_seg.nii.gz"}
+
+
+def test_reading_skips_a_line_cut_off_by_a_crash(tmp_path):
+    report = VolumeReport(str(tmp_path))
+    report.append("P1_seg.nii.gz", "P1", stats(5))
+    with open(report.json_path, "a") as f:
+        f.write('{"filename": "P2_seg.ni')
+    assert [row["filename"] for row in read_volume_report(str(tmp_path))] == ["P1_seg.nii.gz"]
+
+
+def test_report_keeps_newest_row_in_filename_order(tmp_path):
+    report = VolumeReport(str(tmp_path))
+    for filename, volume in (("P10_seg.nii.gz", 10), ("P2_seg.nii.gz", 2), ("P10_seg.nii.gz", 11)):
+        report.append(filename, filename.split("_")[0], stats(volume))
+    with open(report.csv_path, newline="") as f:
+        assert [row[0] for row in list(csv.reader(f))[1:]] == ["P10_seg.nii.gz", "P2_seg.nii.gz", "P10_seg.nii.gz"]
+
+    report.write_sorted_csv()
+    with open(report.csv_path, newline="") as f:
+        rows = list(csv.reader(f))[1:]
+    assert [(row[0], row[2]) for row in rows] == [("P2_seg.nii.gz", "2.00"), ("P10_seg.nii.gz", "11.00")]
+    assert [row["volume"] for row in read_volume_report(str(tmp_path))] == [2, 11]
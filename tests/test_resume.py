@@ -0,0 +1,68 @@
+import csv
+import logging
+import os
+
+import pytest
+
+from benchmark_pipeline import StandInRun
+from phantom import generate_dataset
+from pipeline import PipelineOptions, PipelineRun, get_output_folder
+from report import report_paths
+
+
+@pytest.fixture
+def label_folder(tmp_path):
+    generate_dataset(str(tmp_path / "data"), patients=2, slices=16, size=32)
+    return str(tmp_path / "data" / "Labels")
+
+
+def run(label_folder, **options):
+    return PipelineRun(PipelineOptions(input_folder=label_folder, file_type="NIfTI", use_cache=False,
+                                       conversion_workers=1, **options)).run()
+
+
+def skipped(caplog, stage="postprocess"):
+    return [record.message for record in caplog.records if record.message.startswith(f"Skipping {stage}")]
+
+
+def test_unchanged_rerun_is_skipped(label_folder, caplog):
+    run(label_folder, calculate_volume=True, export_stl=True)
+    with caplog.at_level(logging.INFO):
+        cases = run(label_folder, calculate_volume=True, export_stl=True)
+    assert len(skipped(caplog)) == 2
+    assert all(case.label_stats and case.stl_path for case in cases)
+
+
+def test_adding_stl_export_reruns_postprocess(label_folder, caplog):
+    run(label_folder, calculate_volume=True)
+    with caplog.at_level(logging.INFO):
+        cases = run(label_folder, calculate_volume=True, export_stl=True)
+    assert not skipped(caplog)
+    assert all(case.stl_path and os.path.isfile(case.stl_path) for case in cases)
+
+
+def test_changed_mesh_settings_rerun_postprocess(label_folder, caplog):
+    run(label_folder, export_stl=True)
+    with caplog.at_level(logging.INFO):
+        cases = run(label_folder, export_stl=True, mesh_format="ply", lod_reductions=(0.0, 0.5))
+    assert not skipped(caplog)
+    for case in cases:
+        assert len(case.stl_paths) == 2
+        assert all(path.endswith(".ply") and os.path.isfile(path) for path in case.stl_paths)
+
+
+def test_rerun_with_cache_skips_every_stage(tmp_path, caplog):
+    generate_dataset(str(tmp_path / "data"), patients=2, slices=16, size=32)
+    dicom_root = str(tmp_path / "data" / "DICOM")
+    options = PipelineOptions(input_folder=dicom_root, rename_files=True, convert_to_nifti=True,
+                              run_prediction=True, calculate_volume=True, cache_dir=str(tmp_path / "cache"),
+                              conversion_workers=1, anonymize_workers=1)
+    StandInRun(options).run()
+    with caplog.at_level(logging.INFO):
+        cases = StandInRun(options).run()
+    for stage in ("anonymize", "convert", "predict", "postprocess"):
+        assert len(skipped(caplog, stage)) == 2, stage
+    assert all(case.image_key and case.label_key and case.label_stats for case in cases)
+    # Nothing was measured again, so the report still has one row per case
+    with open(report_paths(get_output_folder(dicom_root))[0], newline="") as f:
+        assert len(list(csv.reader(f))) == 3
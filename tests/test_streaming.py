@@ -0,0 +1,55 @@
+import threading
+import time
+
+from pipeline import Case, run_streaming
+
+
+def ignore(*args):
+    pass
+
+
+def test_every_case_passes_every_stage_in_order():
+    seen = []
+    stages = [(name, lambda case, name=name: seen.append((name, case.name))) for name in ("first", "second", "third")]
+    cases = [Case(name=f"case{i}") for i in range(5)]
+    assert run_streaming(cases, stages, ignore) is cases
+    for case in cases:
+        assert case.error is None
+        assert [stage for stage, name in seen if name == case.name] == ["first", "second", "third"]
+
+
+def test_failed_case_skips_the_remaining_stages():
+    def first(case):
+        if case.name == "bad":
+            raise RuntimeError("broken")
+
+    reached, notifications = [], []
+    cases = [Case(name="bad"), Case(name="good")]
+    run_streaming(cases, [("first", first), ("second", lambda case: reached.append(case.name))],
+                  lambda *args: notifications.append(args))
+    assert cases[0].error == "first: broken"
+    assert cases[1].error is None
+    assert reached == ["good"]
+    assert len(notifications) == 1
+
+
+def test_slow_stage_does_not_hold_back_earlier_stages():
+    release = threading.Event()
+    converted = []
+
+    def second(case):
+        if case.name == "case0":
+            release.wait(10)
+
+    cases = [Case(name=f"case{i}") for i in range(3)]
+    stages = [("first", lambda case: converted.append(case.name)), ("second", second)]
+    runner = threading.Thread(target=run_streaming, args=(cases, stages, ignore))
+    runner.start()
+    # While case0 is stuck in the second stage, the first stage finishes the others
+    deadline = time.monotonic() + 10
+    while len(converted) < 3 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    finished_first = list(converted)
+    release.set()
+    runner.join()
+    assert finished_first == ["case0", "case1", "case2"]
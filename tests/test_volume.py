@@ -0,0 +1,48 @@
+import nibabel as nib
+import numpy as np
+import pytest
+
+from postprocess import LabelMap
+from volume import count_label_voxels, label_statistics
+
+
+@pytest.fixture(params=[".nii", ".nii.gz"])
+def label_file(request, tmp_path):
+    """A label map with several labels and a non-trivial airway, uncompressed and gzipped."""
+    rng = np.random.default_rng(0)
+    data = rng.choice([0, 0, 0, 1, 2], size=(23, 17, 11)).astype(np.uint8)
+    # Voxels at both ends of the data, where a wrong data offset shows first
+    data[0, 0, 0] = data[-1, -1, -1] = 1
+    path = str(tmp_path / f"label{request.param}")
+    nib.save(nib.Nifti1Image(data, np.diag([0.4, 0.4, 0.5, 1.0])), path)
+    return path
+
+
+@pytest.mark.parametrize("chunk_size", [7, 1 << 22])
+@pytest.mark.parametrize("label", [0, 1, 2])
+def test_streamed_count_matches_loaded_array(label_file, label, chunk_size):
+    img = nib.load(label_file)
+    expected = int(np.count_nonzero(np.asanyarray(img.dataobj) == label))
+    assert count_label_voxels(img, label_file, label, chunk_size) == expected
+
+
+def test_streamed_count_on_phantom(phantom_case):
+    _, label_path, airway_voxels = phantom_case
+    img = nib.load(label_path)
+    assert count_label_voxels(img, label_path, 1) == airway_voxels
+    assert count_label_voxels(img, label_path, 1) == int(np.count_nonzero(np.asanyarray(img.dataobj) == 1))
+
+
+def test_streamed_statistics_match_label_map(label_file):
+    streamed = label_statistics(label_file)
+    assert streamed == LabelMap(label_file).statistics()
+    assert streamed["labels"].keys() == {"0", "1", "2"}
+    assert streamed["bbox"] == [[0, 0, 0], [22, 16, 10]]
+
+
+def test_streamed_statistics_match_label_map_on_phantom(phantom_case):
+    _, label_path, airway_voxels = phantom_case
+    streamed = label_statistics(label_path)
+    assert streamed == LabelMap(label_path).statistics()
+    assert streamed["airway_voxels"] == airway_voxels
+    assert set(streamed["labels"]) == {"0", "1"}